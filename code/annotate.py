@@ -13,6 +13,7 @@ The user must also provide:
 # importing the necessary libraries
 import argparse
 import sys
+import threading
 import time
 import numpy as np
 import cv2
@@ -26,9 +27,15 @@ import json
 import os
 from tkinter import font as tkfont
 from vutils import *
+from framecache import FrameCache
+from proxy import load_proxy
+from timeline import FEATURES, load_features, render_strip, segment_at
 
 LINE_SPACING = 30
 FONT_SIZE = 20
+REFINE_TICK = 20 # ms between checks for the full resolution frame while showing the proxy
+TIMELINE_ROW = 6 # height of each feature row of the timeline
+TIMELINE_TICK = 500 # ms between checks for the timeline scan
 
 class VidUI():
     '''
@@ -46,6 +53,7 @@ class VidUI():
         self.root = tk.Tk()
         self.style = ttk.Style(self.root)
         self.dtick = 100
+        self.refining = False
 
         #
         # creamos la interfaz gráfica (ventana)
@@ -75,15 +83,17 @@ class VidUI():
                 "sync_1_frame":-1,
                 "sync_2_frame":-1,
                 "rot1": self.rot[0],
-                "rot2": self.rot[1]
+                "rot2": self.rot[1],
+                "rot1_confidence": args.get("rotation1_confidence"),
+                "rot2_confidence": args.get("rotation2_confidence")
                 }
         print(json.dumps(self.annotations))
 
         self.cap = [cap1,cap2]
-        self.cv2_frame = [None,None]
         self.color_frame = [None,None]
-        self.gray_frame = [None,None]
+        self.frame_cache = [None,None]
         self.tk_image = [None,None]
+        self.items = None # canvas items, created on the first paint
         self.fps = [None,None]
         self.nframes = 1000000000
         for C in range(self.ncams):
@@ -94,9 +104,11 @@ class VidUI():
             self.nframes = min(self.nframes,nframes_c)
             print(f"Total number of frames for camera {C} : {nframes_c}")
         self.frame_idx = 0 # self.nframes-1 # DEBUG
-        self.grab_frame()
-
-        self.frame_height,self.frame_width,nchannels = self.color_frame[C].shape
+        # size of the rotated frames
+        self.frame_width = int(self.cap[C].get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.frame_height = int(self.cap[C].get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if self.rot[C] % 180:
+            self.frame_width,self.frame_height = self.frame_height,self.frame_width
         self.annotations["crop_box"] = [0,self.frame_height,0,self.frame_width]
         two_images_width = 2 * self.frame_width
         two_images_height = self.frame_height
@@ -120,6 +132,15 @@ class VidUI():
 
         self.scaled_frame_width = int(self.frame_width*self.scale)
         self.scaled_frame_height = int(self.frame_height*self.scale)
+        #
+        # frames are decoded, rotated and scaled for display in the background, one thread
+        # per camera, so that the interface does not freeze while navigating
+        #
+        video_fnames = args.get("video_fnames",[None,None])
+        proxies = args.get("proxies",[None,None])
+        for C in range(self.ncams):
+            self.frame_cache[C] = FrameCache(self.cap[C],video_fnames[C],self.rot[C],self.scale,proxy=proxies[C])
+        self.grab_frame()
         self.height = self.window_height
         print("input frame shape h=",self.frame_height, "w=",self.frame_width)
         print("scaled frame shape h=",self.scaled_frame_height, "w=",self.scaled_frame_width)
@@ -161,6 +182,21 @@ class VidUI():
         ci += 1
 
         nav_bar.pack(side=tk.BOTTOM)
+        #
+        # timeline overview of each camera (see timeline.py), scanned in the background;
+        # clicking on it jumps to that frame, or to the start of the segment clicked
+        #
+        self.timeline_features = [None,None]
+        self.timeline_done = [False,False] # scan finished (features stay None if it failed)
+        self.timeline_photo = [None,None]
+        self.timeline_width = self.window_width
+        self.timeline_cursor_x = None
+        self.timeline = tk.Canvas(fmain, width=self.timeline_width, height=TIMELINE_ROW*len(FEATURES)*self.ncams, bg='#111', highlightthickness=0)
+        self.timeline.bind('<Button-1>',self.timeline_click)
+        self.timeline_cursor = self.timeline.create_line(0,0,0,0,fill="#f00",width=2)
+        self.timeline.pack(side=tk.BOTTOM,fill='x')
+        threading.Thread(target=self.scan_timeline,args=(video_fnames,),name="timeline",daemon=True).start()
+        self.root.after(TIMELINE_TICK,self.check_timeline)
         #self.slider = ttk.Scale(fmain,from_=0,to=1,variable=0,orient='horizontal',command=self.slide_to_frame)
         #self.slider.pack(side=tk.TOP,fill='x')
 
@@ -196,20 +232,105 @@ class VidUI():
         self.canvas.after(self.dtick,self.update)
         self.side_bar = side_bar
         self.root.mainloop()
+        for C in range(self.ncams):
+            self.frame_cache[C].close()
+
+    def grab_frame(self,step=0):
+        """
+        Gets the current frame of each camera (already rotated and scaled for display) and
+        has the frames that follow in steps of step decoded in the background.
+        If the videos have proxies, their frames are shown until the full resolution ones
+        are ready (see refine).
+        """
+        for C in range(self.ncams):
+            self.frame_cache[C].request(self.frame_idx,step)
+        pending = False
+        for C in range(self.ncams):
+            frame,exact = self.frame_cache[C].peek(self.frame_idx)
+            if frame is None:
+                frame,exact = self.frame_cache[C].get(self.frame_idx,step),True
+            if frame is None:
+                print(f"WARNING: could not decode frame {self.frame_idx} of camera {C+1}")
+                continue
+            self.color_frame[C] = frame
+            pending = pending or not exact
+        if pending and not self.refining:
+            self.refining = True
+            self.root.after(REFINE_TICK,self.refine)
+
+
+    def refine(self):
+        """
+        Replaces the proxy frames on display by the full resolution ones once decoded
+        """
+        self.refining = False
+        pending = False
+        changed = False
+        for C in range(self.ncams):
+            frame,exact = self.frame_cache[C].peek(self.frame_idx)
+            if exact:
+                changed = changed or frame is not self.color_frame[C]
+                self.color_frame[C] = frame
+            else:
+                pending = True
+        if changed:
+            self.update()
+        if pending:
+            self.refining = True
+            self.root.after(REFINE_TICK,self.refine)
 
-    def grab_frame(self):
+
+    def scan_timeline(self,video_fnames):
+        """
+        Computes (or loads, see timeline.py) the features of each video; runs on its own thread
+        """
+        for C in range(self.ncams):
+            try:
+                if video_fnames[C] is not None:
+                    self.timeline_features[C] = load_features(video_fnames[C])
+            except (OSError, ValueError, cv2.error) as e:
+                print(f"WARNING: could not compute the timeline of camera {C+1}: {e}")
+            finally:
+                self.timeline_done[C] = True
+
+
+    def check_timeline(self):
+        """
+        Draws the timeline of the cameras whose scan has finished
+        """
+        pending = False
+        strip_height = TIMELINE_ROW*len(FEATURES)
         for C in range(self.ncams):
-            #self.cap[C].set(cv2.CAP_PROP_POS_FRAMES, self.frame_idx) # NO FUNCIONA BIEN
-            self.cap[C].set(cv2.CAP_PROP_POS_AVI_RATIO,self.frame_idx/self.nframes)
-            ret, self.cv2_frame[C] = cap[C].read()
-            self.color_frame[C] = np.flip(np.array(self.cv2_frame[C]),axis=2)
-            height,width,nchannels = self.color_frame[C].shape
-            if self.rot[C]:
-                self.color_frame[C] = 255*trans.rotate(self.color_frame[C],-self.rot[C],resize=True) # rotation scales colors to 0-1!!
-            self.gray_frame[C] = \
-                0.25*self.color_frame[C][:,:,0] + \
-                0.5*self.color_frame[C][:,:,1] + \
-                0.25*self.color_frame[C][:,:,2]
+            if self.timeline_photo[C] is not None:
+                continue
+            if not self.timeline_done[C]:
+                pending = True
+                continue
+            if self.timeline_features[C] is None:
+                continue # no timeline for this camera
+            strip = render_strip(self.timeline_features[C],self.timeline_width,TIMELINE_ROW,int(self.nframes))
+            self.timeline_photo[C] = ImageTk.PhotoImage(Image.fromarray(strip))
+            self.timeline.create_image(0,C*strip_height,anchor=tk.NW,image=self.timeline_photo[C])
+            self.timeline.tag_raise(self.timeline_cursor)
+        if pending:
+            self.root.after(TIMELINE_TICK,self.check_timeline)
+
+
+    def timeline_click(self,event):
+        frame = int(event.x*self.nframes/self.timeline_width)
+        frame = max(0,min(int(self.nframes)-1,frame))
+        strip_height = TIMELINE_ROW*len(FEATURES)
+        C = min(self.ncams-1,event.y//strip_height)
+        features = self.timeline_features[C]
+        if features is not None:
+            name = FEATURES[min(len(FEATURES)-1,(event.y % strip_height)//TIMELINE_ROW)]
+            segment = segment_at(features,name,frame)
+            if segment is not None:
+                print(f"{name} segment of camera {C+1}: frames {segment[0]} to {segment[1]}")
+                frame = segment[0]
+        self.frame_idx = frame
+        self.grab_frame()
+        self.update()
 
 
     def save(self):
@@ -302,9 +423,9 @@ class VidUI():
 
     def next_frame(self):
         delta = min(self.nframes-self.frame_idx-1,self.speed)
-        self.frame_idx += self.speed
+        self.frame_idx += delta
         #self.slider.set(self.frame_idx/self.nframes)
-        self.grab_frame()
+        self.grab_frame(self.speed)
         self.update()
 
 
@@ -312,7 +433,7 @@ class VidUI():
         delta = min(self.speed,self.frame_idx)
         self.frame_idx -= delta
         #self.slider.set(self.frame_idx/self.nframes)
-        self.grab_frame()
+        self.grab_frame(-self.speed)
         self.update()
 
     def faster(self):
@@ -332,45 +453,95 @@ class VidUI():
         #self.canvas.after(self.dtick,self.update)
 
 
-    def paint(self):
+    def _create_items(self):
+        """
+        Creates the canvas items once; paint() only updates them
+        """
         huge_font = ("Arial",24)
         large_font = ("Arial",20)
         normal_font = ("Arial",18)
-        #self.canvas.create_rectangle(0,0,self.canvas.winfo_width,self.canvas.winfo_height)
-        self.canvas.delete("all")
+        self.items = [None,None]
+        self.item_state = dict()
+        self.shown_frame = [None,None]
+        W = self.scaled_frame_width+self.margin//3
         for C in range(self.ncams):
             yoff = 20
-            self.npimg = trans.rescale(self.color_frame[C],self.scale,channel_axis=2,order=0,anti_aliasing=False).astype(np.uint8)            
-            W = self.scaled_frame_width+self.margin//3
-            pilimage = Image.fromarray(self.npimg)
-            self.tk_image[C] = ImageTk.PhotoImage(pilimage)
-            self.canvas.create_image(self.margin//3 + C*W,0,anchor=tk.NW,image=self.tk_image[C])
-            self.canvas.create_text(self.margin//3 + 20+C*W,yoff,font=huge_font, text=f"Frame {self.frame_idx}",anchor=tk.NW, fill="#fff")
+            items = dict()
+            items["image"] = self.canvas.create_image(self.margin//3 + C*W,0,anchor=tk.NW)
+            items["frame"] = self.canvas.create_text(self.margin//3 + 20+C*W,yoff,font=huge_font,anchor=tk.NW,fill="#fff")
+            yoff += LINE_SPACING
+            items["cam"] = self.canvas.create_text(20+C*W,yoff,anchor=tk.NW,fill="#ff8",text=f"Cam {C}",font=large_font)
+            items["box"] = self.canvas.create_rectangle(0,0,0,0,fill=None)
+            yoff += LINE_SPACING
+            items["calib"] = self.canvas.create_text(20+C*W,yoff,font=normal_font,anchor=tk.NW)
             yoff += LINE_SPACING
-            self.canvas.create_text(20+C*W,yoff,anchor=tk.NW,fill="#ff8",text=f"Cam {C}",font=large_font)
+            items["white"] = self.canvas.create_text(20+C*W,yoff,font=normal_font,anchor=tk.NW)
+            yoff += LINE_SPACING
+            items["sync"] = self.canvas.create_text(20+C*W,yoff,font=huge_font,anchor=tk.NW,text="SYNC",fill="#8ff")
+            self.items[C] = items
+
+
+    def _config(self,item,**kw):
+        # reconfigure a canvas item only if something changed
+        if self.item_state.get(item) != kw:
+            self.item_state[item] = kw
+            self.canvas.itemconfigure(item,**kw)
+
+
+    def _coords(self,item,*coords):
+        if self.item_state.get((item,"coords")) != coords:
+            self.item_state[(item,"coords")] = coords
+            self.canvas.coords(item,*coords)
+
+
+    def _show_frame(self,C):
+        """
+        Puts the current frame of camera C on the canvas, pasting it into the existing
+        photo image (no new image or canvas item per frame)
+        """
+        frame = self.color_frame[C] # already scaled
+        if frame is None or frame is self.shown_frame[C]:
+            return
+        pilimage = Image.fromarray(frame)
+        if self.tk_image[C] is None or (self.tk_image[C].width(),self.tk_image[C].height()) != pilimage.size:
+            self.tk_image[C] = ImageTk.PhotoImage(pilimage)
+            self.canvas.itemconfigure(self.items[C]["image"],image=self.tk_image[C])
+        else:
+            self.tk_image[C].paste(pilimage)
+        self.shown_frame[C] = frame
+
+
+    def paint(self):
+        if self.items is None:
+            self._create_items()
+        W = self.scaled_frame_width+self.margin//3
+        for C in range(self.ncams):
+            items = self.items[C]
+            self._show_frame(C)
+            self._config(items["frame"],text=f"Frame {self.frame_idx}")
             if self.x1 != self.x2 or self.y1 != self.y2:
                 j0 = min(self.x1,self.x2)
                 j1 = max(self.x1,self.x2)
                 i0 = min(self.y1,self.y2)
                 i1 = max(self.y1,self.y2)
-                self.canvas.create_rectangle(self.margin//3 + C*W+j0,i0,C*W+j1,i1,fill=None,outline="#4e4",width=1)
+                self._config(items["box"],outline="#4e4",width=1)
             else:
                 i0,i1,j0,j1 = self.scaled_cropbox
-                self.canvas.create_rectangle(self.margin//3 + C*W+j0,i0,C*W+j1,i1,fill=None,outline="#0f0",width=2)
-            yoff += LINE_SPACING
-            if self.annotations["ini_calib_frame"] == self.frame_idx:
-                self.canvas.create_text(20+C*W,yoff,text="INI CALIB",font=normal_font, anchor=tk.NW,fill="#8f0")
-            if self.annotations["fin_calib_frame"] == self.frame_idx:
-                self.canvas.create_text(20+C*W,yoff,text="END CALIB",font=normal_font, anchor=tk.NW,fill="#f80")
-            yoff += LINE_SPACING
-            if self.annotations["ini_white_frame"] == self.frame_idx:
-                self.canvas.create_text(20+C*W,yoff,text="INI WHITE",font=normal_font, anchor=tk.NW,fill="#8f0")
-            if self.annotations["fin_white_frame"] == self.frame_idx:
-                self.canvas.create_text(20+C*W,yoff,text="END WHITE",font=normal_font, anchor=tk.NW,fill="#f80")
-            yoff += LINE_SPACING
-
-            if self.annotations[f"sync_{C+1}_frame"] == self.frame_idx:
-                self.canvas.create_text(20+C*W,yoff,font=huge_font, anchor=tk.NW, text="SYNC",fill="#8ff")
+                self._config(items["box"],outline="#0f0",width=2)
+            self._coords(items["box"],self.margin//3 + C*W+j0,i0,C*W+j1,i1)
+            for key,ini,fin in (("calib","INI CALIB","END CALIB"),("white","INI WHITE","END WHITE")):
+                if self.annotations[f"fin_{key}_frame"] == self.frame_idx:
+                    self._config(items[key],text=fin,fill="#f80",state=tk.NORMAL)
+                elif self.annotations[f"ini_{key}_frame"] == self.frame_idx:
+                    self._config(items[key],text=ini,fill="#8f0",state=tk.NORMAL)
+                else:
+                    self._config(items[key],state=tk.HIDDEN)
+            sync = self.annotations[f"sync_{C+1}_frame"] == self.frame_idx
+            self._config(items["sync"],state=tk.NORMAL if sync else tk.HIDDEN)
+        x = int(self.frame_idx*self.timeline_width/max(1,self.nframes))
+        if x != self.timeline_cursor_x:
+            self.timeline_cursor_x = x
+            self.timeline.coords(self.timeline_cursor,x,0,x,TIMELINE_ROW*len(FEATURES)*self.ncams)
 
 
 if __name__ == "__main__":
@@ -400,6 +571,8 @@ if __name__ == "__main__":
     toma_a_path = os.path.join(adq_path,f"{camera_a}.mp4")
     print(f"Ruta a toma de cámara {camera_a}: {toma_a_path}")
     cap[0] = cv2.VideoCapture(toma_a_path)
+    args["video_fnames"] = [toma_a_path,None]
+    args["proxies"] = [load_proxy(toma_a_path),None]
     if cap[0] is None or not cap[0].isOpened():
         print(f"Error al abrir archivo de video {toma_a_path}")
         exit(1)
@@ -409,19 +582,40 @@ if __name__ == "__main__":
         toma_b_path = os.path.join(adq_path,f"{camera_b}.mp4")
         print(f"Ruta a toma de cámara {camera_b}: {toma_b_path}")
         cap[1] = cv2.VideoCapture(toma_b_path)
+        args["video_fnames"][1] = toma_b_path
+        args["proxies"][1] = load_proxy(toma_b_path)
         if cap[1] is None or not cap[1].isOpened():
             print(f"Error al abrir archivo de video {toma_b_path}")
             exit(1)
-    if args["rotation1"] is None:
-        args["rotation1"] = guess_orientation(cap[0])
-        print("Orientation of camera 1 was guessed as ",args["rotation1"])
-        cap[0].set(cv2.CAP_PROP_POS_AVI_RATIO, 0.0)
-
-    if cap[1] is not None and args["rotation2"] is None:
-        args["rotation2"] = guess_orientation(cap[1])
-        print("Orientation of camera 2 was guessed as ",args["rotation2"])
-        cap[1].set(cv2.CAP_PROP_POS_AVI_RATIO, 0.0) 
-    
+    #
+    # the orientation is guessed only once: it is kept in the annotations file, where all
+    # the other tools read it from
+    #
+    json_fname = os.path.join(adq_path,generate_annotations_filename(camera_a,camera_b))
+    annotations = None
+    if os.path.exists(json_fname):
+        with open(json_fname,"r") as f:
+            annotations = json.loads(f.read())
+    guessed = False
+    for C in range(2):
+        if cap[C] is None or args[f"rotation{C+1}"] is not None:
+            continue
+        if annotations is not None and annotations.get(f"rot{C+1}") is not None:
+            args[f"rotation{C+1}"] = annotations[f"rot{C+1}"]
+            print(f"Orientation of camera {C+1} is {args[f'rotation{C+1}']} (from {json_fname})")
+            continue
+        t0 = time.time()
+        args[f"rotation{C+1}"], args[f"rotation{C+1}_confidence"] = guess_orientation(cap[C],proxy=args["proxies"][C])
+        print(f"Orientation of camera {C+1} was guessed as {args[f'rotation{C+1}']} "
+              f"(confidence {args[f'rotation{C+1}_confidence']:.2f}, {time.time()-t0:.2f}s)")
+        if annotations is not None:
+            annotations[f"rot{C+1}"] = args[f"rotation{C+1}"]
+            annotations[f"rot{C+1}_confidence"] = args[f"rotation{C+1}_confidence"]
+            guessed = True
+    if guessed:
+        with open(json_fname,"w") as f:
+            f.write(json.dumps(annotations,indent=4))
+
     gui  = VidUI(cap[0],cap[1],args)
     
     if cap[0]:
@@ -14,6 +14,54 @@ import numpy as np
 import skimage
 from skimage import io as imgio
 
+from illumination import make_gain_map, apply_gain, get_gain_map
+from framestore import open_frames
+from vutils import fast_rot
+
+
+def legacy_gain_map(calibration, calibration_frame, rotate, scale, shape):
+    """
+    Gain map from a white frame image, for calibrations without white_frame_parameters
+    """
+    if calibration_frame is None or not os.path.exists(calibration_frame):
+        print(f"Calibration image file {calibration_frame} not found.")
+        sys.exit(1)
+    white_frame = skimage.img_as_float(imgio.imread(calibration_frame))
+    white_balance = calibration["white_balance"]
+
+    #
+    # same convention as fast_rot and get_gain_map (90 is clockwise). Up to now this
+    # turned the other way (np.rot90), so -r 90 and -r 270 swap with respect to earlier runs
+    #
+    if rotate % 90:
+        print(f"Only rotations multiple of 90 are supported (got {rotate}).")
+        sys.exit(1)
+    white_frame = np.squeeze(fast_rot(white_frame[:,:,np.newaxis],rotate % 360))
+
+    #
+    # adjust white frame size to input frame if necessary
+    #
+    wh, ww = white_frame.shape[:2]
+    ih, iw = shape
+    if wh != ih and ww != iw:
+        wratio = ww/wh
+        iratio = iw/ih
+        if wratio != iratio:
+            print(f"Input frames have different aspect ratio ({iratio}) than calibration frame ({wratio}).")
+            sys.exit(1)
+        else:
+            if scale > 1:
+                white_frame = skimage.transform.rescale(white_frame,1/scale)
+            wh, ww = white_frame.shape[:2]
+            if wh != ih and ww != iw:
+                print(f"Wrong scaling factor: input frames have different shape ({ih}x{iw}) than calibration frame ({wh}x{ww}).")
+                print(f"Wrong scaling factor.")
+                sys.exit(1)
+    #
+    # fixed point gain map: inverse white frame times white balance factor
+    #
+    return make_gain_map(white_frame,white_balance)
+
 
 if __name__ == "__main__":
 
@@ -21,8 +69,8 @@ if __name__ == "__main__":
     ap.add_argument("-j","--calib_json", required=True, help="JSON file with calibration data.")
     ap.add_argument("-r","--rotate",type=int,  default=0, help="Rotate white frame if necessary.")
     ap.add_argument("-s","--scale",type=int,  default=1, help="Scale down by this integer factor, if necessary.")
-    ap.add_argument("-w","--calib_frame", required=True, help="Calibration white frame")
-    ap.add_argument("-i","--input", required=True, help="image, image list or folder.")
+    ap.add_argument("-w","--calib_frame", default=None, help="Calibration white frame (only for calibrations without white_frame_parameters)")
+    ap.add_argument("-i","--input", required=True, help="frame store, image, image list or folder.")
     ap.add_argument("-o","--output_prefix",required=True,help="output prefix. May produce one or more images depending on input.")
 
     args = ap.parse_args()
@@ -36,87 +84,40 @@ if __name__ == "__main__":
         calibration = json.loads(fc.read())
 
 
-    if not os.path.exists(calibration_frame):
-        print(f"Calibration image file {calibration_frame} not found.")
-        sys.exit(1)
-    white_frame = skimage.img_as_float(imgio.imread(calibration_frame))
-
     if not os.path.exists(args.input):
         print("Input file not found.")
         sys.exit(1)
     
     #
-    # detect type of input
+    # input may be a frame store, an image, a folder or a list
     #
-    input_files = list()
-    if os.path.isdir(args.input):
-        input_files = [os.path.join(args.input,f) for f in os.listdir(args.input) if f.endswith(".jpg") or f.endswith(".png")]
-    else:
-        _,ext = os.path.splitext(args.input)
-        extl = ext.lower()
-        if extl == '.list':
-            with open(args.input,'r') as fl:
-                input_files = [l.strip() for l in fl.readlines()]
-        elif extl == '.jpg' or extl == '.png':
-            input_files = [args.input]
+    input_files, read_frame = open_frames(args.input)
     print('Images to process:',len(input_files))
 
-    #
-    # prepare calibration for max speed
-    #     
-    white_balance = calibration["white_balance"]
-    white_balance['red'] /= 255
-    white_balance['green'] /= 255
-    white_balance['blue'] /= 255
-
-    inv_white_frame = 1/np.maximum(white_frame,1e-3)
-    if args.rotate == 90:
-        inv_white_frame = np.rot90(inv_white_frame)
-    elif args.rotate == 180:
-        inv_white_frame = np.fliplr(np.flipud(inv_white_frame))
-    elif args.rotate == 270:
-        inv_white_frame = np.rot90(inv_white_frame)
-        inv_white_frame = np.fliplr(np.flipud(inv_white_frame))
-
-    #
-    # adjust white frame size to input frame if necessary
-    #
     if len(input_files) == 0:
         print("No input files.")
         sys.exit(1)
-    
-    first_frame = skimage.img_as_float(imgio.imread(input_files[0]))
-    wh, ww = inv_white_frame.shape[:2]
+    first_frame = read_frame(0)
     ih, iw = first_frame.shape[:2]
-    if wh != ih and ww != iw:
-        wratio = ww/wh
-        iratio = iw/ih
-        if wratio != iratio:
-            print(f"Input frames have different aspect ratio ({iratio}) than calibration frame ({wratio}).")
-            sys.exit(1)
-        else:
-            if args.scale > 1:
-                inv_white_frame = skimage.transform.rescale(inv_white_frame,1/args.scale)
-            wh, ww = inv_white_frame.shape[:2]
-            if wh != ih and ww != iw:
-                print(f"Wrong scaling factor: input frames have different shape ({ih}x{iw}) than calibration frame ({wh}x{ww}).")
-                print(f"Wrong scaling factor.")
-                sys.exit(1)
-
-    norm_frame = np.empty((*inv_white_frame.shape,3))
-    norm_frame[:,:,0] = inv_white_frame*(1/white_balance["red"])
-    norm_frame[:,:,1] = inv_white_frame*(1/white_balance["green"])
-    norm_frame[:,:,2] = inv_white_frame*(1/white_balance["blue"])
+    if "white_frame_parameters" in calibration:
+        #
+        # gain map generated (and cached) from the illumination model for this shape and rotation
+        #
+        h, w = (ih, iw) if args.rotate % 180 == 0 else (iw, ih)
+        norm_frame = get_gain_map(calibration,(h,w),args.rotate)
+    else:
+        norm_frame = legacy_gain_map(calibration,calibration_frame,args.rotate,args.scale,(ih,iw))
+    output_frame = np.empty(norm_frame.shape,dtype=np.uint8)
 
     output_dir = os.path.dirname(args.output_prefix)
     if output_dir != '' and output_dir != '.' and not os.path.exists(output_dir):
         output_dir = '.'
         os.makedirs(output_dir)
     for i,input_file in enumerate(input_files):
-        input_frame = skimage.img_as_float(imgio.imread(input_file))
-        output_frame = np.maximum(0,np.minimum(1,input_frame * norm_frame))
+        input_frame = read_frame(i)
+        apply_gain(input_frame,norm_frame,out=output_frame)
         output_file = os.path.join(args.output_prefix,os.path.basename(input_file))
         print(f'{i+1}/{len(input_files)}: {input_file} -> {output_file}')
-        imgio.imsave(output_file,skimage.img_as_ubyte(output_frame))
+        imgio.imsave(output_file,output_frame)
 
 
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Automatic estimation of the synchronization offset between the two cameras of a pair.
+
+Instead of looking for the same event (a clap, a stopwatch) in both videos by hand, we
+reduce each video to a compact signal with one value per frame: the mean luma of a small
+version of the frame and, if ffmpeg is available, the envelope (RMS) of the audio during
+that frame. Both cameras see (and hear) the same scene, so their signals are shifted
+copies of each other, and the shift is found by cross-correlating them (with FFTs) and
+refining the peak to a fraction of a frame with a parabola.
+
+Signals are cached next to each video (<video>.sync.npz), so once computed the offset of
+any pair of cameras is obtained in milliseconds.
+
+The offset is written to the annotations file as auto_offset (with its confidence);
+compute_offsets() uses it when the sync frames were not annotated by hand.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import numpy as np
+import cv2
+
+from vutils import generate_annotations_filename
+from ffsource import open_video, ffmpeg_available, BACKENDS, FFMPEG
+
+SYNC_SUFFIX = ".sync.npz"
+SYNC_VERSION = 1
+RESCALE_FACTOR = 8      # luma is computed on frames this many times smaller
+AUDIO_RATE = 8000       # audio is resampled to this rate (Hz) before computing the envelope
+MAX_OFFSET = 60         # seconds
+MIN_OVERLAP = 0.5       # fraction of the shortest signal that must overlap at any offset
+
+
+def sync_filename(video_fname):
+    return video_fname + SYNC_SUFFIX
+
+
+def luma_trace(video_fname, backend="opencv", rescale_factor=RESCALE_FACTOR):
+    """
+    Mean luma of each frame of the video
+    """
+    cap, transformed = open_video(video_fname, backend, rescale_factor, 0, pix_fmt="gray")
+    trace = list()
+    try:
+        while cap.isOpened():
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if transformed:
+                trace.append(frame.mean())
+            else:
+                b, g, r, _ = cv2.mean(frame)
+                trace.append(0.114*b + 0.587*g + 0.299*r)
+            if not len(trace) % 1000:
+                print(f"\t{video_fname}: {len(trace)} frames")
+    finally:
+        cap.release()
+    return np.array(trace, dtype=np.float32)
+
+
+def audio_trace(video_fname, fps, nframes):
+    """
+    RMS of the audio during each frame of the video, or None if the video has no audio
+    or ffmpeg is not available
+    """
+    if not ffmpeg_available():
+        return None
+    cmd = [FFMPEG, "-v", "error", "-i", video_fname, "-vn", "-ac", "1", "-ar", str(AUDIO_RATE),
+           "-f", "s16le", "-"]
+    try:
+        samples = np.frombuffer(subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout, dtype=np.int16)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if not len(samples):
+        return None
+    # sample where each frame starts
+    bounds = np.minimum(np.round(np.arange(nframes+1)*AUDIO_RATE/fps).astype(np.int64), len(samples))
+    energy = np.concatenate(([0], np.cumsum(samples.astype(np.float64)**2)))
+    counts = np.maximum(np.diff(bounds), 1)
+    return np.sqrt((energy[bounds[1:]] - energy[bounds[:-1]])/counts).astype(np.float32)
+
+
+def load_traces(video_fname, backend="opencv", rescale_factor=RESCALE_FACTOR, rebuild=False):
+    """
+    Returns (fps, luma trace, audio trace or None) of a video, computing them and caching
+    them next to the video if needed
+    """
+    cache_fname = sync_filename(video_fname)
+    if not rebuild and os.path.exists(cache_fname):
+        with np.load(cache_fname) as data:
+            cached = {k: data[k] for k in data.files}
+        if int(cached["version"]) == SYNC_VERSION and \
+           int(cached["rescale_factor"]) == rescale_factor and \
+           int(cached["file_size"]) == os.path.getsize(video_fname) and \
+           float(cached["file_mtime"]) == os.path.getmtime(video_fname):
+            audio = cached["audio"] if len(cached["audio"]) else None
+            return float(cached["fps"]), cached["luma"], audio
+    print("computing sync signals for", video_fname)
+    probe = cv2.VideoCapture(video_fname)
+    fps = probe.get(cv2.CAP_PROP_FPS)
+    probe.release()
+    luma = luma_trace(video_fname, backend, rescale_factor)
+    audio = audio_trace(video_fname, fps, len(luma))
+    try:
+        tmp_fname = f"{cache_fname}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_fname, version=SYNC_VERSION, rescale_factor=rescale_factor, fps=fps,
+                 file_size=os.path.getsize(video_fname), file_mtime=os.path.getmtime(video_fname),
+                 luma=luma, audio=audio if audio is not None else np.zeros(0, dtype=np.float32))
+        os.replace(tmp_fname, cache_fname)
+    except OSError as e:
+        print("WARNING: could not cache sync signals:", e)
+    return fps, luma, audio
+
+
+def _normalize(trace):
+    # changes rather than levels: the exposure and gain of both cameras differ
+    d = np.diff(trace.astype(np.float64))
+    d -= d.mean()
+    std = d.std()
+    return d/std if std > 0 else d
+
+
+def cross_correlation(a, b):
+    """
+    Cross correlation c[k] = sum(a[t]*b[t+k])/min(len(a),len(b)) for k in -(len(a)-1) .. len(b)-1,
+    computed with FFTs. Dividing by the largest possible overlap (instead of the overlap at
+    each lag) favours lags where the signals overlap more, so that periodic scenes do not
+    give spurious peaks at large offsets.
+    Returns (lags, c, number of overlapping samples at each lag).
+    """
+    n = len(a) + len(b) - 1
+    nfft = 1 << int(np.ceil(np.log2(n)))
+    fa = np.fft.rfft(a, nfft)
+    fb = np.fft.rfft(b, nfft)
+    c = np.fft.irfft(np.conj(fa)*fb, nfft)
+    c = np.concatenate((c[nfft-(len(a)-1):], c[:len(b)]))
+    lags = np.arange(-(len(a)-1), len(b))
+    # number of overlapping samples at each lag
+    overlap = np.minimum(len(a), len(b) - lags) - np.maximum(0, -lags)
+    return lags, c/min(len(a), len(b)), overlap
+
+
+def estimate_offset(traces_1, traces_2, max_offset=None):
+    """
+    Offset (in frames, with sub frame precision) such that frame f of camera 1 corresponds
+    to frame f + offset of camera 2, from lists of signals of both cameras (luma, audio, ...;
+    None entries are ignored). Returns (offset, confidence): confidence is the correlation
+    at the peak (about 1 for a clean match, near 0 if there is no clear match).
+    """
+    total = None
+    count = 0
+    for a, b in zip(traces_1, traces_2):
+        if a is None or b is None or len(a) < 3 or len(b) < 3:
+            continue
+        lags_ab, c, overlap_ab = cross_correlation(_normalize(a), _normalize(b))
+        if total is None:
+            total, lags, overlap = c, lags_ab, overlap_ab
+        elif len(c) == len(total):
+            total = total + c
+        else:
+            continue # signals of different length (should not happen)
+        count += 1
+    if total is None:
+        raise ValueError("no usable signals to synchronize")
+    total /= count
+    valid = overlap >= MIN_OVERLAP*overlap.max()
+    if max_offset is not None:
+        valid &= np.abs(lags) <= max_offset
+    if not np.any(valid):
+        raise ValueError("no valid offsets: signals too short or max offset too small")
+    score = np.where(valid, total, -np.inf)
+    k = int(np.argmax(score))
+    offset = float(lags[k])
+    if 0 < k < len(total) - 1 and valid[k-1] and valid[k+1]:
+        # parabola through the peak and its neighbours
+        den = total[k-1] - 2*total[k] + total[k+1]
+        if den < 0:
+            offset += 0.5*(total[k-1] - total[k+1])/den
+    return offset, float(total[k])
+
+
+def sync_pair(video_1, video_2, backend="opencv", rescale_factor=RESCALE_FACTOR, max_offset=MAX_OFFSET, rebuild=False):
+    """
+    Offset (frames) and confidence of video_2 relative to video_1 (see estimate_offset);
+    max_offset is given in seconds
+    """
+    fps_1, luma_1, audio_1 = load_traces(video_1, backend, rescale_factor, rebuild)
+    fps_2, luma_2, audio_2 = load_traces(video_2, backend, rescale_factor, rebuild)
+    if abs(fps_1 - fps_2) > 0.01:
+        print(f"WARNING: frame rates differ ({fps_1} and {fps_2}); the offset will be approximate")
+    return estimate_offset([luma_1, audio_1], [luma_2, audio_2], max_offset*fps_1 if max_offset else None)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-D","--datadir",type=str,required=True,help="directorio donde se encuentran todos los datos.")
+    ap.add_argument("-A","--adqdir", type=str, required=True,
+                    help="nombre de directorio de la instancia de adquisicion, por ej: 2024-01-03-vino_fino SIN terminadores (barras).")
+    ap.add_argument("-a","--camera-a", type=str, required=True,
+                    help="primera cámara")
+    ap.add_argument("-b","--camera-b", type=str, required=True,
+                    help="segunda cámara")
+    ap.add_argument("-t","--take", type=int, default=1,
+                    help="número de toma")
+    ap.add_argument("-p","--part", type=int, default=1,
+                    help="número de parte")
+    ap.add_argument('-r',"--rescale-factor", type=int, default=RESCALE_FACTOR,
+                    help=f"Compute the luma on frames reduced this many times (defaults to {RESCALE_FACTOR}).")
+    ap.add_argument('-m',"--max-offset", type=float, default=MAX_OFFSET,
+                    help=f"Largest offset considered, in seconds (defaults to {MAX_OFFSET}).")
+    ap.add_argument('-k','--backend', type=str, default="ffmpeg" if ffmpeg_available() else "opencv", choices=BACKENDS,
+                    help="Video decoding backend (ffmpeg, if available, decodes directly at low resolution).")
+    ap.add_argument('--rebuild', action="store_true",
+                    help="Recompute the cached signals.")
+    ap.add_argument('-n','--dry-run', action="store_true",
+                    help="Only print the offset, do not write it to the annotations file.")
+    args = vars(ap.parse_args())
+
+    input_dir = os.path.join(args["datadir"],args["adqdir"])
+    videos = [os.path.join(input_dir,f'{cam}/{cam}_toma{args["take"]}_parte{args["part"]}.mp4')
+              for cam in (args["camera_a"],args["camera_b"])]
+    for fname in videos:
+        if not os.path.exists(fname):
+            print(f"ERROR: no se encuentra video {fname}.")
+            exit(1)
+    offset, confidence = sync_pair(videos[0],videos[1],args["backend"],args["rescale_factor"],
+                                   args["max_offset"],args["rebuild"])
+    print(f"offset of {args['camera_b']} relative to {args['camera_a']}: {offset:.2f} frames (confidence {confidence:.2f})")
+    if args["dry_run"]:
+        exit(0)
+    annotations_fname = os.path.join(input_dir,generate_annotations_filename(args["camera_a"],args["camera_b"]))
+    if not os.path.exists(annotations_fname):
+        print(f"ERROR: annotations file {annotations_fname} not found.")
+        exit(1)
+    with open(annotations_fname,"r") as fa:
+        annotations = json.loads(fa.read())
+    annotations["auto_offset"] = offset
+    annotations["auto_offset_confidence"] = confidence
+    with open(annotations_fname,"w") as fa:
+        fa.write(json.dumps(annotations,indent=4))
+    print("offset written to",annotations_fname)
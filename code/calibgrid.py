@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Coarse-to-fine calibration pattern detection, run on a process pool.
+
+cv2.findCirclesGrid is slow on large images and it fails on most frames of a calibration
+session anyway (pattern out of view, blurred, too oblique). So we first look for the
+pattern on a heavily downscaled copy of the frame (detect_scale times smaller) and only
+when it is found there we detect it again, at full resolution, on a small region around
+it, to get accurate centers.
+
+detect_stream() takes frames from the decoding loop, converts them to gray and runs the
+detection on a process pool, with a bounded number of frames in flight, returning the
+results in order.
+"""
+
+import collections
+import concurrent.futures
+import os
+import numpy as np
+import cv2
+
+from vmap import init_worker
+
+DETECT_SCALE = 2    # detection is done on frames this many times smaller than the refinement
+ROI_MARGIN = 1.0    # margin around the coarse pattern, in units of the pattern spacing
+
+
+def normalize_gray(frame):
+    """
+    Green channel of an RGB frame (or a gray frame), stretched to 0-255
+    """
+    gray = frame[:, :, 1] if frame.ndim == 3 else frame
+    lo, hi = int(gray.min()), int(gray.max())
+    if hi <= lo:
+        return np.zeros(gray.shape, dtype=np.uint8)
+    lut = np.clip((np.arange(256) - lo)*(255/(hi-lo)), 0, 255).astype(np.uint8)
+    return lut[gray]
+
+
+def _find(gray, pattern_size, pattern):
+    if pattern == "chessboard":
+        found, centers = cv2.findChessboardCorners(gray, pattern_size)
+    else:
+        found, centers = cv2.findCirclesGrid(gray, pattern_size, flags=cv2.CALIB_CB_ASYMMETRIC_GRID)
+    return centers if found else None
+
+
+def find_grid(gray, pattern_size, pattern="circles", detect_scale=DETECT_SCALE):
+    """
+    Finds the calibration pattern on a uint8 gray image: first on a copy reduced
+    detect_scale times, then on a region of gray around it.
+    Returns the (n x 1 x 2, float32) centers in gray coordinates, or None. Views that are
+    only found on the reduced copy are dropped: their centers are too coarse to calibrate.
+    """
+    h, w = gray.shape[:2]
+    if detect_scale > 1:
+        small = cv2.resize(gray, (w//detect_scale, h//detect_scale), interpolation=cv2.INTER_AREA)
+        coarse = _find(small, pattern_size, pattern)
+        if coarse is None:
+            return None
+        # pixel centers of small map to (x+0.5)*s-0.5 in gray
+        sx, sy = w/small.shape[1], h/small.shape[0]
+        coarse = (coarse + 0.5)*[sx, sy] - 0.5
+    else:
+        return _find(gray, pattern_size, pattern)
+    #
+    # refine at full resolution on the region of the pattern
+    #
+    pts = coarse.reshape(-1, 2)
+    spacing = np.median(np.linalg.norm(np.diff(pts, axis=0), axis=1))
+    margin = ROI_MARGIN*spacing
+    x0 = int(max(0, pts[:, 0].min() - margin))
+    y0 = int(max(0, pts[:, 1].min() - margin))
+    x1 = int(min(w, pts[:, 0].max() + margin + 1))
+    y1 = int(min(h, pts[:, 1].max() + margin + 1))
+    fine = _find(np.ascontiguousarray(gray[y0:y1, x0:x1]), pattern_size, pattern)
+    if fine is None:
+        return None
+    if pattern == "chessboard":
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 1e-3)
+        fine = cv2.cornerSubPix(gray[y0:y1, x0:x1], fine, (5, 5), (-1, -1), criteria)
+    return (fine + [x0, y0]).astype(np.float32)
+
+
+def make_pool(nworkers=None):
+    """
+    Process pool for detect_stream (one process per core by default)
+    """
+    if nworkers is None:
+        nworkers = os.cpu_count() or 1
+    return concurrent.futures.ProcessPoolExecutor(max_workers=nworkers, initializer=init_worker)
+
+
+def detect_stream(frames, pool, pattern_size, pattern="circles", detect_scale=DETECT_SCALE, max_pending=None):
+    """
+    frames yields (frame_index, frame) pairs (RGB or gray uint8 frames).
+    Yields (frame_index, gray, centers) in the same order, where gray is the normalized
+    gray frame and centers is None if the pattern was not found.
+    The detection runs on pool; at most max_pending frames are in flight.
+    """
+    if max_pending is None:
+        max_pending = 2*(os.cpu_count() or 1)
+    pending = collections.deque()
+    for frame_index, frame in frames:
+        while len(pending) >= max_pending:
+            index, gray, future = pending.popleft()
+            yield index, gray, future.result()
+        gray = normalize_gray(frame)
+        pending.append((frame_index, gray, pool.submit(find_grid, gray, pattern_size, pattern, detect_scale)))
+    while len(pending):
+        index, gray, future = pending.popleft()
+        yield index, gray, future.result()
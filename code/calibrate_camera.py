@@ -5,23 +5,67 @@ import os
 import argparse 
 import json
 import skimage.io as imgio
+import time
+import concurrent.futures
 
 from vutils import *
+from ffsource import open_video, BACKENDS
+from imgwriter import ImageWriter
+from calibgrid import detect_stream, make_pool, DETECT_SCALE
+from viewselect import view_sharpness, select_views, incremental_calibration, MAX_VIEWS
+from cornercache import CornerCache, CACHE_FNAME, video_fingerprint, frame_key
+from undistort import INTRINSICS_FNAME
+
+def _camera_frames(input_fname, backend, res_fac, rot, start_frame, nframes):
+    """
+    Decodes nframes frames from start_frame, reduced by res_fac, rotated and in RGB.
+    Yields (number of frame relative to start_frame, frame).
+    """
+    # with the ffmpeg backend frames come already reduced, rotated and in RGB
+    cap, transformed = open_video(input_fname,backend,res_fac,rot,pix_fmt="rgb24",start_frame=start_frame)
+    try:
+        n = 0
+        while cap.isOpened() and n < nframes: # ----- loop over frames
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if not transformed:
+                h,w,_ = frame.shape
+                frame = cv2.resize(frame,(w//res_fac,h//res_fac))
+                frame = np.flip(frame,axis=2)
+                frame = fast_rot(frame,rot)
+            yield n, frame
+            n += 1
+    finally:
+        cap.release()
+
 
 def gather_calibration_data(annotations,args):
-    input_fname = [None,None]
+    """
+    Detects the calibration pattern on the calibration frames of each camera.
+    Frames are decoded at rescale_factor; the pattern is looked for at detect_scale times
+    less resolution and refined at rescale_factor (see calibgrid.py), on a process pool
+    shared by both cameras, which are decoded concurrently. Detections are kept in a
+    CornerCache: frames already cached are neither decoded nor detected again.
+    Returns, for each camera, the frame size (w,h) and the lists of object points, image
+    points, frame numbers and sharpness of the frames where the pattern was found.
+    """
     camera = [None,None]
-    fps = [None,None]
-    cap = [None,None]
     input_fname = [None,None]
     obj_points = [None,None]
     img_points =[None,None]
+    frames = [None,None]
+    sharpness = [None,None]
+    frame_size = [None,None]
 
     M = args["nrows"]
     N = args["ncols"]
-    window_size = 11 # for finding cheessboard points
     objp = np.zeros((M*N,3), np.float32)
-    objp[:,:2] = np.mgrid[0:M,0:N].T.reshape(-1,2) * args["pattern_size"]
+    if args["pattern"] == "circles":
+        # asymmetric grid: N rows of M circles, odd rows shifted half a (double) spacing
+        objp[:,:2] = [((2*j + i%2)*args["pattern_size"], i*args["pattern_size"]) for i in range(N) for j in range(M)]
+    else:
+        objp[:,:2] = np.mgrid[0:M,0:N].T.reshape(-1,2) * args["pattern_size"]
 
     ini_frame = annotations["ini_calib_frame"]
     if ini_frame <= 0:
@@ -33,11 +77,11 @@ def gather_calibration_data(annotations,args):
         exit(1)
 
     camera[0] = annotations["camera_a"]
+    take = args["take"]
     input_dir=os.path.join(args["datadir"],args["adqdir"])
     output_dir=args["outdir"]
     if output_dir is None:
-        annotations_rel_fname = generate_annotations_filename(args["camera_a"],args["camera_b"],args[ "take"])
-        input_dir = os.path.join(args["datadir"],args["adqdir"])
+        annotations_rel_fname = generate_annotations_filename(args["camera_a"],args["camera_b"])
         annotations_fname = os.path.join(input_dir,annotations_rel_fname)
         print("annotations file:",annotations_fname)
         annotations_base,_ = os.path.splitext(annotations_fname)
@@ -53,86 +97,150 @@ def gather_calibration_data(annotations,args):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir,exist_ok=True)
 
-
     offset = compute_offsets(annotations)
-    # white frame
     for c in range(ncam):
-        print("-"*80)
         input_fname[c] = os.path.join(input_dir,f'{camera[c]}/{camera[c]}_toma{take}_parte1.mp4')
         if not os.path.exists(input_fname[c]):
             print("ERROR: file ",input_fname[c]," not found.")
             exit(1)
-        cap[c] = cv2.VideoCapture(input_fname[c])
-        cap[c].set(cv2.CAP_PROP_POS_FRAMES, offset[c]+ini_frame)
-        fps[c] = cap[c].get(cv2.CAP_PROP_FPS) 
-        # Arrays to store object points and image points from all the images.
+    nframes = final_frame - ini_frame + 1
+    pattern_size = (M,N)
+
+    cache_fname = args["corner_cache"] or os.path.join(output_dir,CACHE_FNAME)
+    cache = CornerCache(cache_fname)
+    print(f"corner cache {cache_fname}: {len(cache)} detections")
+    # everything that changes the detected points, except the frame itself
+    detection_params = dict(backend=args["backend"],rescale_factor=res_fac,pattern=args["pattern"],
+                            pattern_size=pattern_size,detect_scale=args["detect_scale"])
+
+    def gather_camera(c):
         objpoints_c = [] # 3d point in real world space
         imgpoints_c = [] # 2d points in image plane.
-        frame = None
-        frame_index = ini_frame
-        good_frames = 0
-        while (cap[c].isOpened()) and frame_index <= final_frame: # ----- loop over frames
-            # Capture frame-by-frame
-            if frame is None:
-                ret, frame = cap[c].read()
-            else:
-                ret, frame = cap[c].read(frame)
-            if not ret:
-                break
-            h,w,_ = frame.shape
-            color_frame = cv2.resize(frame,(w//res_fac,h//res_fac))
-            color_frame = np.flip(np.array(color_frame),axis=2)            
-            color_frame = fast_rot(color_frame,rot[c])
-            color_frame = color_frame.astype(float)
-            gray_frame = color_frame[:,:,1]
-            gray = np.array(gray_frame)
-            gray = gray - np.min(gray)
-            gray = gray*(255/np.max(gray))
-            gray = gray.astype(np.uint8)
-            frame_name = f'camera{c+1}_calib_{frame_index:07d}.jpg'
-            frame_full_path = os.path.join(output_dir,frame_name)
-            imgio.imsave(frame_full_path,gray,quality=90)
-
-            # Find the chess board corners
-            ret, centers = cv2.findCirclesGrid(gray, (M,N), flags=cv2.CALIB_CB_ASYMMETRIC_GRID)
-            # If found, add object points, image points (after refining them)
-            print(ret,len(centers))
-            if ret == True:
+        frames_c = []
+        sharpness_c = []
+        fingerprint = video_fingerprint(input_fname[c])
+        keys = [frame_key(fingerprint,offset[c]+ini_frame+n,rot=rot[c],**detection_params) for n in range(nframes)]
+        # frames already looked at in a previous run are not decoded nor detected again
+        results = dict()
+        for n,key in enumerate(keys):
+            if key in cache:
+                results[n] = cache.get(key)
+        missing = [n for n in range(nframes) if n not in results]
+        print(f"camera {c+1}: {len(results)} of {nframes} frames in the corner cache.")
+        to_decode = nframes if args["debug"] else (missing[-1]+1 if len(missing) else 0)
+        if to_decode:
+            decoded = _camera_frames(input_fname[c],args["backend"],res_fac,rot[c],offset[c]+ini_frame,to_decode)
+            if not args["debug"]:
+                decoded = ((n,frame) for n,frame in decoded if n not in results)
+        else:
+            decoded = iter(())
+        # calibration frames are encoded and written in the background
+        writer = ImageWriter(args["writers"])
+        for n, gray, centers in detect_stream(decoded,pool,pattern_size,args["pattern"],args["detect_scale"]):
+            frame_index = ini_frame + n
+            size = (gray.shape[1],gray.shape[0])
+            if n not in results:
+                sharp = view_sharpness(gray,centers) if centers is not None else np.nan
+                cache.put(keys[n],centers,size,sharp)
+                results[n] = (centers,size,sharp)
+                if centers is not None:
+                    # frames with the pattern are kept for later inspection (or recalibration)
+                    frame_name = f'camera{c+1}_calib_{frame_index:07d}.jpg'
+                    writer.write(os.path.join(output_dir,frame_name),gray,quality=90)
+            centers = results[n][0]
+            if args["debug"]:
+                debug = gray.copy()
+                for ce in (centers if centers is not None else []):
+                    ce = np.squeeze(ce).astype(int)
+                    debug[ce[1]-2:ce[1]+2,ce[0]-2:ce[0]+2] = 255
+                debug_frame_name = f'camera{c+1}_debug_{frame_index:07d}.jpg'
+                writer.write(os.path.join(output_dir,debug_frame_name),debug,quality=90)
+            if not (n+1) % 100:
+                print(f"camera {c+1}: frame {frame_index}, {len(results)} of {nframes} frames done.")
+        writer.close()
+        for n in sorted(results):
+            centers, size, sharp = results[n]
+            frame_size[c] = size
+            if centers is not None:
                 objpoints_c.append(objp)
-                #criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, args["maxiter"], args["epsilon"])
-                #corners2 = cv2.cornerSubPix(gray,centers, (window_size,window_size), (-1,-1), criteria)
-                centers2 = centers
-                imgpoints_c.append(centers2)
-                good_frames += 1
-                print('OK!')
-            else:
-                print('Pattern not found in frame ',frame_index)
-                objpoints_c.append(None)
-                imgpoints_c.append(None)
-            for ce in centers:
-                ce = np.squeeze(ce).astype(int)
-                gray[ce[1]-2:ce[1]+2,ce[0]-2:ce[0]+2] = 255
-            debug_frame_name = f'camera{c+1}_debug_{frame_index:07d}.jpg'
-            debug_frame_full_path = os.path.join(output_dir,debug_frame_name)
-            imgio.imsave(debug_frame_full_path,gray,quality=90)
-            frame_index += 1
-            print(f"got {good_frames} out of {final_frame-ini_frame} frames.")
-            # end while: go over calibration frames for current camera
+                imgpoints_c.append(centers)
+                frames_c.append(ini_frame + n)
+                sharpness_c.append(sharp)
+        print(f"camera {c+1}: pattern found in {len(frames_c)} out of {nframes} frames.")
         obj_points[c] = objpoints_c
         img_points[c] = imgpoints_c
-        # end for: end gathering data for current camera
-    return np.flip(gray_frame.shape), obj_points, img_points
+        frames[c] = frames_c
+        sharpness[c] = sharpness_c
 
-if __name__ == "__main__":
-    ap = argparse.ArgumentParser()
+    t0 = time.time()
+    try:
+        with make_pool(args["jobs"]) as pool:
+            # one decoding thread per camera, both feeding the same detection pool
+            with concurrent.futures.ThreadPoolExecutor(max_workers=ncam) as decoders:
+                for f in [decoders.submit(gather_camera,c) for c in range(ncam)]:
+                    f.result()
+    finally:
+        # whatever was detected is kept, even if interrupted
+        cache.close()
+    print(f"detection took {time.time()-t0:.1f}s")
+    return frame_size[:ncam], obj_points[:ncam], img_points[:ncam], frames[:ncam], sharpness[:ncam]
+
+def calibrate_single(obj_points, img_points, frames, sharpness, frame_size, max_views=MAX_VIEWS):
+    """
+    Calibrates one camera from the views where the pattern was found: keeps the most
+    informative views (position, scale, tilt, sharpness), most informative first, and
+    calibrates adding views until the error converges.
+    Returns rms, camera matrix, distortion coefficients, rotation and translation vectors
+    and the frames of the views used.
+    """
+    selected = select_views(img_points,frame_size,sharpness,max_views)
+    print(f"\t{len(selected)} views selected out of {len(obj_points)}")
+    ret, mtx, dist, rvecs, tvecs, nviews = incremental_calibration([obj_points[i] for i in selected],
+                                                                 [img_points[i] for i in selected],
+                                                                 frame_size)
+    used = [frames[i] for i in selected[:nviews]]
+    print('RMSE',ret,'with',nviews,'views:',used)
+    rvecs = np.squeeze(np.array(rvecs))
+    tvecs = np.squeeze(np.array(tvecs))
+    dist = np.squeeze(dist)
+    return ret, mtx, dist, rvecs, tvecs, used
+
+
+def save_calibration(output_dir, prefix, mtx, dist, rvecs, tvecs, newcameramtx, frame_size=None, rescale_factor=None, rot=0):
+    # the model and the frames it refers to, for undistorting (see undistort.py)
+    intrinsics = {"camera_matrix":np.asarray(mtx).tolist(),
+                  "distortion_coeffs":np.asarray(dist).tolist(),
+                  "optimal_matrix":np.asarray(newcameramtx).tolist(),
+                  "frame_size":list(frame_size) if frame_size is not None else None,
+                  "rescale_factor":rescale_factor,
+                  "rot":rot}
+    with open(os.path.join(output_dir,prefix+INTRINSICS_FNAME),"w") as fc:
+        fc.write(json.dumps(intrinsics,indent=4))
+    np.savetxt(os.path.join(output_dir,prefix+'calibration_matrix.txt'),mtx,fmt='%10.6f')
+    np.savetxt(os.path.join(output_dir,prefix+'calibration_distortion_coeffs.txt'),dist,fmt='%10.6f')
+    np.savetxt(os.path.join(output_dir,prefix+'calibration_rotation_vectors.txt'),rvecs,fmt='%10.6f')
+    np.savetxt(os.path.join(output_dir,prefix+'calibration_translation_vectors.txt'),tvecs,fmt='%10.6f')
+    np.savetxt(os.path.join(output_dir,prefix+'calibration_optimal_matrix.txt'),newcameramtx,fmt='%10.6f')
+
+
+def add_arguments(ap):
+    """
+    Command line arguments shared by calibrate_camera.py and calibrate_pair.py
+    """
     ap.add_argument("-a","--camera-a", type=str, required=True,
                     help="primera cámara (siempre tiene que estar)")
     ap.add_argument("-b","--camera-b", type=str, default=None,
                     help="segunda cámara (si es un par)")
     ap.add_argument('-D',"--datadir", type=str, required=True,
                     help="Base directory for all gathered data.")
-    ap.add_argument('-R',"--rescale-factor", type=int, default=8,
-                    help="Reduce resolution this many times (defaults to 8 -- brutal). ")
+    ap.add_argument("-A","--adqdir", type=str, required=True,
+                    help="nombre de directorio de la instancia de adquisicion, por ej: 2024-01-03-vino_fino SIN terminadores (barras)")
+    ap.add_argument("-t","--take", type=int, default=1,
+                    help="Which take to process (toma).")
+    ap.add_argument('-R',"--rescale-factor", type=int, default=4,
+                    help="Reduce resolution this many times (defaults to 4). The pattern is detected at detect-scale times less resolution and refined at this one.")
+    ap.add_argument("--detect-scale", type=int, default=DETECT_SCALE,
+                    help="Look for the pattern on frames this many times smaller than the rescaled ones.")
     ap.add_argument('-l',"--alpha", type=float, default=1,
                     help="Parameter for OpenCV getOptimalNewCameraMatrix.")
     ap.add_argument('-E',"--epsilon", type=float, default=1e-3,
@@ -140,7 +248,7 @@ if __name__ == "__main__":
     ap.add_argument('-I',"--maxiter", type=int, default=100,help="Parameter for OpenCV corner subpixel estimation.")
     ap.add_argument('-o',"--outdir", type=str, default=None,
                     help="output directory. Defaults to the same name as the annotation file with .calib instead of .json as suffix.")
-    ap.add_argument('-p',"--pattern", type=str, default="circles",
+    ap.add_argument('-p',"--pattern", type=str, default="circles", choices=("circles","chessboard"),
                     help="Type of calibration pattern. May be chessboard or circles.")
     ap.add_argument('-M',"--nrows", type=int, default=5,
                     help="Number of rows in pattern.")
@@ -150,9 +258,26 @@ if __name__ == "__main__":
                     help="Save debugging info (frames).")
     ap.add_argument('-L',"--pattern-size", type=float, default=1,
                     help="Size of patterns in real world (in your units of preference, doesn't matter).")
+    ap.add_argument('-k','--backend', type=str, default="opencv", choices=BACKENDS,
+                    help="Video decoding backend. ffmpeg reduces, rotates and converts frames inside the decoder (needs the ffmpeg executable).")
+    ap.add_argument('-w','--writers', type=int, default=4,
+                    help="Number of threads encoding and writing calibration frames (0 to write synchronously).")
+    ap.add_argument('-j','--jobs', type=int, default=None,
+                    help="Number of processes detecting the pattern (defaults to the number of cores).")
+    ap.add_argument('-m','--max-views', type=int, default=MAX_VIEWS,
+                    help="Maximum number of views (frames with the pattern) used for calibrating each camera.")
+    ap.add_argument('-C','--corner-cache', type=str, default=None,
+                    help=f"File where detected patterns are cached, so that recalibrating (e.g. with another alpha) needs no decoding nor detection. Defaults to {CACHE_FNAME} in the output directory.")
+    ap.add_argument('-d','--debug', action="store_true",
+                    help="Save debugging frames (every frame, with the detected centers marked).")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    add_arguments(ap)
 
     args = vars(ap.parse_args())
-    annotations_rel_fname = generate_annotations_filename(args["camera_a"],args["camera_b"],args[ "take"])
+    annotations_rel_fname = generate_annotations_filename(args["camera_a"],args["camera_b"])
     input_dir = os.path.join(args["datadir"],args["adqdir"])
     annotations_fname = os.path.join(input_dir,annotations_rel_fname)
     print("annotations file:",annotations_fname)
@@ -160,34 +285,28 @@ if __name__ == "__main__":
         annotations = json.loads(fa.read())
         print("annotations:",json.dumps(annotations,indent="  "))
         #
-        # grab and store calibration frames
-        #
-        frame_size, obj_points, img_points = gather_calibration_data(annotations,args)
-        #
-        # calibrating
-        #
-        print("Initial calibration")
-        ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(obj_points, img_points, frame_size, None, None)
-        print('RMSE',ret)
-        rvecs = np.squeeze(np.array(rvecs))
-        tvecs = np.squeeze(np.array(tvecs))
-        dist = np.squeeze(dist)
+        # grab calibration frames and detect the pattern
         #
-        # refining model
-        #
-        alpha = args["alpha"]
-        print('Refining calibration')
-        newcameramtx, roi = cv2.getOptimalNewCameraMatrix(mtx, dist, frame_size, alpha, frame_size)
-
-        print('Saving results')
-        input_dir=os.path.join(args["datadir"],args["adqdir"])
+        frame_size, obj_points, img_points, frames, sharpness = gather_calibration_data(annotations,args)
         output_dir=args["outdir"]
         if output_dir is None:
             annotations_base,_ = os.path.splitext(annotations_fname)
-            output_dir = os.path.join(input_dir,annotations_base+".calib")
-        np.savetxt(os.path.join(output_dir,'calibration_matrix.txt'),mtx,fmt='%10.6f')
-        np.savetxt(os.path.join(output_dir,'calibration_distortion_coeffs.txt'),dist,fmt='%10.6f')
-        np.savetxt(os.path.join(output_dir,'calibration_rotation_vectors.txt'),rvecs,fmt='%10.6f')
-        np.savetxt(os.path.join(output_dir,'calibration_translation_vectors.txt'),tvecs,fmt='%10.6f')
-        np.savetxt(os.path.join(output_dir,'calibration_optimal_matrix.txt'),newcameramtx,fmt='%10.6f')
-        cv2.destroyAllWindows()
+            output_dir = annotations_base+".calib"
+        for c in range(len(obj_points)):
+            if not len(obj_points[c]):
+                print(f"ERROR: pattern not found in any frame of camera {c+1}.")
+                continue
+            print(f"Calibrating camera {c+1}")
+            ret, mtx, dist, rvecs, tvecs, used = calibrate_single(obj_points[c],img_points[c],frames[c],sharpness[c],
+                                                                  frame_size[c],args["max_views"])
+            #
+            # refining model
+            #
+            alpha = args["alpha"]
+            print('Refining calibration')
+            newcameramtx, roi = cv2.getOptimalNewCameraMatrix(mtx, dist, frame_size[c], alpha, frame_size[c])
+
+            print('Saving results')
+            # camera 1 keeps the historical file names
+            save_calibration(output_dir,"" if c == 0 else f"camera{c+1}_",mtx,dist,rvecs,tvecs,newcameramtx,
+                             frame_size[c],args["rescale_factor"],annotations[f"rot{c+1}"])
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Stereo calibration of a pair of synchronized cameras.
+
+Both videos are decoded concurrently, in sync (using the sync frames of the annotations,
+see compute_offsets), and the pattern is detected on both streams by the same process pool
+(see calibrate_camera.gather_calibration_data). Each camera is calibrated on its own with
+all the frames where it sees the pattern; then the pair is calibrated with cv2.stereoCalibrate
+(intrinsics fixed) using only the frames where BOTH cameras see it.
+
+Everything is written to a single file, stereo_calibration.json, in the calibration
+directory: the intrinsics of both cameras, the pose of camera 2 relative to camera 1 (R,T),
+the essential and fundamental matrices (E,F) and the rectification transforms (R1,R2,P1,P2,Q)
+computed with alpha. All of them refer to frames reduced rescale_factor times and rotated
+rot1/rot2 as in the annotations.
+"""
+import numpy as np
+import cv2
+import os
+import argparse
+import json
+
+from vutils import *
+from viewselect import select_views
+from calibrate_camera import add_arguments, gather_calibration_data, calibrate_single
+from undistort import STEREO_FNAME
+
+def pair_views(obj_points, img_points, frames, sharpness):
+    """
+    Views (frames) where the pattern was found on both cameras.
+    Returns the object points, image points of each camera, frame numbers and sharpness
+    (the smallest of both) of each of them.
+    """
+    index_2 = {f:i for i,f in enumerate(frames[1])}
+    pairs = [(i,index_2[f]) for i,f in enumerate(frames[0]) if f in index_2]
+    return ([obj_points[0][i] for i,_ in pairs],
+            [img_points[0][i] for i,_ in pairs],
+            [img_points[1][j] for _,j in pairs],
+            [frames[0][i] for i,_ in pairs],
+            [min(sharpness[0][i],sharpness[1][j]) for i,j in pairs])
+
+
+def calibrate_stereo(frame_size, obj_points, img_points, frames, sharpness, args):
+    """
+    Calibrates each camera and then the pair.
+    Returns the calibration as a dict of JSON serializable values.
+    """
+    if frame_size[0] != frame_size[1]:
+        # stereoCalibrate and stereoRectify take a single image size for both cameras
+        print(f"ERROR: frame sizes differ ({frame_size[0]} and {frame_size[1]}); use frames of the same size for both cameras.")
+        exit(1)
+    intrinsics = list()
+    for c in range(2):
+        print(f"Calibrating camera {c+1}")
+        rms, mtx, dist, _, _, used = calibrate_single(obj_points[c],img_points[c],frames[c],sharpness[c],
+                                                      frame_size[c],args["max_views"])
+        intrinsics.append((rms,mtx,dist))
+
+    objp, imgp_1, imgp_2, pair_frames, pair_sharpness = pair_views(obj_points,img_points,frames,sharpness)
+    print(f"pattern found on both cameras in {len(pair_frames)} frames.")
+    if not len(pair_frames):
+        print("ERROR: no frame with the pattern on both cameras.")
+        exit(1)
+    size = frame_size[0]
+    # the pose of the pattern matters here as much as for a single camera
+    selected = select_views(imgp_1,size,pair_sharpness,args["max_views"])
+    print(f"Calibrating pair with {len(selected)} views out of {len(pair_frames)}")
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, args["maxiter"], args["epsilon"])
+    (rms_1,mtx_1,dist_1), (rms_2,mtx_2,dist_2) = intrinsics
+    rms, mtx_1, dist_1, mtx_2, dist_2, R, T, E, F = cv2.stereoCalibrate([objp[i] for i in selected],
+                                                                      [imgp_1[i] for i in selected],
+                                                                      [imgp_2[i] for i in selected],
+                                                                      mtx_1, dist_1, mtx_2, dist_2, size,
+                                                                      criteria=criteria,
+                                                                      flags=cv2.CALIB_FIX_INTRINSIC)
+    print('RMSE',rms)
+    R1, R2, P1, P2, Q, roi_1, roi_2 = cv2.stereoRectify(mtx_1, dist_1, mtx_2, dist_2, size, R, T, alpha=args["alpha"])
+    tolist = lambda a: np.asarray(a).tolist()
+    return {"camera_a":args["camera_a"],
+            "camera_b":args["camera_b"],
+            "rescale_factor":args["rescale_factor"],
+            "frame_size":list(size),
+            "alpha":args["alpha"],
+            "camera_matrix_1":tolist(mtx_1),
+            "distortion_coeffs_1":tolist(np.squeeze(dist_1)),
+            "rms_1":rms_1,
+            "camera_matrix_2":tolist(mtx_2),
+            "distortion_coeffs_2":tolist(np.squeeze(dist_2)),
+            "rms_2":rms_2,
+            "R":tolist(R),
+            "T":tolist(np.squeeze(T)),
+            "E":tolist(E),
+            "F":tolist(F),
+            "rms":rms,
+            "R1":tolist(R1),
+            "R2":tolist(R2),
+            "P1":tolist(P1),
+            "P2":tolist(P2),
+            "Q":tolist(Q),
+            "roi_1":list(roi_1),
+            "roi_2":list(roi_2),
+            "frames":[pair_frames[i] for i in selected]}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    add_arguments(ap)
+
+    args = vars(ap.parse_args())
+    if args["camera_b"] is None:
+        print("ERROR: a stereo calibration needs two cameras (-b).")
+        exit(1)
+    annotations_rel_fname = generate_annotations_filename(args["camera_a"],args["camera_b"])
+    input_dir = os.path.join(args["datadir"],args["adqdir"])
+    annotations_fname = os.path.join(input_dir,annotations_rel_fname)
+    print("annotations file:",annotations_fname)
+    with open(annotations_fname,"r") as fa:
+        annotations = json.loads(fa.read())
+    print("annotations:",json.dumps(annotations,indent="  "))
+    #
+    # decode both cameras in sync and detect the pattern
+    #
+    frame_size, obj_points, img_points, frames, sharpness = gather_calibration_data(annotations,args)
+    output_dir=args["outdir"]
+    if output_dir is None:
+        annotations_base,_ = os.path.splitext(annotations_fname)
+        output_dir = annotations_base+".calib"
+    for c in range(2):
+        if not len(obj_points[c]):
+            print(f"ERROR: pattern not found in any frame of camera {c+1}.")
+            exit(1)
+    calibration = calibrate_stereo(frame_size,obj_points,img_points,frames,sharpness,args)
+    calibration["rot1"] = annotations["rot1"]
+    calibration["rot2"] = annotations["rot2"]
+    calibration["offsets"] = compute_offsets(annotations)
+    stereo_fname = os.path.join(output_dir,STEREO_FNAME)
+    print('Saving results to',stereo_fname)
+    with open(stereo_fname,"w") as fc:
+        fc.write(json.dumps(calibration,indent=4))
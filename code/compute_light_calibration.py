@@ -22,58 +22,127 @@ from skimage import transform as trans
 import skimage
 import json
 import os
+import concurrent.futures
 from vutils import *
+from ffsource import open_video, BACKENDS
+from whiteframe import WhiteAccumulator
+from illumination import white_frame_model
+from vindex import load_index
+from proxy import load_proxy
+from vmap import split_video, init_worker
 
 
-def do_white(input_fname, ini_frame, end_frame, output_prefix):
-    calibration = dict()
-    res_fac = 8 # args["rescale_factor"]
-    input_fname = input_fname
+MIN_SEGMENT = 50 # frames; shorter segments are not worth a process
+
+
+def white_segment(input_fname, ini_frame, end_frame, output_prefix, backend="opencv", method="max", res_fac=8):
+    """
+    Accumulates the white frame statistics of frames ini_frame to end_frame (not included) of a video.
+    Returns the (serializable) state of the WhiteAccumulator, see whiteframe.py.
+    If the video has a proxy at res_fac (see proxy.py), frames are read from it instead.
+    """
     n_frames = end_frame - ini_frame
-    cap = cv2.VideoCapture(input_fname)
-    t_frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-    fps = cap.get(cv2.CAP_PROP_FPS) 
-    print("\tframes per second: ",fps)
-    max_frame = None
+    proxy = load_proxy(input_fname,res_fac)
+    if proxy is not None:
+        # already reduced and in RGB, nothing to decode
+        n_frames = max(0,min(end_frame,len(proxy))-ini_frame)
+        cap, transformed = None, True
+    else:
+        # with the ffmpeg backend the frames come already reduced and in RGB
+        cap, transformed = open_video(input_fname,backend,res_fac,pix_fmt="rgb24",start_frame=ini_frame)
+        h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    # per pixel white frame reduction (max, average, trimmed mean or percentile)
+    # and color sums of the non-saturated pixels, in a single pass
+    accumulator = WhiteAccumulator(method)
     t0 = time.time()
-    mean_red = 0
-    mean_green = 0
-    mean_blue = 0
-    num_valid = 0
     n = 0
-    calibration = dict()
-    while (cap.isOpened()) and n < n_frames: # ----- loop over frames
-        # Capture frame-by-frame
-        ret, input_frame = cap.read()
-        if not ret:
-            print("Error reading frame!")
-            break
-        h,w,_ = input_frame.shape
-        small_frame = cv2.resize(input_frame,(w//res_fac,h//res_fac))
-        hr,wr = small_frame.shape[:2]
-        # BGR -> RGB
-        small_frame = np.flip(np.array(small_frame),axis=2)
-        if max_frame is None:
-            gray_frame = np.zeros((hr,wr),dtype=np.uint8)
-            valid_pixels = np.zeros_like(gray_frame,dtype=bool)
-            max_frame = np.zeros_like(gray_frame,dtype=np.uint8)
-
-        gray_frame[:] = np.squeeze((np.sum(small_frame,axis=2))//3) # R + G + B
-        valid_pixels[:] = gray_frame < 255
-        num_valid  += np.sum(valid_pixels)
-        mean_red   += np.sum(small_frame[:,:,0]*valid_pixels)
-        mean_green += np.sum(small_frame[:,:,1]*valid_pixels)
-        mean_blue  += np.sum(small_frame[:,:,2]*valid_pixels)
-        max_frame[:] = np.maximum(max_frame,gray_frame)
-
-        if not n % 5:
+    while (cap is None or cap.isOpened()) and n < n_frames: # ----- loop over frames
+        if proxy is not None:
+            input_frame = proxy[ini_frame+n]
+        else:
+            # Capture frame-by-frame
+            ret, input_frame = cap.read()
+            if not ret:
+                print("Error reading frame!")
+                break
+        if transformed:
+            small_frame = input_frame
+        else:
+            small_frame = cv2.resize(input_frame,(w//res_fac,h//res_fac))
+            # BGR -> RGB
+            small_frame = np.flip(np.array(small_frame),axis=2)
+        accumulator.update(small_frame)
+
+        if not (n+ini_frame) % 5:
             _fps = n/(time.time()-t0)
             imgio.imsave(f'{output_prefix}_frame_{n+ini_frame:05d}.jpg',small_frame)
             print(f'frame {n+ini_frame:05d}  fps {_fps:7.1f}')
 
         n += 1
         # release the video capture object
+    if cap is not None:
+        cap.release()
+    return accumulator.state()
+
+
+def split_intervals(intervals, jobs):
+    """
+    Splits the (video, ini_frame, end_frame) intervals in segments of (about) the same
+    length, at least MIN_SEGMENT frames long, so that jobs processes are kept busy.
+    Segments start at keyframes (see vmap.split_video), so no worker decodes frames that
+    another one processes.
+    """
+    total = sum(end-ini for _,ini,end in intervals)
+    seg_len = max(MIN_SEGMENT, int(np.ceil(total/max(1,jobs))))
+    segments = list()
+    for fname,ini,end in intervals:
+        nsegments = max(1,int(round((end-ini)/seg_len)))
+        segments.extend((fname,i0,i1) for i0,i1 in split_video(fname,nsegments,ini,end))
+    return segments
+
+
+def accumulate_white(intervals, output_prefix, backend="opencv", method="max", res_fac=8, jobs=1):
+    """
+    White frame statistics of several (video, ini_frame, end_frame) intervals, which may
+    come from different takes of the same camera. The intervals are split in segments which
+    are processed in parallel by jobs processes; their partial states are merged at the end.
+    """
+    segments = split_intervals(intervals, jobs)
+    accumulator = WhiteAccumulator(method)
+    t0 = time.time()
+    if jobs <= 1 or len(segments) == 1:
+        for fname,ini,end in segments:
+            accumulator.merge(WhiteAccumulator.from_state(white_segment(fname,ini,end,output_prefix,backend,method,res_fac)))
+    else:
+        print(f"processing {len(segments)} segments on {jobs} processes")
+        if backend == "opencv":
+            for fname in set(fname for fname,_,_ in segments):
+                load_index(fname) # build it once here instead of in every worker
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,initializer=init_worker) as pool:
+            futures = [pool.submit(white_segment,fname,ini,end,output_prefix,backend,method,res_fac) for fname,ini,end in segments]
+            for f in futures:
+                accumulator.merge(WhiteAccumulator.from_state(f.result()))
+    print(f"{accumulator.frames} frames in {time.time()-t0:.1f}s")
+    return accumulator
+
+
+def do_white(input_fname, ini_frame, end_frame, output_prefix, backend="opencv", method="max", jobs=1, intervals=None):
+    """
+    Computes the white frame and white balance of a camera from frames ini_frame to end_frame
+    of input_fname and, optionally, other (video, ini_frame, end_frame) intervals.
+    """
+    res_fac = 8 # args["rescale_factor"]
+    all_intervals = [(input_fname,ini_frame,end_frame)] + (list(intervals) if intervals is not None else [])
+    cap = cv2.VideoCapture(input_fname)
+    h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    fps = cap.get(cv2.CAP_PROP_FPS) 
     cap.release()
+    print("\tframes per second: ",fps)
+    calibration = dict()
+    accumulator = accumulate_white(all_intervals,output_prefix,backend,method,res_fac,jobs)
+    max_frame = accumulator.white_frame()
     i0r = 0
     j0r = 0
     i1r = max_frame.shape[0]
@@ -88,12 +157,12 @@ def do_white(input_fname, ini_frame, end_frame, output_prefix):
     max_frame_up = cv2.resize(max_frame,(w,h))
     wf_avg_preview = f'{output_prefix}_average_white_frame.png'
     imgio.imsave(wf_avg_preview,skimage.img_as_ubyte(max_frame_up))
-    means = (mean_red/num_valid,mean_green/num_valid,mean_blue/num_valid)
     #
     # save calibration params
     #
-    calibration["white_balance"] = {"red":means[0],"green":means[1],"blue":means[2]}
-    print(f"mean white frame color:",means)
+    calibration["white_balance"] = accumulator.white_balance()
+    calibration["white_frame_method"] = str(method)
+    print(f"mean white frame color:",calibration["white_balance"])
     #
     # compute illumination curve as a second order curve from the non-saturated pixels
     #
@@ -123,14 +192,13 @@ def do_white(input_fname, ini_frame, end_frame, output_prefix):
     a,rss,rank,sval = np.linalg.lstsq(X,L,rcond=None)
     calibration["white_frame_parameters"] = a.tolist()
 
-    ri = np.arange(h)/h
-    ci = np.arange(w)/w
-    Ri,Ci = np.meshgrid(ri,ci,indexing='ij')
-    white_frame = a[0] + a[1]*Ri + a[2]*Ci + a[3]*(Ri**2) + a[4]*(Ri*Ci) + a[5]*(Ci**2)
-    wf_matrix_fname = f'{output_prefix}_white_frame_par.npy'
-    np.save(wf_matrix_fname,white_frame)
+    #
+    # the coefficients are all we keep: gain maps for any resolution, rotation and crop are
+    # generated from them on demand (see illumination.get_gain_map). This is just a preview.
+    #
+    white_frame = white_frame_model(a,(hr,wr))
     # very likely, the computed parametric white frame falls out of the valid range if there were many saturated
-    # pixels, so we downscale the output image. We will use the saved matrix (npy), not this, for normalization
+    # pixels, so we downscale the output image.
     white_frame = (white_frame*(255/np.max(white_frame))).astype(np.uint8)
     wf_image_fname = f'{output_prefix}_white_frame_par.png'
     imgio.imsave(wf_image_fname,white_frame)
@@ -152,9 +220,17 @@ if __name__ == "__main__":
     ap.add_argument('-o',"--output_prefix", type=str, default="output_",
                     help="Output prefix for data produced by this function.")
     ap.add_argument('-m',"--method", type=str, default="max",
-                    help="Method for computing the white frame. May be average,max,or an integer for the percentile (much slower).")
+                    help="Method for computing the white frame. May be max, average, trimmed (mean without the 10%% lowest and highest values) or an integer for the percentile.")
+    ap.add_argument('-k',"--backend", type=str, default="opencv", choices=BACKENDS,
+                    help="Video decoding backend. ffmpeg reduces and converts frames inside the decoder (needs the ffmpeg executable).")
+    ap.add_argument('-j',"--jobs", type=int, default=os.cpu_count(),
+                    help="Number of processes decoding segments of the calibration interval(s) in parallel.")
+    ap.add_argument('-I',"--interval", nargs=3, action="append", default=[], metavar=("VIDEO","INI_FRAME","END_FRAME"),
+                    help="Additional white calibration interval (e.g. from another take of the same camera). May be repeated.")
     args = ap.parse_args()
-    calibration = do_white(args.input_video, args.ini_frame, args.end_frame, args.output_prefix)
+    intervals = [(fname,int(ini),int(end)) for fname,ini,end in args.interval]
+    calibration = do_white(args.input_video, args.ini_frame, args.end_frame, args.output_prefix, args.backend, args.method,
+                           args.jobs, intervals)
     txt = json.dumps(calibration,indent=4)
     print("CALIBRATION:",txt)    
     with open(f'{args.output_prefix}_white.json',"w") as f:
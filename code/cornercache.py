@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Persistent cache of calibration pattern detections.
+
+Detecting the pattern is by far the most expensive part of a calibration, and the
+detections do not depend on what is done with them afterwards (alpha, model flags, number
+of views...), so they are kept in a cache and a calibration can be repeated without
+touching the images again.
+
+The cache is content addressed: each entry is keyed by a sha1 of what was looked at plus
+every parameter that affects the result (pattern type and size, scales, subpixel
+criteria, ...):
+
+    file_key()    the bytes of an image file (no need to decode it on a hit)
+    image_key()   the pixels of an image already in memory
+    frame_key()   a frame of a video, given by a fingerprint of the video file, the frame
+                  number and the decoding parameters (no need to decode the video on a hit)
+
+Each entry holds the detected points (or nothing if the pattern was not found), the size
+(w,h) of the image the points refer to and, optionally, its sharpness.
+
+All entries are stored in a single .npz file: the keys, sizes and sharpness as arrays
+with one row per entry and the points of all the entries concatenated in one float32
+array (with offsets). It is written atomically by save().
+"""
+
+import hashlib
+import json
+import os
+import numpy as np
+
+CACHE_FNAME = "corners.npz"
+FINGERPRINT_BYTES = 1 << 20     # bytes hashed at each end of a video file
+
+
+def _key(content_hash, params):
+    return hashlib.sha1((content_hash + json.dumps(params, sort_keys=True)).encode("utf-8")).hexdigest()
+
+
+def image_key(image, **params):
+    """
+    Key of the detection on an image (numpy array) with the given parameters
+    """
+    image = np.ascontiguousarray(image)
+    h = hashlib.sha1(str((image.shape, image.dtype.str)).encode("utf-8"))
+    h.update(image)
+    return _key(h.hexdigest(), params)
+
+
+def file_key(fname, **params):
+    """
+    Key of the detection on an image file with the given parameters
+    """
+    h = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(FINGERPRINT_BYTES), b""):
+            h.update(block)
+    return _key(h.hexdigest(), params)
+
+
+def video_fingerprint(fname):
+    """
+    Identifies a video file by its size and the contents of its first and last
+    FINGERPRINT_BYTES (hashing several GB on each run would defeat the purpose)
+    """
+    size = os.path.getsize(fname)
+    h = hashlib.sha1(str(size).encode("utf-8"))
+    with open(fname, "rb") as f:
+        h.update(f.read(FINGERPRINT_BYTES))
+        if size > FINGERPRINT_BYTES:
+            f.seek(max(FINGERPRINT_BYTES, size - FINGERPRINT_BYTES))
+            h.update(f.read(FINGERPRINT_BYTES))
+    return h.hexdigest()
+
+
+def frame_key(fingerprint, frame, **params):
+    """
+    Key of the detection on frame number frame of the video with the given fingerprint
+    (see video_fingerprint) decoded and detected with the given parameters
+    """
+    return _key(f"{fingerprint}:{frame}", params)
+
+
+class CornerCache():
+    '''
+    Dictionary of key -> (points or None, size, sharpness) backed by an .npz file.
+    Changes are written to disk by save() (or close()).
+    '''
+    def __init__(self, fname):
+        self.fname = fname
+        self.entries = dict()
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        self.entries = dict()
+        if not os.path.exists(self.fname):
+            return
+        try:
+            with np.load(self.fname) as data:
+                keys = data["keys"]
+                sizes = data["sizes"]
+                sharpness = data["sharpness"]
+                offsets = data["offsets"]
+                points = data["points"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"WARNING: ignoring unreadable corner cache {self.fname}: {e}")
+            return
+        for i, key in enumerate(keys):
+            p = points[offsets[i]:offsets[i+1]]
+            self.entries[key.decode("ascii")] = (p.reshape(-1, 1, 2) if len(p) else None,
+                                                 (int(sizes[i, 0]), int(sizes[i, 1])), float(sharpness[i]))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """
+        (points, size, sharpness) of key, or None if not cached. points is None if the
+        pattern was not found.
+        """
+        return self.entries.get(key)
+
+    def put(self, key, points, size, sharpness=np.nan):
+        if points is not None:
+            points = np.asarray(points, dtype=np.float32).reshape(-1, 1, 2)
+        self.entries[key] = (points, (int(size[0]), int(size[1])), float(sharpness))
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        n = len(self.entries)
+        keys = np.array([k.encode("ascii") for k in self.entries], dtype="S40").reshape(n)
+        sizes = np.zeros((n, 2), dtype=np.int32)
+        sharpness = np.zeros(n, dtype=np.float32)
+        offsets = np.zeros(n+1, dtype=np.int64)
+        points = list()
+        for i, (p, size, s) in enumerate(self.entries.values()):
+            sizes[i] = size
+            sharpness[i] = s
+            npts = 0 if p is None else len(p)
+            offsets[i+1] = offsets[i] + npts
+            if npts:
+                points.append(p.reshape(-1, 2))
+        points = np.concatenate(points) if len(points) else np.zeros((0, 2), dtype=np.float32)
+        dirname = os.path.dirname(self.fname)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_fname = f"{self.fname}.{os.getpid()}.tmp"
+        with open(tmp_fname, "wb") as f:
+            np.savez(f, keys=keys, sizes=sizes, sharpness=sharpness, offsets=offsets, points=points)
+        os.replace(tmp_fname, self.fname)
+        self.dirty = False
+
+    def close(self):
+        self.save()
@@ -18,8 +18,128 @@ from skimage import transform as trans
 import json
 import os
 import csv
+import functools
 from vutils import *
+from qrtrack import QRTracker, find_finder_patterns, merge_events
+from ffsource import BACKENDS
+from proxy import load_proxy
+from vmap import map_video
+from qrindex import QRIndex
 
+PROXY_MARGIN = 15 # frames processed before and after those where the proxy shows finder patterns
+PROXY_UPSCALE = 4 # proxy frames are enlarged this many times before looking for finder patterns
+PROXY_MIN_FINDER = 3 # smallest finder pattern found in the proxy, in proxy pixels
+
+
+def candidate_frames(proxy, margin=PROXY_MARGIN):
+    """
+    Frames where a QR code may be visible: those where finder patterns are found in the
+    proxy of the video, and margin frames around them (codes are tracked from the moment
+    they can be decoded until they leave the frame, which the coarse proxy may not see).
+    Finder patterns a few proxy pixels wide only keep their nested contours when the frame
+    is enlarged (and thresholded on a small neighbourhood); still, those smaller than
+    PROXY_MIN_FINDER proxy pixels (24 pixels of the video for a 1/8 proxy) are missed,
+    although the tracker finds them down to about 12.
+    """
+    hits = np.zeros(len(proxy),dtype=bool)
+    for i in range(len(proxy)):
+        gray = cv2.resize(proxy.gray(i),None,fx=PROXY_UPSCALE,fy=PROXY_UPSCALE,interpolation=cv2.INTER_CUBIC)
+        hits[i] = len(find_finder_patterns(gray,block_size=9,min_size=PROXY_MIN_FINDER*PROXY_UPSCALE)) > 0
+    # dilate the hits by margin frames on each side
+    counts = np.concatenate(([0],np.cumsum(hits)))
+    lo = np.maximum(np.arange(len(proxy))-margin,0)
+    hi = np.minimum(np.arange(len(proxy))+margin+1,len(proxy))
+    return np.flatnonzero(counts[hi]-counts[lo] > 0)
+
+
+class QRScan():
+    '''
+    Finds the QR codes in a segment of a video; mapper for vmap.map_video.
+    result() returns (rows, events, frames processed, decode attempts), where rows are the
+    CSV rows (frame, data, corners) of the codes visible in each frame.
+    Codes still tracked at the end of the segment are followed past it (see more()), as a
+    serial scan would, since the next segment may not be able to decode them again; the
+    rows of those frames may then also come from the next segment.
+    With full_decode every frame is decoded and the events are the runs of consecutive
+    frames where each code is decoded.
+    '''
+    def __init__(self, full_decode=False):
+        self.full_decode = full_decode
+        self.detector = cv2.QRCodeDetector()
+        self.tracker = QRTracker()
+        self.rows = list()
+        self.last_index = None
+        self.end = None
+        self.frames = 0
+        self.decodes = 0
+        self.open_events = dict() # full_decode events of the codes seen in the last frame
+        self.events = list()
+
+    def process(self, frame_index, frame):
+        if self.last_index is not None and frame_index != self.last_index + 1:
+            self.tracker.gap() # frames were skipped
+        self.last_index = frame_index
+        # with the ffmpeg backend the decoder gives us the luma plane directly
+        gray_frame = frame if frame.ndim == 2 else cv2.cvtColor(frame,cv2.COLOR_BGR2GRAY)
+        if self.full_decode:
+            try:
+                qr_info, qr_points, qr_data = self.detector.detectAndDecode(gray_frame)
+            except:
+                qr_info = None
+            self.decodes += 1
+            visible = []
+            if qr_info is not None and len(qr_info):
+                visible.append((qr_info,qr_points))
+            self._update_events(frame_index,gray_frame.shape,visible)
+        else:
+            # cheap finder detection + tracking, decodes only when a new code shows up
+            visible = self.tracker.process(frame_index,gray_frame)
+            if self.end is not None:
+                # past the segment, only the codes that come from it
+                visible = [(t["data"],t["quad"]) for t in self.tracker.tracks if t["entry"] < self.end]
+        for qr_info, qr_points in visible:
+            qr_info = int(qr_info)
+            print(f'frame {frame_index:06d}: QR detected: {qr_info:03d}',flush=True)
+            qr_points = np.squeeze(np.round(qr_points).astype(int))
+            csv_row = [frame_index,qr_info]
+            csv_row.extend(qr_points.ravel().tolist())
+            self.rows.append(csv_row)
+        self.frames += 1
+
+    def _update_events(self, frame_index, shape, visible):
+        h, w = shape[:2]
+        seen = dict()
+        for data, quad in visible:
+            c = np.squeeze(quad).reshape(-1,2).mean(axis=0)
+            d = np.hypot(c[0]-w/2,c[1]-h/2)
+            e = self.open_events.pop(data,None)
+            if e is None or e["exit"] != frame_index - 1:
+                if e is not None:
+                    self.events.append(e)
+                e = {"data": data, "entry": frame_index, "center": frame_index, "exit": frame_index, "center_dist": d}
+            e["exit"] = frame_index
+            if d < e["center_dist"]:
+                e["center"] = frame_index
+                e["center_dist"] = d
+            seen[data] = e
+        # codes not seen in this frame have left
+        self.events.extend(self.open_events.values())
+        self.open_events = seen
+
+    def more(self, frame_index, end):
+        self.end = end
+        if self.last_index is None or frame_index != self.last_index + 1:
+            return False
+        return any(t["entry"] < end for t in self.tracker.tracks)
+
+    def result(self):
+        if self.full_decode:
+            events = sorted(self.events + list(self.open_events.values()),key=lambda e: e["entry"])
+            return self.rows, events, self.frames, self.decodes
+        events = self.tracker.finish()
+        if self.end is not None:
+            events = [e for e in events if e["entry"] < self.end]
+        return self.rows, events, self.frames, self.tracker.decodes
 
 
 if __name__ == "__main__":
@@ -30,12 +150,22 @@ if __name__ == "__main__":
     #
     ap.add_argument("-i","--input",type=str,required=True,help="video de entrada.")
     ap.add_argument("-o","--output", type=str, required=True,help="CSV de salida")
+    ap.add_argument("-e","--events", type=str, default=None,
+                    help="CSV de salida con los frames de entrada, centro y salida de cada código.")
+    ap.add_argument("-F","--full-decode", action="store_true",
+                    help="Run the full QR detector/decoder on every frame instead of detect-then-track (much slower).")
+    ap.add_argument("-k","--backend", type=str, default="opencv", choices=BACKENDS,
+                    help="Video decoding backend (ffmpeg needs the ffmpeg executable).")
+    ap.add_argument("-p","--proxy", action="store_true",
+                    help="Use the proxy of the video (see proxy.py) to find the frames where codes may be visible, and decode only those. "
+                         f"Codes whose finder patterns are smaller than {PROXY_MIN_FINDER} proxy pixels (24 video pixels for a 1/8 proxy) are missed.")
+    ap.add_argument('-j',"--jobs", type=int, default=os.cpu_count(),
+                    help="Number of processes; the video is split in as many keyframe aligned segments, decoded in parallel.")
+    ap.add_argument('-I','--qr-index', type=str, default=None,
+                    help="SQLite index where the QR codes seen are also recorded (see qrindex.py), e.g. <datadir>/qr_index.sqlite.")
     args = ap.parse_args()
     csv_fname    = args.output
     input_fname  = args.input
-    csv_file = open(csv_fname,'w')
-    csv_writer = csv.writer(csv_file,delimiter=',')
-    csv_writer.writerow(('frame','data','x1', 'y1', 'x2','y2','x3','y3','x4','y4'))
     cap = cv2.VideoCapture(input_fname)
     nframes= int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     print("number of frames:",nframes)
@@ -43,36 +173,63 @@ if __name__ == "__main__":
     print("input frame height",h)
     w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     print("input frame width",w)
-    frame = np.empty((h,w,3))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+    qr_index = None
+    if args.qr_index:
+        qr_index = QRIndex(args.qr_index)
+        video_id = qr_index.video(input_fname,fps)
 
-    frame_index = 0
-    qr_detector = cv2.QRCodeDetector()
-    # Loop until the end of the video
-    while cap.isOpened(): # ----- loop over frames
-        ret, frame = cap.read(frame)
-        if not ret:
-            print('End of stream reached.')
-            break
+    t0 = time.time()
+    candidates = None
+    if args.proxy:
+        proxy = load_proxy(input_fname)
+        if proxy is None:
+            print(f"WARNING: {input_fname} has no proxy (run proxy.py); decoding every frame.")
+        else:
+            candidates = candidate_frames(proxy)
+            print(f"NOTE: codes whose finder patterns are under {PROXY_MIN_FINDER*proxy.rescale_factor} pixels are not seen in the proxy.")
+            print(f"{len(candidates)} candidate frames out of {len(proxy)} ({time.time()-t0:.1f}s)")
 
-        h,w,_ = frame.shape
-#        color_frame = cv2.resize(frame,(w//res_fac,h//res_fac))
-#        color_frame = np.flip(np.array(color_frame),axis=2)            
-#        color_frame = fast_rot(color_frame,rot)
-#        hr,wr,_ = color_frame.shape
-#        color_frame = color_frame.astype(float)
-        gray_frame = np.mean(frame,axis=2)        
-        try:
-            qr_info, qr_points, qr_data = qr_detector.detectAndDecode(gray_frame)
-        except:
-            qr_info = None
-        if qr_info is not None and len(qr_info):
-            qr_info = int(qr_info)
-            print(f'frame {frame_index:06d}: QR detected: {qr_info:03d}')
-            qr_points = np.squeeze(np.round(qr_points).astype(int))
-            csv_row = [frame_index,qr_info]
-            csv_row.extend(qr_points.ravel().tolist())
-            csv_writer.writerow(csv_row)
-        frame_index += 1
-        print('.',end='')
-        if not frame_index % 80:
-            print() 
+    csv_file = open(csv_fname,'w')
+    csv_writer = csv.writer(csv_file,delimiter=',')
+    csv_writer.writerow(('frame','data','x1', 'y1', 'x2','y2','x3','y3','x4','y4'))
+    processed = 0
+    decodes = 0
+    events = list()
+    carried = list() # rows past the end of the last segment, of codes tracked across it
+    # segments come back in frame order, so rows are written in frame order
+    for (ini,end),(rows,segment_events,frames,segment_decodes) in map_video(input_fname,
+                                                                           functools.partial(QRScan,args.full_decode),
+                                                                           jobs=args.jobs,
+                                                                           backend=args.backend,
+                                                                           pix_fmt="gray",
+                                                                           frames=candidates):
+        # a code seen by both segments is kept as tracked by the first one
+        seen = {(row[0],row[1]) for row in carried}
+        rows = sorted(carried + [row for row in rows if (row[0],row[1]) not in seen],key=lambda row: row[0])
+        carried = [row for row in rows if row[0] >= end]
+        rows = [row for row in rows if row[0] < end]
+        csv_writer.writerows(rows)
+        if qr_index is not None:
+            for row in rows:
+                qr_index.add(video_id,fps,row[0],row[1],np.array(row[2:]))
+            qr_index.flush()
+        events.extend(segment_events)
+        processed += frames
+        decodes += segment_decodes
+        print(f'frames {ini}-{end}: {frames} frames, {len(rows)} detections ({time.time()-t0:.1f}s)')
+    csv_writer.writerows(carried)
+    if qr_index is not None:
+        for row in carried:
+            qr_index.add(video_id,fps,row[0],row[1],np.array(row[2:]))
+    csv_file.close()
+    if qr_index is not None:
+        qr_index.close()
+    print(f'{processed} frames in {time.time()-t0:.1f}s, {decodes} decode attempts.')
+    if args.events is not None:
+        with open(args.events,'w') as events_file:
+            events_writer = csv.writer(events_file,delimiter=',')
+            events_writer.writerow(('data','entry_frame','center_frame','exit_frame'))
+            for e in merge_events(events):
+                events_writer.writerow((e["data"],e["entry"],e["center"],e["exit"]))
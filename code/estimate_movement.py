@@ -15,13 +15,14 @@ import skimage
 from skimage import io as imgio
 from skimage.filters import gaussian
 import matplotlib.pyplot as plt
+from framestore import open_frames
 
 
 if __name__ == "__main__":
 
     ap = argparse.ArgumentParser()
-    ap.add_argument("-i","--input", required=True, help="image list or folder.")
-    ap.add_argument("-d","--base_dir", required=True, help="base dir for files.")
+    ap.add_argument("-i","--input", required=True, help="frame store, image list or folder.")
+    ap.add_argument("-d","--base_dir", default=None, help="base dir for the files of an image list.")
     ap.add_argument("-w","--filter_radius", type=float, default=8)
 
     args = ap.parse_args()
@@ -30,19 +31,9 @@ if __name__ == "__main__":
         sys.exit(1)
     
     #
-    # detect type of input
+    # input may be a frame store (read straight from memory mapped chunks), a folder or a list
     #
-    input_files = list()
-    if os.path.isdir(args.input):
-        input_files = [os.path.join(args.base_dir,f) for f in os.listdir(args.input) if f.endswith(".jpg") or f.endswith(".png")]
-    else:
-        _,ext = os.path.splitext(args.input)
-        extl = ext.lower()
-        if extl == '.list':
-            with open(args.input,'r') as fl:
-                input_files = [l.strip() for l in fl.readlines()]
-        else:
-            print("Input must be a list or a folder.")
+    input_files, read_frame = open_frames(args.input,args.base_dir)
 
     print('Images to process:',len(input_files))
 
@@ -59,12 +50,12 @@ if __name__ == "__main__":
     yi = 0
     x = list()
     y = list()
-    for i,input_rel_path in enumerate(input_files):
+    for i,input_path in enumerate(input_files):
         x.append(xi)
         y.append(yi)
-        input_abs_path = os.path.join(args.base_dir,input_rel_path)
-        #print(f'{i+1}/{len(input_files)}: {input_abs_path}')
-        input_frame = np.squeeze(skimage.img_as_float(imgio.imread(input_abs_path))[:,:,1])
+        #print(f'{i+1}/{len(input_files)}: {input_path}')
+        # green channel only (from a frame store this only touches the mapped pages we need)
+        input_frame = skimage.img_as_float(read_frame(i)[:,:,1])
         h,w = input_frame.shape
         #input_frame = skimage.transform.resize(input_frame,(h,w))
         h,w = input_frame.shape
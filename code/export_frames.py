@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Exports the frames of a frame store (see framestore.py) as one JPEG (or PNG) file per frame,
+named as extract.py would have named them (<prefix>_frame_NNNNNNN.jpg).
+"""
+
+# importing the necessary libraries
+import argparse
+import os
+import sys
+import time
+from framestore import FrameStore, is_store, STORE_SUFFIX
+from imgwriter import ImageWriter
+
+
+if __name__ == "__main__":
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i","--input", type=str, required=True, help="frame store (directory ending in .frames).")
+    ap.add_argument("-o","--output-dir", type=str, default=None, help="output directory (defaults to the one containing the store).")
+    ap.add_argument("-p","--prefix", type=str, default=None, help="file name prefix (defaults to the name of the store).")
+    ap.add_argument("-e","--ext", type=str, default=".jpg", help="output file extension (.jpg or .png).")
+    ap.add_argument("-q","--quality", type=int, default=90, help="JPEG quality.")
+    ap.add_argument('-w','--writers', type=int, default=4,
+                    help="Number of threads encoding and writing output images (0 to write synchronously).")
+    args = ap.parse_args()
+    if not is_store(args.input):
+        print(f"{args.input} is not a frame store.")
+        sys.exit(1)
+    store_path = os.path.normpath(args.input)
+    output_dir = args.output_dir if args.output_dir is not None else os.path.dirname(store_path)
+    prefix = args.prefix
+    if prefix is None:
+        prefix = os.path.basename(store_path)
+        if prefix.endswith(STORE_SUFFIX):
+            prefix = prefix[:-len(STORE_SUFFIX)]
+    os.makedirs(output_dir,exist_ok=True)
+    save_args = {"quality": args.quality} if args.ext.lower() == ".jpg" else dict()
+    store = FrameStore(store_path)
+    print(f"exporting {len(store)} frames from {store_path} to {output_dir}")
+    t0 = time.time()
+    with ImageWriter(args.writers) as writer:
+        for i,frame in enumerate(store.frames):
+            # the memmap view is read only and stays valid, no need to copy it
+            writer.write(os.path.join(output_dir,f"{prefix}_frame_{frame:07d}{args.ext}"),store[i],**save_args)
+    print(f"{writer.written} images written in {time.time()-t0:.1f}s.")
@@ -19,8 +19,66 @@ import json
 import os
 import csv
 from vutils import *
+from qrtrack import QRTracker
+from ffsource import BACKENDS
+from illumination import make_gain_map, get_gain_map
+from imgwriter import ImageWriter
+from manifest import Manifest, params_hash
+from framestore import FrameStore, store_dirname
+from undistort import load_camera_model, get_undistort_maps, remap, source_points
+from qrindex import QRIndex
 
-def extract(input_dir, annotations, calibration, args, output_dir):
+
+def load_gain_map(calibration_dir, camera_calibration, res_fac, shape, rot=0):
+    """
+    Gain map of a camera for output frames of the given (already reduced and rotated) shape.
+    Gain maps are generated from the illumination model and cached in <calibration_dir>/gains.
+    """
+    h,w = shape[:2]
+    if rot % 180:
+        h,w = w,h
+    if "white_frame_parameters" in camera_calibration:
+        return get_gain_map(camera_calibration,(h,w),rot,cache_dir=os.path.join(calibration_dir,"gains"))
+    # old calibrations only have the full resolution white frame matrix
+    print('Loading white frame')
+    white_frame = np.load(os.path.join(calibration_dir,camera_calibration["white_frame_matrix"]))
+    white_frame = trans.resize(white_frame,(h,w))*(1/255)
+    white_frame = np.squeeze(fast_rot(white_frame[:,:,np.newaxis],rot))
+    return make_gain_map(white_frame,camera_calibration["white_balance"])
+
+
+QR_CSV_HEADER = ('camera','frame','data','x1', 'y1', 'x2','y2','x3','y3','x4','y4')
+
+
+def qr_csv_compatible(qr_csv_path):
+    """
+    Whether the rows of an existing QR CSV file follow QR_CSV_HEADER (files written before
+    the data column was filled in have the same header, but rows one column short)
+    """
+    with open(qr_csv_path,'r',newline='') as f:
+        rows = list(csv.reader(f,delimiter=','))
+    return len(rows) > 0 and tuple(rows[0]) == QR_CSV_HEADER and all(len(row) == len(QR_CSV_HEADER) for row in rows[1:])
+
+
+def drop_qr_rows(qr_csv_path, camera, frames):
+    """
+    Removes from a QR CSV file the rows of camera at frames (which are about to be
+    extracted again, and so reported again). Returns the number of rows removed.
+    """
+    frames = set(frames)
+    with open(qr_csv_path,'r',newline='') as f:
+        rows = list(csv.reader(f,delimiter=','))
+    kept = rows[:1] + [row for row in rows[1:] if not (int(row[0]) == camera and int(row[1]) in frames)]
+    if len(kept) == len(rows):
+        return 0
+    tmp_path = f"{qr_csv_path}.{os.getpid()}.tmp"
+    with open(tmp_path,'w',newline='') as f:
+        csv.writer(f,delimiter=',').writerows(kept)
+    os.replace(tmp_path,qr_csv_path)
+    return len(rows) - len(kept)
+
+
+def extract(input_dir, annotations, calibration, args, output_dir, calibration_dir):
 
     take = annotations["take"]
     part = args["part"]
@@ -36,21 +94,48 @@ def extract(input_dir, annotations, calibration, args, output_dir):
         os.makedirs(output_dir,exist_ok=True)
     frames_in_seconds = args["seconds"]
     #
+    # the manifest records every image written, so that an interrupted (or repeated)
+    # extraction only does the frames that are missing or whose parameters changed
+    #
+    restart = args.get("restart",False)
+    manifest = Manifest(output_dir,restart=restart)
+    if len(manifest.entries):
+        print(f"resuming: {len(manifest.entries)} images already in manifest")
+    #
     # we store the QR info in a CSV table along with the files
     #
+    csv_writer = None
+    resume_csv = False
     if args["create_csv"]:
         qr_csv_path = os.path.join(output_dir,'qr.csv')
-        qr_csv_file = open(qr_csv_path,'w')
-        print('Creating csv file ',qr_csv_path)
+        resume_csv = not restart and os.path.exists(qr_csv_path)
+        if resume_csv and not qr_csv_compatible(qr_csv_path):
+            # do not mix two layouts in one file: keep the old one aside and start again
+            old_csv_path = os.path.join(output_dir,f'qr.{time.strftime("%Y%m%d-%H%M%S")}.old.csv')
+            os.replace(qr_csv_path,old_csv_path)
+            print(f"WARNING: {qr_csv_path} has an older layout; moved to {old_csv_path}. "
+                  "The frames already extracted will not have QR rows in the new file.")
+            resume_csv = False
+        qr_csv_file = open(qr_csv_path,'a' if resume_csv else 'w',newline='')
+        print('Appending to csv file ' if resume_csv else 'Creating csv file ',qr_csv_path)
         csv_writer = csv.writer(qr_csv_file,delimiter=',')
-        csv_writer.writerow(('camera','frame','data','x1', 'y1', 'x2','y2','x3','y3','x4','y4'))
+        if not resume_csv:
+            csv_writer.writerow(QR_CSV_HEADER)
+    #
+    # and in the QR index of all the acquisitions
+    #
+    qr_index_fname = args.get("qr_index")
+    qr_index = QRIndex(qr_index_fname) if qr_index_fname else None
     print("extracting frames to output directory:",output_dir)
+    #
+    # frames are encoded and written in the background
+    #
+    writer = ImageWriter(args["writers"],checksum=True)
     print("skipping every ",skip,"frames","reduced by a factor of ",res_fac)
     offset = compute_offsets(annotations)
-    if args["reference"] == 2:
+    if args.get("reference",1) == 2:
         offset = [offset[0]-offset[1],0]
     print(f"offset: camera 1 {offset[0]} camera 2 {offset[1]}")
-    # white frame
     for c in range(1,ncam+1):
         camera_id = f"camera{c}"
         camera_name = calibration[camera_id]["name"]
@@ -62,15 +147,9 @@ def extract(input_dir, annotations, calibration, args, output_dir):
         final_frame = args["fin_data_frame"]
         if final_frame <= 0:
             final_frame = 1000000000
-        frame = None
-        white_frame = None
-        n = 0
-        t0 = time.time()
-        nframes = [list(),list()]
         print("="*80)
         print(f"camara {camera_name}")
         print(f"parte {part} ")
-        white_balance = calibration[camera_id]["white_balance"]
         fps = calibration[camera_id]["fps"]
         if frames_in_seconds:
             ini_frame = int(ini_frame*fps)
@@ -82,111 +161,114 @@ def extract(input_dir, annotations, calibration, args, output_dir):
         if not os.path.exists(input_fname):
             print(f'ERROR: no se encuentra video {input_fname}.')
             break
+        print(f'grabbing frames {ini_frame} to {final_frame}')
 
-        cap = cv2.VideoCapture(input_fname)
-        nframes= int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        print("number of frames:",nframes)
-        h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        print("input frame height",h)
-        w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        print("input frame width",w)
-        frame = np.empty((h,w,3))
         #
-        # ningun metodo de posicionamiento parece andar 100% bien así que 
-        # voy a hacerlo a lo bestia y leer todos los frames iniciales hasta llegar al objetivo
+        # lens undistortion (or stereo rectification) replaces the reduction by a remap
         #
-        print(f'grabbing frames {ini_frame} to {final_frame}')
-        frame_index = 0
-        print(f'skipping initial frames')
-        while cap.isOpened() and frame_index < ini_frame:
-            res = cap.read(frame) # do not decode
-            if not res:
-                print(f'Fin de stream en frame {frame_index}')
-                break
-            if not frame_index % 1000:
-                print(f'frame {frame_index}')
-            frame_index += 1
+        model = None
+        if args.get("undistort"):
+            model = load_camera_model(calibration_dir,c,stereo=args["undistort"]=="stereo",rot=rot)
+        probe = cv2.VideoCapture(input_fname)
+        nframes = int(probe.get(cv2.CAP_PROP_FRAME_COUNT))
+        source_shape = (int(probe.get(cv2.CAP_PROP_FRAME_HEIGHT)),int(probe.get(cv2.CAP_PROP_FRAME_WIDTH)))
+        probe.release()
+        video_id = qr_index.video(input_fname,fps) if qr_index is not None else None
+
+        def report_qr(item,qr_info,qr_points,c=c,fps=fps,video_id=video_id,rot=rot,model=model,source_shape=source_shape):
+            frame_index = item["index"]
+            qr_info = int(qr_info)
+            frame_time_s = frame_index / fps
+            frame_time_min = int(np.floor(frame_time_s / 60))
+            frame_time_s -= frame_time_min*60
+            print(f'frame {frame_index:06d} (time {frame_time_min:02d}:{frame_time_s:5.2f}s: QR detected: {qr_info:03d}')
+            if qr_index is not None:
+                # the index holds corners in pixels of the source video, whatever the extraction
+                qr_index.add(video_id,fps,frame_index,qr_info,source_points(qr_points,source_shape,res_fac,rot,model))
+            qr_points = np.squeeze(np.round(qr_points).astype(int))
+            if csv_writer is not None:
+                csv_row = [c,frame_index,qr_info]
+                csv_row.extend(qr_points.ravel().tolist())
+                csv_writer.writerow(csv_row)
         #
-        # create QR code detector instance
+        # decode (seek through the frame index, grab-only dropped frames) -> reduce, RGB, rotate
+        # -> rectify illumination and white balance -> detect QR codes -> crop -> save
         #
-        qr_detector = cv2.QRCodeDetector()
-        # Loop until the end of the video
-        while cap.isOpened() and frame_index < min(final_frame,nframes): # ----- loop over frames
-            ret, frame = cap.read(frame)
-            if not ret:
-                print('End of stream reached.')
-                break
-
-            n = frame_index - ini_frame
-            if n > 0 and n % skip:
-                frame_index += 1
-                print('x',end='')
-                continue
-            else:
-                print('o',end='')
-            if not n % 10:
-                print()
-            h,w,_ = frame.shape
-            color_frame = cv2.resize(frame,(w//res_fac,h//res_fac))
-            color_frame = np.flip(np.array(color_frame),axis=2)            
-            color_frame = fast_rot(color_frame,rot)
-            hr,wr,_ = color_frame.shape
-            color_frame = color_frame.astype(float)
-            
-            if white_frame is None:
-                print('Loading white frame')
-                top_crop = hr*args["top_crop"]//100
-                bottom_crop = hr*(100-args["bottom_crop"])//100
-                print("uncropped frame size: h=",hr,"w=",wr)
-                print("crop: top",top_crop, "bottom",bottom_crop)
-                white_frame = np.load(os.path.join(calibration_dir,calibration[camera_id]["white_frame_matrix"]))
-                hw,ww = white_frame.shape
-                white_frame = trans.resize(white_frame,(hw//res_fac,ww//res_fac))*(1/255)
-            #
-            # apply rectification
-            #
-            color_frame[:,:,0] = (color_frame[:,:,0]/white_frame)*(255/white_balance["red"]) # both white balance and white frame are 0-255
-            color_frame[:,:,1] = (color_frame[:,:,1]/white_frame)*(255/white_balance["green"])
-            color_frame[:,:,2] = (color_frame[:,:,2]/white_frame)*(255/white_balance["blue"])            
-            color_frame = np.maximum(0,np.minimum(255,color_frame)).astype(np.uint8)
+        camera_calibration = calibration[camera_id]
+        extras = dict()
+        if args["crude"]:
+            extras = {"crude":"_crude","image":"_refined"}
+        # everything that changes the contents of the output images
+        params = params_hash({"rescale_factor":res_fac,"rot":rot,
+                              "undistort":model["key"] if model is not None else None,
+                              "top_crop":args["top_crop"],"bottom_crop":args["bottom_crop"],
+                              "crude":args["crude"],"backend":args["backend"],
+                              "white_balance":camera_calibration["white_balance"],
+                              "white_frame_parameters":camera_calibration.get("white_frame_parameters"),
+                              "white_frame_matrix":camera_calibration.get("white_frame_matrix")})
+        planned = range(ini_frame,min(final_frame,nframes),skip)
+        if args.get("format","jpg") == "store":
             #
-            # detect QR code, if any
+            # raw frames go to chunked frame stores (one per kind of image), which are
+            # appended to when resuming, unless they were produced with other parameters
             #
-            try:
-                qr_info, qr_points, qr_data = qr_detector.detectAndDecode(color_frame[:,:,1])
-            except:
-                qr_info = ""
-            if qr_info is not None and len(qr_info):
-                qr_info = int(qr_info)
-                frame_time_s = frame_index / fps
-                frame_time_min = int(np.floor(frame_time_s / 60))
-                frame_time_s -= frame_time_min*60
-                print(f'frame {frame_index:06d} (time {frame_time_min:02d}:{frame_time_s:5.2f}s: QR detected: {qr_info:03d}')
-                qr_points = np.squeeze(np.round(qr_points).astype(int))
-                if args["create_csv"]:
-                    csv_row = [c+1,frame_index]
-                    csv_row.extend(qr_points.ravel().tolist())
-                    csv_writer.writerow(csv_row)
-            #
-            # crop and save frame
-            #
-            if top_crop >0 or bottom_crop < hr:
-                color_frame = color_frame[top_crop:bottom_crop,:,:]
-            frame_name = f'{camera_name}_frame_{frame_index:07d}'
-            imgio.imsave(os.path.join(output_dir,frame_name+'.jpg'),color_frame,quality=90)
-            if args["crude"]:
-                crude_frame = cv2.resize(frame,(w//res_fac,h//res_fac))
-                crude_frame = np.flip(np.array(crude_frame),axis=2)            
-                crude_frame = fast_rot(crude_frame,rot)
-                imgio.imsave(os.path.join(output_dir,frame_name+'_crude.jpg'),crude_frame,quality=90)
-                imgio.imsave(os.path.join(output_dir,frame_name+'_refined.jpg'),color_frame,quality=90)
-            else:
-                imgio.imsave(os.path.join(output_dir,frame_name+'.jpg'),color_frame,quality=90)
-
-            frame_index += 1
-        cap.release()
-        # -------- end for: we have read all parts from this camera
+            stores = dict()
+            for key,suffix in ([("image","")] if not args["crude"] else [("image","_refined"),("crude","_crude")]):
+                store_path = store_dirname(output_dir,camera_name+suffix)
+                store = FrameStore(store_path,"w" if restart else "a",params=params)
+                if store.stored_params != params and len(store):
+                    print(f"parameters changed, rewriting {store_path}")
+                    store = FrameStore(store_path,"w",params=params)
+                stores[key] = store
+            done = set.intersection(*[set(store.frames.tolist()) for store in stores.values()])
+            todo = [f for f in planned if f not in done]
+            sink = FrameStoreSink(stores)
+        else:
+            sink = ImageSink(writer,output_dir,camera_name,extras,manifest=manifest,params=params,quality=90)
+            todo = [f for f in planned if not manifest.done(sink.frame_files(f),params,args.get("verify",False))]
+        print(f"{len(planned)-len(todo)} of {len(planned)} frames already done")
+        if csv_writer is not None and resume_csv and len(todo):
+            # frames done again report their codes again
+            qr_csv_file.close()
+            dropped = drop_qr_rows(qr_csv_path,c,todo)
+            if dropped:
+                print(f"dropped {dropped} rows of frames to be extracted again from {qr_csv_path}")
+            qr_csv_file = open(qr_csv_path,'a',newline='')
+            csv_writer = csv.writer(qr_csv_file,delimiter=',')
+        if not len(todo):
+            sink.close()
+            continue
+        source = VideoSource(input_fname,ini_frame,final_frame,skip,args["backend"],res_fac,rot,
+                             use_index=not args["no_index"],frames=todo)
+        if model is None:
+            stages = [ReduceStage(res_fac,rot)]
+            gain_fn = lambda shape: load_gain_map(calibration_dir,camera_calibration,res_fac,shape,rot)
+        else:
+            stages = [RemapStage(lambda shape,transformed,model=model,rot=rot: get_undistort_maps(model,shape,res_fac,rot,transformed))]
+            # the gain map is defined on the distorted frame: it is corrected once, like the frames
+            gain_fn = lambda shape,model=model,rot=rot,camera_calibration=camera_calibration: \
+                remap(load_gain_map(calibration_dir,camera_calibration,res_fac,shape,rot),get_undistort_maps(model,shape,res_fac,rot))
+        if args["crude"]:
+            stages.append(CopyStage("crude"))
+        stages.append(RectifyStage(gain_fn))
+        stages.append(QRStage(QRTracker(),report_qr))
+        stages.append(CropStage(args["top_crop"],args["bottom_crop"]))
+        pipeline = Pipeline(source,stages,sink,threaded=args["threaded"])
+        try:
+            pipeline.run()
+        finally:
+            sink.close() # frames already stored stay usable if we crash
+        pipeline.report()
+        if qr_index is not None:
+            qr_index.flush()
         # end for: we have processed all cameras
+    try:
+        writer.close()
+    finally:
+        manifest.close()
+        if qr_index is not None:
+            qr_index.close()
+    print(f"{writer.written} images written.")
     if args["create_csv"]:
         qr_csv_file.close()
     # end function    
@@ -226,13 +308,28 @@ if __name__ == "__main__":
     ap.add_argument('-T',"--top-crop", type=int,  default=0, help="Crop the top T%% pixels from the output image. This does not affect QR detection as it is done after that stage.")
     ap.add_argument('-B',"--bottom-crop", type=int,  default=0, help="Crop the top T%% pixels from the output image. This does not affect QR detection as it is done after that stage.")
     ap.add_argument('-v','--create-csv',action='store_true')
+    ap.add_argument('-I','--qr-index', type=str, default=None,
+                    help="SQLite index where the QR codes seen are also recorded (see qrindex.py), e.g. <datadir>/qr_index.sqlite.")
     ap.add_argument('-x','--crude',action="store_true",help='Save non-rectified frames as well. For comparison.')
+    ap.add_argument('-k','--backend', type=str, default="opencv", choices=BACKENDS,
+                    help="Video decoding backend. ffmpeg reduces, rotates and converts frames inside the decoder (needs the ffmpeg executable).")
+    ap.add_argument('-P','--threaded', action="store_true",
+                    help="Run each stage of the pipeline (decode, rectify, QR, ...) on its own thread.")
+    ap.add_argument('-w','--writers', type=int, default=4,
+                    help="Number of threads encoding and writing output images (0 to write synchronously).")
+    ap.add_argument('-n','--no-index',action="store_true",help='Do not use (or build) the frame index; seek by decoding every initial frame.')
+    ap.add_argument('-U','--undistort', type=str, default=None, choices=("lens","stereo"),
+                    help="Correct lens distortion with the calibration of calibrate_camera.py (lens) or also rectify the pair with that of calibrate_pair.py (stereo).")
+    ap.add_argument('-F','--format', type=str, default="jpg", choices=("jpg","store"),
+                    help="Output one JPEG file per frame (jpg) or a chunked raw frame store per camera (store; see framestore.py and export_frames.py).")
+    ap.add_argument('--restart',action="store_true",help='Ignore the output manifest and extract every frame again.')
+    ap.add_argument('--verify',action="store_true",help='When resuming, check the checksum of the images already extracted (slower).')
     args = vars(ap.parse_args())
     camera_a = args["camera_a"]
     camera_b = args["camera_b"]
     take     = args["take"]
     input_dir = os.path.join(args["datadir"],args["adqdir"])
-    annotations_file = os.path.join(input_dir,generate_annotations_filename(camera_a,camera_b,take))
+    annotations_file = os.path.join(input_dir,generate_annotations_filename(camera_a,camera_b))
     calibration_dir,_ = os.path.splitext(annotations_file) 
     calibration_dir = calibration_dir + ".calib"
     calibration_file = os.path.join(calibration_dir,"calibration.json")
@@ -260,5 +357,5 @@ if __name__ == "__main__":
             calibration = json.loads(fc.read())
             print("annotations:",json.dumps(annotations,indent="  "))
             print("calibration:",json.dumps(calibration,indent="  "))
-            extract(input_dir, annotations, calibration, args, output_dir)
+            extract(input_dir, annotations, calibration, args, output_dir, calibration_dir)
 
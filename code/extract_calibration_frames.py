@@ -19,6 +19,7 @@ import json
 import os
 import csv
 from vutils import *
+from imgwriter import ImageWriter
 
 
 
@@ -42,6 +43,7 @@ def extract(input_dir, annotations, args, calibration_dir):
     # we store the QR info in a CSV table along with the files
     #
     offset = compute_offsets(annotations)
+    writer = ImageWriter(args["writers"])
     # white frame
     for c in range(ncam):
         camera = cameras[c]
@@ -101,12 +103,13 @@ def extract(input_dir, annotations, args, calibration_dir):
             #color_frame = color_frame.astype(float)
             
             frame_name = f'{camera}_frame_{frame_index:07d}'
-            imgio.imsave(os.path.join(calibration_dir,frame_name+'.png'),color_frame,quality=4)
+            writer.write(os.path.join(calibration_dir,frame_name+'.png'),color_frame,quality=4)
             frame_index += 1
         print(f"finished with camera {camera}")    
         cap.release()
         # -------- end for: we have read all parts from this camera
         # end for: we have processed all cameras
+    writer.close()
     # end function    
 
 
@@ -123,6 +126,8 @@ if __name__ == "__main__":
                     help="segunda cámara")
     ap.add_argument('-r',"--rescale-factor", type=int, default=2,
                     help="Reduce output this many times (defaults to 2). ")
+    ap.add_argument('-w','--writers', type=int, default=4,
+                    help="Number of threads encoding and writing output images (0 to write synchronously).")
     args = vars(ap.parse_args())
     camera_a = args["camera_a"]
     camera_b = args["camera_b"]
@@ -5,173 +5,19 @@ This program takes one or two video inputs and already computed calibration info
 and extracts pairs of frames at given intervals, correcting the illumination and white balance
 using the calibration information.
 
-This one works on some installations. For some obscure reason, seeking within the MP4 stream
-will work sometimes and sometimes not, so a brute force seek must be donee.
-If possible, usee this one. It is WAY faster than reading every single frame.
-
+This used to be a copy of extract.py that seeked with CAP_PROP_POS_FRAMES instead of reading every
+initial frame. Now both seek through the frame index (see vindex.py) and share the same
+pipeline (see extract.extract and the pipeline stages in vutils.py); this is just the
+same extractor with its old defaults (rescale factor 4, frames always referred to camera 1).
 """
 
 # importing the necessary libraries
 import argparse
-import sys
-import time
-import numpy as np
-import cv2
-import matplotlib.pyplot as plt
-from skimage import io as imgio
-from skimage import transform as trans
 import json
 import os
-import csv
 from vutils import *
-
-def extract(input_dir, annotations, calibration, args, output_dir):
-    part = args["part"]
-    take = annotations["take"]
-    res_fac = args["rescale_factor"]
-    skip = args["skip"]
-    camera_b = annotations["camera_b"]
-    if camera_b is None:
-        ncam = 1
-    else:
-        ncam = 2
-    print("number of cameras",ncam)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir,exist_ok=True)
-
-    frames_in_seconds = args["seconds"]
-    #
-    # we store the QR info in a CSV table along with the files
-    #
-    if args["create_csv"]:
-        qr_csv_path = os.path.join(output_dir,'qr.csv')
-        qr_csv_file = open(qr_csv_path,'w')
-        print('Creating csv file ',qr_csv_path)
-        csv_writer = csv.writer(qr_csv_file,delimiter=',')
-        csv_writer.writerow(('camera','frame','data','x1', 'y1', 'x2','y2','x3','y3','x4','y4'))
-
-    print("extracting frames to output directory:",output_dir)
-    print("skipping every ",skip,"frames","reduced by a factor of ",res_fac)
-    offset = compute_offsets(annotations)
-    # white frame
-    for c in range(ncam):
-
-        camera = calibration[f"camera{c+1}"]["name"]
-
-        input_fname = os.path.join(input_dir,f'{camera}/{camera}_toma{take}_parte{part}.mp4')
-        print(input_fname)
-        if not os.path.exists(input_fname):
-            break
-
-        cap = cv2.VideoCapture(input_fname)
-        fps = cap.get(cv2.CAP_PROP_FPS) 
-        print("fps",fps)
-        nframes = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-        print("nframes:",nframes)
-        # initial frame is beyond this part
-        print("backend",cap.getBackendName())
-
-
-        ini_frame = args["ini_data_frame"]
-        if ini_frame < 0:
-            ini_frame = 0
-        final_frame = args["fin_data_frame"]
-        if final_frame <= 0:
-            final_frame = 1000000000
-
-        rot = annotations[f"rot{c+1}"]
-
-        frame = None
-        white_frame = None
-        n = 0
-        t0 = time.time()
-        print("="*80)
-        print(f"camera {camera}:")
-        white_balance = calibration[f"camera{c+1}"]["white_balance"]
-        if frames_in_seconds:
-            ini_frame = int(round(ini_frame*fps))
-            final_frame = int(round(final_frame*fps))
-        print("ini_frame",ini_frame,"fin_frame",final_frame,"offset",offset[c])
-        ini_frame += offset[c]
-        frame_index = ini_frame
-        print("-"*80)
-
-        ret = cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
-        #
-        # create QR code detector instance
-        #        
-        ret, frame = cap.read()
-
-        # Loop until the end of the video
-        qr_detector = cv2.QRCodeDetector()
-
-        while ret and (cap.isOpened()) and frame_index < min(final_frame,nframes): # ----- loop over frames
-            n = frame_index - ini_frame
-            frame_index += 1
-            if n > 0 and n % skip:
-                continue
-            h,w,_ = frame.shape
-            color_frame = cv2.resize(frame,(w//res_fac,h//res_fac))
-            color_frame = np.flip(np.array(color_frame),axis=2)                        
-            color_frame = fast_rot(color_frame,rot)
-            hr,wr,_ = color_frame.shape
-            color_frame = color_frame.astype(float)
-            if white_frame is None:
-                top_crop = hr*args["top_crop"]//100
-                bottom_crop = hr*(100-args["bottom_crop"])//100
-                print("uncropped frame size: h=",hr,"w=",wr)
-                print("crop: top",top_crop, "bottom",bottom_crop)
-                white_frame = np.load(os.path.join(calibration_dir,calibration[f'camera{c+1}']["white_frame_matrix"]))
-                hw,ww = white_frame.shape
-                white_frame = trans.resize(white_frame,(hw//res_fac,ww//res_fac))*(1/255)
-            #
-            # apply rectification
-            #
-            color_frame[:,:,0] = (color_frame[:,:,0]/white_frame)*(255/white_balance["red"]) # both white balance and white frame are 0-255
-            color_frame[:,:,1] = (color_frame[:,:,1]/white_frame)*(255/white_balance["green"])
-            color_frame[:,:,2] = (color_frame[:,:,2]/white_frame)*(255/white_balance["blue"])            
-            color_frame = np.maximum(0,np.minimum(255,color_frame)).astype(np.uint8)
-            #
-            # detect QR code, if any
-            #
-            try:
-                qr_info, qr_points, qr_data = qr_detector.detectAndDecode(color_frame[:,:,1])
-            except:
-                qr_info = ""
-            if qr_info is not None and len(qr_info):
-                qr_info = int(qr_info)
-                frame_time_s = frame_index / fps
-                frame_time_min = int(np.floor(frame_time_s / 60))
-                frame_time_s -= frame_time_min*60
-                print(f'frame {frame_index:06d} (time {frame_time_min:02d}:{frame_time_s:5.2f}s: QR detected: {qr_info:03d}')
-                qr_points = np.squeeze(np.round(qr_points).astype(int))
-                if args["create_csv"]:
-                    csv_row = [c+1,frame_index]
-                    csv_row.extend(qr_points.ravel().tolist())
-                    csv_writer.writerow(csv_row)
-            #
-            # crop and save frame
-            #
-            if top_crop >0 or bottom_crop < hr:
-                color_frame = color_frame[top_crop:bottom_crop,:,:]
-            frame_name = f'camera{c+1}_frame_{frame_index:07d}'
-            imgio.imsave(os.path.join(output_dir,frame_name+'.jpg'),color_frame,quality=90)
-            if args["crude"]:
-                crude_frame = cv2.resize(frame,(w//res_fac,h//res_fac))
-                crude_frame = np.flip(np.array(crude_frame),axis=2)            
-                crude_frame = fast_rot(crude_frame,rot)
-                imgio.imsave(os.path.join(output_dir,frame_name+'_crude.jpg'),crude_frame,quality=90)
-                imgio.imsave(os.path.join(output_dir,frame_name+'_refined.jpg'),color_frame,quality=90)
-            else:
-                imgio.imsave(os.path.join(output_dir,frame_name+'.jpg'),color_frame,quality=90)
-            ret, frame = cap.read(frame)
-        cap.release()
-        # -------- end for: we have read all parts from this camera
-        print("finished with camera ",c+1)    
-        # end for: we have processed all cameras
-    if args["create_csv"]:
-        qr_csv_file.close()
-    # end function    
+from ffsource import BACKENDS
+from extract import extract
 
 
 if __name__ == "__main__":
@@ -206,13 +52,29 @@ if __name__ == "__main__":
     ap.add_argument('-T',"--top-crop", type=int,  default=0, help="Crop the top T%% pixels from the output image. This does not affect QR detection as it is done after that stage.")
     ap.add_argument('-B',"--bottom-crop", type=int,  default=0, help="Crop the top T%% pixels from the output image. This does not affect QR detection as it is done after that stage.")
     ap.add_argument('-v','--create-csv',action='store_true')
+    ap.add_argument('-I','--qr-index', type=str, default=None,
+                    help="SQLite index where the QR codes seen are also recorded (see qrindex.py), e.g. <datadir>/qr_index.sqlite.")
     ap.add_argument('-x','--crude',action="store_true",help='Save non-rectified frames as well. For comparison.')
+    ap.add_argument('-k','--backend', type=str, default="opencv", choices=BACKENDS,
+                    help="Video decoding backend. ffmpeg reduces, rotates and converts frames inside the decoder (needs the ffmpeg executable).")
+    ap.add_argument('-P','--threaded', action="store_true",
+                    help="Run each stage of the pipeline (decode, rectify, QR, ...) on its own thread.")
+    ap.add_argument('-w','--writers', type=int, default=4,
+                    help="Number of threads encoding and writing output images (0 to write synchronously).")
+    ap.add_argument('-U','--undistort', type=str, default=None, choices=("lens","stereo"),
+                    help="Correct lens distortion with the calibration of calibrate_camera.py (lens) or also rectify the pair with that of calibrate_pair.py (stereo).")
+    ap.add_argument('-F','--format', type=str, default="jpg", choices=("jpg","store"),
+                    help="Output one JPEG file per frame (jpg) or a chunked raw frame store per camera (store; see framestore.py and export_frames.py).")
+    ap.add_argument('--restart',action="store_true",help='Ignore the output manifest and extract every frame again.')
+    ap.add_argument('--verify',action="store_true",help='When resuming, check the checksum of the images already extracted (slower).')
     args = vars(ap.parse_args())
+    args["reference"] = 1
+    args["no_index"] = False
     camera_a = args["camera_a"]
     camera_b = args["camera_b"]
     take     = args["take"]
     input_dir = os.path.join(args["datadir"],args["adqdir"])
-    annotations_file = os.path.join(input_dir,generate_annotations_filename(camera_a,camera_b,take))
+    annotations_file = os.path.join(input_dir,generate_annotations_filename(camera_a,camera_b))
     calibration_dir,_ = os.path.splitext(annotations_file) 
     calibration_dir = calibration_dir + ".calib"
     calibration_file = os.path.join(calibration_dir,"calibration.json")
@@ -240,5 +102,5 @@ if __name__ == "__main__":
             calibration = json.loads(fc.read())
             #print("annotations:",json.dumps(annotations,indent="  "))
             #print("calibration:",json.dumps(calibration,indent="  "))
-            extract(input_dir, annotations, calibration, args, output_dir)
+            extract(input_dir, annotations, calibration, args, output_dir, calibration_dir)
 
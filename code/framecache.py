@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Decoded frame cache with a background decoder, for interactive tools (annotate.py).
+
+Seeking and decoding a full resolution frame takes hundreds of milliseconds, so doing it
+on the GUI thread on every key press freezes the interface. FrameCache owns the video
+capture and decodes on its own thread, keeping the last decoded frames (already converted
+to RGB, scaled for display and rotated) in a bounded LRU cache. Whenever a frame is
+requested, the next frames in the direction of navigation are queued too, so that they are
+ready by the time the user asks for them.
+
+Seeks go through the frame index (see vindex.py), which is exact; when the requested frame
+is a little ahead of the current position, we just decode forward instead of seeking.
+
+If the video has a proxy (see proxy.py), peek() returns at once the proxy frame, upscaled,
+while the full resolution frame is decoded; when the display is not larger than the proxy,
+frames are taken from it and the video is not decoded at all.
+"""
+
+import collections
+import threading
+import numpy as np
+import cv2
+from vindex import load_index, seek_frame
+from vutils import fast_rot
+
+CAPACITY = 64   # frames kept in memory (per camera)
+PREFETCH = 8    # frames decoded ahead in the direction of navigation
+
+
+class FrameCache():
+    '''
+    get(frame, step) returns the display ready frame number frame (waiting for it if
+    needed) and schedules frame+step, frame+2*step, ... for decoding in the background.
+    The capture passed belongs to the cache from then on.
+    '''
+    def __init__(self, cap, fname=None, rot=0, scale=1.0, capacity=CAPACITY, prefetch=PREFETCH, proxy=None):
+        self.cap = cap
+        self.rot = rot
+        self.scale = scale
+        w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.size = (max(1, int(w*scale)), max(1, int(h*scale))) # display size before rotating
+        self.proxy = proxy
+        # the proxy is enough when the display is not larger than it
+        self.from_proxy = proxy is not None and scale*proxy.rescale_factor <= 1
+        self.capacity = max(capacity, prefetch + 1)
+        self.prefetch = prefetch
+        self.nframes = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.index = None
+        if fname is not None:
+            try:
+                self.index = load_index(fname)
+                self.nframes = len(self.index["pts"])
+            except (OSError, ValueError, KeyError) as e:
+                print(f"WARNING: no frame index for {fname} ({e}); seeking may be inexact")
+        self.next_frame = 0  # frame that the next cap.read() returns
+        self.frames = collections.OrderedDict()
+        self.wanted = list() # frames to decode, most urgent first
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="frame-cache", daemon=True)
+        self.thread.start()
+
+    def _schedule(self, frame, step):
+        # called with the lock held
+        wanted = [frame]
+        if step:
+            wanted.extend(frame + k*step for k in range(1, self.prefetch + 1))
+        self.wanted = [f for f in wanted if 0 <= f < self.nframes and f not in self.frames]
+        self.cond.notify_all()
+
+    def request(self, frame, step=0):
+        """
+        Schedules frame (and the following ones in steps of step) for decoding
+        """
+        with self.cond:
+            self._schedule(frame, step)
+
+    def peek(self, frame):
+        """
+        Returns at once (image, exact): the display ready frame if it was already decoded
+        (exact is True), otherwise its proxy frame (exact is False) or None if there is no
+        proxy. Does not schedule anything.
+        """
+        frame = max(0, min(self.nframes - 1, frame))
+        with self.cond:
+            image = self.frames.get(frame)
+            if image is not None:
+                self.frames.move_to_end(frame)
+                return image, True
+        if self.proxy is None or frame >= len(self.proxy):
+            return None, False
+        return self._from_proxy(frame), self.from_proxy
+
+    def _from_proxy(self, frame):
+        image = cv2.resize(self.proxy[frame], self.size, interpolation=cv2.INTER_AREA if self.from_proxy else cv2.INTER_LINEAR)
+        return np.ascontiguousarray(fast_rot(image, self.rot))
+
+    def get(self, frame, step=0):
+        """
+        Display ready (RGB, scaled, rotated) frame number frame, or None if it cannot be
+        decoded. Schedules the next prefetch frames in steps of step.
+        """
+        frame = max(0, min(self.nframes - 1, frame))
+        with self.cond:
+            self._schedule(frame, step)
+            while frame not in self.frames and not self.closed:
+                if frame not in self.wanted:
+                    return None # decoding failed
+                self.cond.wait()
+            image = self.frames.get(frame)
+            if image is not None:
+                self.frames.move_to_end(frame)
+            return image
+
+    def _seek(self, frame):
+        if frame == self.next_frame:
+            return
+        if self.index is not None:
+            keyframe = int(self.index["keyframe"][frame])
+            if self.next_frame < frame and self.next_frame >= keyframe:
+                # closer to decode forward than to go back to the keyframe
+                while self.next_frame < frame and self.cap.grab():
+                    self.next_frame += 1
+            else:
+                seek_frame(self.cap, self.index, frame)
+        else:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame)
+        self.next_frame = frame
+
+    def _decode(self, frame):
+        if self.from_proxy and frame < len(self.proxy):
+            return self._from_proxy(frame)
+        self._seek(frame)
+        ret, image = self.cap.read()
+        if not ret:
+            self.next_frame = -1 # unknown
+            return None
+        self.next_frame = frame + 1
+        h, w = image.shape[:2]
+        if self.scale != 1:
+            image = cv2.resize(image, (max(1, int(w*self.scale)), max(1, int(h*self.scale))), interpolation=cv2.INTER_AREA)
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        return np.ascontiguousarray(fast_rot(image, self.rot))
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.wanted and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                frame = self.wanted[0]
+            image = self._decode(frame)
+            with self.cond:
+                if self.wanted and self.wanted[0] == frame:
+                    self.wanted.pop(0)
+                elif frame in self.wanted:
+                    self.wanted.remove(frame)
+                if image is not None:
+                    self.frames[frame] = image
+                    while len(self.frames) > self.capacity:
+                        self.frames.popitem(last=False)
+                self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.cap.release()
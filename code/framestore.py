@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Chunked, memory mappable frame store.
+
+Writing one JPEG per extracted frame and decoding them all again in estimate_movement.py,
+stitch_frames.py, etc. means that most of the time of those programs goes into the JPEG
+codec. A FrameStore keeps the (already rectified, uint8) frames of a sequence as raw
+arrays instead:
+
+    <name>.frames/
+        index.json          shape, chunk size, and one row per frame:
+                            frame number, time (s), chunk, slot and the QR codes seen on it
+        chunk_00000.u8      up to chunk_frames frames, back to back (h x w x c uint8 each)
+        chunk_00001.u8
+        ...
+
+Readers open the chunks with np.memmap, so store[i] is a zero copy view of the i-th frame
+(frames are always presented sorted by frame number) and the OS page cache does the rest.
+
+Frames are appended to the current chunk file; the index is rewritten (atomically) every
+time a chunk is completed and on close(), so after a crash the store holds every frame up
+to the last completed chunk. Reopening a store for appending starts a new chunk, which is
+how extraction resumes (see extract.py). The store also remembers the parameters hash of
+the extraction that produced it (see manifest.py).
+
+JPEG files can still be produced from a store with export_frames.py.
+"""
+
+import json
+import os
+import numpy as np
+
+STORE_SUFFIX = ".frames"
+STORE_VERSION = 1
+CHUNK_FRAMES = 256
+INDEX_FNAME = "index.json"
+
+
+def store_dirname(output_dir, prefix):
+    return os.path.join(output_dir, prefix+STORE_SUFFIX)
+
+
+def is_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, INDEX_FNAME))
+
+
+class FrameStore():
+    '''
+    Opens (mode "r"), creates (mode "w") or appends to (mode "a") the frame store at path.
+    stored_params are the parameters recorded in an existing store (None for a new one);
+    when appending to a store that already has frames, params is not replaced by the
+    given one: the caller must compare both and rewrite the store (mode "w") if they differ.
+    '''
+    def __init__(self, path, mode="r", chunk_frames=CHUNK_FRAMES, params=None):
+        if mode not in ("r", "w", "a"):
+            raise ValueError(f"invalid mode {mode}")
+        self.path = path
+        self.mode = mode
+        self.chunk_frames = chunk_frames
+        self.params = params
+        self.stored_params = None
+        self.shape = None
+        self.nchunks = 0
+        self.rows = list()  # [frame, time, chunk, slot, qr]
+        self.maps = dict()  # chunk -> memmap
+        self.chunk_file = None
+        self.chunk_slots = 0
+        if mode == "w" or (mode == "a" and not is_store(path)):
+            os.makedirs(path, exist_ok=True)
+            for fname in os.listdir(path):
+                if fname.startswith("chunk_") or fname == INDEX_FNAME:
+                    os.remove(os.path.join(path, fname))
+        else:
+            self._load_index()
+        self._sort()
+
+    def _load_index(self):
+        with open(os.path.join(self.path, INDEX_FNAME), "r") as f:
+            index = json.load(f)
+        if index["version"] != STORE_VERSION:
+            raise ValueError(f"{self.path}: unsupported frame store version {index['version']}")
+        self.shape = tuple(index["shape"]) if index["shape"] is not None else None
+        self.chunk_frames = index["chunk_frames"]
+        self.nchunks = index["nchunks"]
+        self.rows = [list(r) for r in index["frames"]]
+        self.stored_params = index["params"]
+        # frames already stored keep the parameters they were produced with
+        if self.params is None or self.mode == "r" or len(self.rows):
+            self.params = self.stored_params
+
+    def _sort(self):
+        self.rows.sort(key=lambda r: r[0])
+        self.frames = np.array([r[0] for r in self.rows], dtype=np.int64)
+        self.times = np.array([r[1] for r in self.rows], dtype=np.float64)
+        self.qr = [r[4] for r in self.rows]
+
+    def _write_index(self):
+        index = {"version": STORE_VERSION, "shape": self.shape, "chunk_frames": self.chunk_frames,
+                 "nchunks": self.nchunks, "params": self.params, "frames": self.rows}
+        fname = os.path.join(self.path, INDEX_FNAME)
+        with open(fname+".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(fname+".tmp", fname)
+
+    def _chunk_fname(self, chunk):
+        return os.path.join(self.path, f"chunk_{chunk:05d}.u8")
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        """
+        i-th frame (in frame number order), as a read only view of the chunk memmap
+        """
+        _, _, chunk, slot, _ = self.rows[i]
+        m = self.maps.get(chunk)
+        if m is None:
+            nbytes = os.path.getsize(self._chunk_fname(chunk))
+            frame_bytes = int(np.prod(self.shape))
+            m = np.memmap(self._chunk_fname(chunk), dtype=np.uint8, mode="r",
+                          shape=(nbytes//frame_bytes,)+self.shape)
+            self.maps[chunk] = m
+        return m[slot]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def find(self, frame):
+        """
+        Position of frame number frame in the store, or -1 if it is not there
+        """
+        i = int(np.searchsorted(self.frames, frame))
+        return i if i < len(self.frames) and self.frames[i] == frame else -1
+
+    def append(self, frame, image, time=None, qr=None):
+        """
+        Appends image (uint8, all with the same shape) as frame number frame.
+        qr is a list of (data, quad) pairs (as given by QRTracker)
+        """
+        if self.mode == "r":
+            raise ValueError(f"{self.path} was opened read only")
+        if self.shape is None:
+            self.shape = tuple(image.shape)
+        elif tuple(image.shape) != self.shape:
+            raise ValueError(f"frame shape {image.shape} does not match store shape {self.shape}")
+        if self.chunk_file is None:
+            self.chunk_file = open(self._chunk_fname(self.nchunks), "wb")
+            self.nchunks += 1
+            self.chunk_slots = 0
+        self.chunk_file.write(np.ascontiguousarray(image, dtype=np.uint8).data)
+        codes = [] if qr is None else [[str(d), np.round(q).astype(int).ravel().tolist()] for d, q in qr]
+        self.rows.append([int(frame), time, self.nchunks-1, self.chunk_slots, codes])
+        self.chunk_slots += 1
+        if self.chunk_slots >= self.chunk_frames:
+            self._close_chunk()
+
+    def _close_chunk(self):
+        if self.chunk_file is not None:
+            self.chunk_file.close()
+            self.chunk_file = None
+            self._write_index()
+
+    def close(self):
+        if self.mode != "r":
+            self._close_chunk()
+            self._write_index()
+            self._sort()
+        self.maps = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def open_frames(path, base_dir=None):
+    """
+    Input of the post-processing programs: a frame store, an image folder, a single image
+    or a .list file with one image per line (relative to base_dir, if given).
+    Returns (list of file names, function i -> uint8 image). For a frame store the names
+    follow the same <prefix>_frame_NNNNNNN.jpg pattern as the JPEG files written by extract.py.
+    """
+    if is_store(path):
+        store = FrameStore(path)
+        prefix = os.path.basename(os.path.normpath(path))[:-len(STORE_SUFFIX)]
+        return [f"{prefix}_frame_{f:07d}.jpg" for f in store.frames], lambda i: store[i]
+    from skimage import io as imgio
+    if os.path.isdir(path):
+        fnames = sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".jpg") or f.endswith(".png"))
+    elif path.lower().endswith(".list"):
+        with open(path, "r") as fl:
+            fnames = [l.strip() for l in fl.readlines() if len(l.strip())]
+        if base_dir is not None:
+            fnames = [os.path.join(base_dir, f) for f in fnames]
+    elif path.lower().endswith(".jpg") or path.lower().endswith(".png"):
+        fnames = [path]
+    else:
+        raise ValueError(f"{path}: input must be a frame store, an image, a folder or a .list file")
+    return fnames, lambda i: imgio.imread(fnames[i])
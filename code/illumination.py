@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Illumination and white balance correction.
+
+The correction of a frame is a per pixel, per channel gain:
+
+    out[i,j,c] = in[i,j,c] * 255 / (white_frame[i,j] * white_balance[c])
+
+where white_frame is the (normalized, 0-1) illumination map and white_balance holds the
+mean R,G,B values (0-255) of the white calibration frames. Instead of dividing every frame
+by the white frame and by the white balance in separate float64 passes, we precompute the
+gain map once (per camera and resolution) and apply it with a fused kernel that works on
+horizontal bands of the frame in parallel and writes directly to a uint8 output.
+
+The gain map is stored as uint16 fixed point (GAIN_FRAC_BITS fractional bits, that is,
+gains up to 256 with a resolution of 1/256) or as float32.
+
+The white frame itself is not stored: compute_light_calibration.py fits a quadratic model
+of the illumination in normalized image coordinates and saves its six coefficients
+(white_frame_parameters in the calibration JSON). GainMaps evaluates the model for any
+resolution, rotation and crop on demand, and keeps the most recently used gain maps in
+memory and, if given a directory, on disk as float32 memory maps. All the programs should
+get their gain maps through get_gain_map().
+"""
+
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import numpy as np
+
+GAIN_FRAC_BITS = 8
+GAIN_ONE = 1 << GAIN_FRAC_BITS
+GAIN_MAX = (1 << 16) - 1
+TILE_ROWS = 64
+
+_pool = None
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = concurrent.futures.ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1),
+                                                      thread_name_prefix="illumination")
+    return _pool
+
+
+def make_gain_map(white_frame, white_balance, dtype=np.uint16):
+    """
+    Builds the h x w x 3 (RGB) gain map from a white frame (h x w, normalized to 0-1)
+    and the white balance dict {"red","green","blue"} (0-255).
+    dtype may be np.uint16 (fixed point) or np.float32.
+    """
+    inv_white_frame = 1/np.maximum(white_frame.astype(np.float32), 1e-3)
+    h, w = inv_white_frame.shape[:2]
+    gain = np.empty((h, w, 3), dtype=np.float32)
+    for c, color in enumerate(("red", "green", "blue")):
+        gain[:, :, c] = inv_white_frame*(255/white_balance[color])
+    if dtype == np.float32:
+        return gain
+    return to_fixed_point(gain)
+
+
+def to_fixed_point(gain):
+    """
+    Converts a float32 gain map to uint16 fixed point
+    """
+    fixed = np.multiply(gain, GAIN_ONE, dtype=np.float32)
+    np.clip(fixed, 0, GAIN_MAX, out=fixed)
+    return np.rint(fixed).astype(np.uint16)
+
+
+def _apply_tile(frame, gain, out, i0, i1):
+    f = frame[i0:i1]
+    g = gain[i0:i1]
+    if gain.dtype == np.uint16:
+        acc = f.astype(np.uint32)
+        acc *= g
+        acc += GAIN_ONE//2 # rounding
+        acc >>= GAIN_FRAC_BITS
+        np.minimum(acc, 255, out=acc)
+    else:
+        acc = f.astype(np.float32)
+        acc *= g
+        np.clip(acc, 0, 255, out=acc)
+    out[i0:i1] = acc
+
+
+def apply_gain(frame, gain, out=None, tile_rows=TILE_ROWS, parallel=True):
+    """
+    Applies a gain map (see make_gain_map) to a uint8 RGB frame.
+    The result is written to out (which may be frame itself), or to a new uint8 array.
+    Work is split in bands of tile_rows rows, processed in parallel (numpy releases the GIL)
+    so that temporaries are small and stay in cache.
+    """
+    if frame.shape != gain.shape:
+        raise ValueError(f"frame shape {frame.shape} does not match gain map shape {gain.shape}")
+    if out is None:
+        out = np.empty(frame.shape, dtype=np.uint8)
+    h = frame.shape[0]
+    bands = [(i0, min(h, i0+tile_rows)) for i0 in range(0, h, tile_rows)]
+    if not parallel or len(bands) == 1:
+        for i0, i1 in bands:
+            _apply_tile(frame, gain, out, i0, i1)
+    else:
+        futures = [_get_pool().submit(_apply_tile, frame, gain, out, i0, i1) for i0, i1 in bands]
+        for f in futures:
+            f.result()
+    return out
+
+
+def white_frame_model(parameters, shape, rot=0, crop=None):
+    """
+    Evaluates the quadratic illumination model a0 + a1 r + a2 c + a3 r^2 + a4 rc + a5 c^2
+    (r, c normalized row and column, 0-1) on a frame of shape (h,w), the shape of the
+    (reduced) frames *before* rotation; then rotates it by rot degrees (same convention as
+    vutils.fast_rot) and crops it to crop=(top,bottom,left,right), if given.
+    Returns a float32 map normalized to 0-1 (the model predicts 0-255 values).
+    """
+    a = np.asarray(parameters, dtype=np.float64)/255
+    h, w = shape
+    r = (np.arange(h)/h).reshape(-1, 1)
+    c = (np.arange(w)/w).reshape(1, -1)
+    white_frame = (a[0] + a[1]*r + a[2]*c + a[3]*r**2 + a[4]*(r*c) + a[5]*c**2).astype(np.float32)
+    rot = rot % 360
+    if rot == 90:
+        white_frame = np.flip(white_frame, axis=0).T
+    elif rot == 180:
+        white_frame = white_frame[::-1, ::-1]
+    elif rot == 270:
+        white_frame = np.flip(white_frame.T, axis=0)
+    elif rot != 0:
+        raise ValueError(f"only rotations multiple of 90 are supported (got {rot})")
+    if crop is not None:
+        top, bottom, left, right = crop
+        white_frame = white_frame[top:bottom, left:right]
+    return np.ascontiguousarray(white_frame)
+
+
+class GainMaps():
+    '''
+    LRU cache of gain maps, keyed by (calibration, shape, rotation, crop).
+    At most max_memory maps are kept in memory; if cache_dir is given, the float32 maps
+    are also kept there (at most max_disk files, least recently used ones are removed).
+    '''
+    def __init__(self, cache_dir=None, max_memory=8, max_disk=32):
+        self.cache_dir = cache_dir
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.maps = collections.OrderedDict()
+
+    def _disk_fname(self, key):
+        return os.path.join(self.cache_dir, f"gain_{key}.f32")
+
+    def _load(self, key, shape):
+        fname = self._disk_fname(key)
+        if not os.path.exists(fname) or os.path.getsize(fname) != np.prod(shape)*4:
+            return None
+        os.utime(fname) # mark as recently used
+        return np.memmap(fname, dtype=np.float32, mode="r", shape=shape)
+
+    def _store(self, key, gain):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fname = self._disk_fname(key)
+        tmp_fname = f"{fname}.{os.getpid()}.tmp"
+        gain.astype(np.float32).tofile(tmp_fname)
+        os.replace(tmp_fname, fname)
+        cached = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir)
+                  if f.startswith("gain_") and f.endswith(".f32")]
+        cached.sort(key=os.path.getmtime)
+        for old in cached[:max(0, len(cached)-self.max_disk)]:
+            os.remove(old)
+
+    def get(self, camera_calibration, shape, rot=0, crop=None, dtype=np.uint16):
+        """
+        Gain map (see make_gain_map) for frames of shape (h,w) before rotation,
+        rotated by rot and cropped to crop=(top,bottom,left,right)
+        """
+        parameters = [float(x) for x in camera_calibration["white_frame_parameters"]]
+        white_balance = {k: float(camera_calibration["white_balance"][k]) for k in ("red", "green", "blue")}
+        desc = {"parameters": parameters, "white_balance": white_balance, "shape": list(shape),
+                "rot": rot % 360, "crop": list(crop) if crop is not None else None}
+        key = hashlib.sha1(json.dumps(desc, sort_keys=True).encode("utf-8")).hexdigest()[:20]
+        mem_key = (key, np.dtype(dtype).str)
+        gain = self.maps.get(mem_key)
+        if gain is not None:
+            self.maps.move_to_end(mem_key)
+            return gain
+        gain32 = None
+        if self.cache_dir is not None:
+            h, w = shape if rot % 180 == 0 else (shape[1], shape[0])
+            if crop is not None:
+                h, w = crop[1]-crop[0], crop[3]-crop[2]
+            gain32 = self._load(key, (h, w, 3))
+        if gain32 is None:
+            gain32 = make_gain_map(white_frame_model(parameters, shape, rot, crop), white_balance, dtype=np.float32)
+            if self.cache_dir is not None:
+                self._store(key, gain32)
+        gain = gain32 if np.dtype(dtype) == np.float32 else to_fixed_point(gain32)
+        self.maps[mem_key] = gain
+        while len(self.maps) > self.max_memory:
+            self.maps.popitem(last=False)
+        return gain
+
+
+_gain_maps = dict()
+
+
+def get_gain_map(camera_calibration, shape, rot=0, crop=None, dtype=np.uint16, cache_dir=None):
+    """
+    Gain map of a camera for frames of shape (h,w) (reduced, before rotation), rotated by rot
+    and cropped to crop=(top,bottom,left,right), from the white_frame_parameters and
+    white_balance of its calibration. Maps are cached (see GainMaps), on disk in cache_dir if given.
+    """
+    cache = _gain_maps.get(cache_dir)
+    if cache is None:
+        cache = _gain_maps[cache_dir] = GainMaps(cache_dir)
+    return cache.get(camera_calibration, shape, rot, crop, dtype)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Bounded asynchronous image writer.
+
+Encoding a JPEG takes about as long as decoding, rectifying and analyzing a frame, so
+the extraction programs hand their output frames to an ImageWriter, which encodes and
+writes them on a pool of worker threads (the encoders release the GIL) while the main
+thread keeps decoding. At most max_pending images are in flight: when the queue is full,
+write() blocks until the oldest one is done (backpressure), so memory stays bounded.
+Images complete (and errors are raised) in the same order they were submitted.
+
+Usage:
+
+    with ImageWriter(nworkers=4) as writer:
+        for ...:
+            writer.write(fname, frame, quality=90)
+
+The image passed to write() must not be modified afterwards; pass a copy if the buffer
+is going to be reused.
+
+write() also accepts an on_done(fname, checksum) callback, called (from the thread that
+calls write/flush/close, in submission order) once the file is completely written. With
+checksum=True the workers compute the CRC32 of each written file; otherwise checksum is None.
+"""
+
+import collections
+import concurrent.futures
+import os
+import zlib
+from skimage import io as imgio
+
+
+def file_checksum(fname):
+    with open(fname, "rb") as f:
+        return zlib.crc32(f.read())
+
+
+def _save(fname, img, kwargs, checksum):
+    imgio.imsave(fname, img, **kwargs)
+    return fname, file_checksum(fname) if checksum else None
+
+
+class ImageWriter():
+    '''
+    Pool of threads that encode and write images in the background.
+    With nworkers=0 images are written synchronously (handy for debugging).
+    '''
+    def __init__(self, nworkers=None, max_pending=None, checksum=False):
+        if nworkers is None:
+            nworkers = min(8, os.cpu_count() or 1)
+        self.nworkers = nworkers
+        if max_pending is None:
+            max_pending = 4*max(1, nworkers)
+        self.max_pending = max_pending
+        self.checksum = checksum
+        self.pending = collections.deque()
+        self.written = 0
+        self.pool = None
+        if nworkers > 0:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=nworkers, thread_name_prefix="imgwriter")
+
+    def write(self, fname, img, on_done=None, **kwargs):
+        """
+        Queue img to be saved as fname. kwargs are passed on to skimage.io.imsave (e.g. quality)
+        """
+        if self.pool is None:
+            result = _save(fname, img, kwargs, self.checksum)
+            self.written += 1
+            if on_done is not None:
+                on_done(*result)
+            return
+        while len(self.pending) >= self.max_pending:
+            self._reap_oldest()
+        self.pending.append((self.pool.submit(_save, fname, img, kwargs, self.checksum), on_done))
+
+    def _reap_oldest(self):
+        # result() re-raises any exception from the worker, in submission order
+        future, on_done = self.pending.popleft()
+        result = future.result()
+        self.written += 1
+        if on_done is not None:
+            on_done(*result)
+
+    def flush(self):
+        """
+        Wait until every queued image has been written
+        """
+        while len(self.pending):
+            self._reap_oldest()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(wait=True)
+                self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.pool is not None:
+            # do not hide the original error behind a write error
+            for f, _ in self.pending:
+                f.cancel()
+            self.pending.clear()
+        self.close()
+        return False
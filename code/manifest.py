@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Output manifest for resumable, incremental extraction.
+
+Each output directory gets a manifest.jsonl file with one line per image written:
+
+    {"file": "cam1_frame_0001234.jpg", "frame": 1234, "camera": "cam1", "params": "<sha1>", "crc": 123456}
+
+where params is a hash of the parameters that affect the image contents (resolution,
+rotation, crop, calibration, ...) and crc is the CRC32 of the file. A line is appended
+(and flushed) only after its image has been completely written, so if the extraction is
+interrupted the manifest lists exactly the images that are complete; a torn last line is
+simply ignored. When a file appears more than once the last line wins.
+
+On restart, extract.py skips the frames whose files are all in the manifest with the same
+parameters hash, and seeks directly to the first one that is missing.
+"""
+
+import hashlib
+import json
+import os
+from imgwriter import file_checksum
+
+MANIFEST_FNAME = "manifest.jsonl"
+
+
+def params_hash(params):
+    """
+    sha1 of a (JSON serializable) parameters dict; key order does not matter
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class Manifest():
+    '''
+    Append-only record of the images written to output_dir.
+    '''
+    def __init__(self, output_dir, restart=False):
+        self.output_dir = output_dir
+        self.fname = os.path.join(output_dir, MANIFEST_FNAME)
+        self.entries = dict()
+        if restart:
+            if os.path.exists(self.fname):
+                os.remove(self.fname)
+        else:
+            self.load()
+        self.file = None
+
+    def load(self):
+        self.entries = dict()
+        if not os.path.exists(self.fname):
+            return
+        with open(self.fname, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # torn line from an interrupted run
+                self.entries[entry["file"]] = entry
+
+    def done(self, fnames, params, verify=False):
+        """
+        True if all the files in fnames were written with the given parameters hash
+        and still exist (and, if verify is set, their contents match the recorded CRC)
+        """
+        for fname in fnames:
+            entry = self.entries.get(os.path.basename(fname))
+            if entry is None or entry["params"] != params:
+                return False
+            path = os.path.join(self.output_dir, entry["file"])
+            if not os.path.exists(path):
+                return False
+            if verify and entry["crc"] is not None and file_checksum(path) != entry["crc"]:
+                return False
+        return True
+
+    def record(self, fname, frame, camera, params, crc):
+        if self.file is None:
+            self.file = open(self.fname, "a")
+        entry = {"file": os.path.basename(fname), "frame": int(frame), "camera": camera,
+                 "params": params, "crc": crc}
+        self.file.write(json.dumps(entry)+"\n")
+        self.file.flush()
+        self.entries[entry["file"]] = entry
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
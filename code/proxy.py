@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Low resolution proxies of the videos.
+
+Several tools only need a coarse look at a video: browsing it (annotate.py), guessing its
+orientation, computing the white frame (at 1/8 resolution) or finding the frames where
+QR codes may appear (detect_qr_codes.py). Decoding the full resolution video each time is
+what makes them slow. A proxy is every frame of the video reduced rescale_factor times
+(RGB, unrotated), stored in a single memory mapped .npy array next to the video, plus some
+per frame luma statistics:
+
+    <video>.proxy.npy       (frames, h, w, 3) uint8
+    <video>.proxy.npz       rescale factor, fps, luma mean/std/min/max of each frame and
+                            the size and modification time of the video
+
+It is built once, when the videos are ingested (python proxy.py videos...), and then read
+at memory speed by all the tools, which fall back to the video when there is no proxy.
+The .npz is written last, so an interrupted build is not taken for a valid proxy.
+"""
+
+import argparse
+import concurrent.futures
+import os
+import time
+import numpy as np
+import cv2
+
+from ffsource import open_video, ffmpeg_available, BACKENDS
+
+PROXY_SUFFIX = ".proxy.npy"
+STATS_SUFFIX = ".proxy.npz"
+PROXY_VERSION = 1
+RESCALE_FACTOR = 8
+
+
+def proxy_filenames(video_fname):
+    return video_fname + PROXY_SUFFIX, video_fname + STATS_SUFFIX
+
+
+class Proxy():
+    '''
+    Proxy of a video: proxy[i] is frame i (RGB, reduced rescale_factor times), and
+    luma_mean, luma_std, luma_min and luma_max are arrays with one value per frame.
+    '''
+    def __init__(self, video_fname):
+        frames_fname, stats_fname = proxy_filenames(video_fname)
+        with np.load(stats_fname) as data:
+            stats = {k: data[k] for k in data.files}
+        self.video_fname = video_fname
+        self.rescale_factor = int(stats["rescale_factor"])
+        self.fps = float(stats["fps"])
+        self.luma_mean = stats["luma_mean"]
+        self.luma_std = stats["luma_std"]
+        self.luma_min = stats["luma_min"]
+        self.luma_max = stats["luma_max"]
+        self.stats = stats
+        n = len(self.luma_mean)
+        self.frames = np.load(frames_fname, mmap_mode="r")[:n]
+        self.shape = self.frames.shape[1:]
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, i):
+        return self.frames[i]
+
+    def gray(self, i):
+        return cv2.cvtColor(np.ascontiguousarray(self.frames[i]), cv2.COLOR_RGB2GRAY)
+
+
+def load_proxy(video_fname, rescale_factor=None):
+    """
+    Proxy of a video, or None if it has not been built, is stale (the video changed) or
+    has another rescale_factor (if given)
+    """
+    frames_fname, stats_fname = proxy_filenames(video_fname)
+    if not os.path.exists(stats_fname) or not os.path.exists(frames_fname):
+        return None
+    try:
+        proxy = Proxy(video_fname)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"WARNING: ignoring unreadable proxy of {video_fname}: {e}")
+        return None
+    stats = proxy.stats
+    if int(stats["version"]) != PROXY_VERSION or \
+       int(stats["file_size"]) != os.path.getsize(video_fname) or \
+       float(stats["file_mtime"]) != os.path.getmtime(video_fname):
+        print(f"WARNING: proxy of {video_fname} is stale, ignoring it")
+        return None
+    if rescale_factor is not None and proxy.rescale_factor != rescale_factor:
+        return None
+    return proxy
+
+
+def build_proxy(video_fname, rescale_factor=RESCALE_FACTOR, backend="opencv"):
+    """
+    Decodes the whole video and writes its proxy. Returns the Proxy.
+    """
+    frames_fname, stats_fname = proxy_filenames(video_fname)
+    if os.path.exists(stats_fname):
+        os.remove(stats_fname) # invalid until we are done
+    probe = cv2.VideoCapture(video_fname)
+    fps = probe.get(cv2.CAP_PROP_FPS)
+    nframes = int(probe.get(cv2.CAP_PROP_FRAME_COUNT))
+    w = int(probe.get(cv2.CAP_PROP_FRAME_WIDTH))
+    h = int(probe.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    probe.release()
+    shape = (h//rescale_factor, w//rescale_factor, 3)
+    # the frame count in the header may be a little off: leave some room
+    capacity = max(1, nframes + 16)
+    frames = np.lib.format.open_memmap(frames_fname, mode="w+", dtype=np.uint8, shape=(capacity,) + shape)
+    stats = np.zeros((capacity, 4), dtype=np.float32)
+    # with the ffmpeg backend the frames come already reduced and in RGB
+    cap, transformed = open_video(video_fname, backend, rescale_factor, pix_fmt="rgb24")
+    t0 = time.time()
+    n = 0
+    try:
+        while cap.isOpened() and n < capacity:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if not transformed:
+                frame = cv2.resize(frame, (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            frames[n] = frame
+            luma = cv2.cvtColor(frames[n], cv2.COLOR_RGB2GRAY)
+            lo, hi = cv2.minMaxLoc(luma)[:2]
+            mean, std = cv2.meanStdDev(luma)
+            stats[n] = (mean[0, 0], std[0, 0], lo, hi)
+            n += 1
+            if not n % 1000:
+                print(f"\t{video_fname}: {n} frames, {n/(time.time()-t0):.1f} fps")
+    finally:
+        cap.release()
+    frames.flush()
+    del frames
+    tmp_fname = f"{stats_fname}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_fname, version=PROXY_VERSION, rescale_factor=rescale_factor, fps=fps,
+             file_size=os.path.getsize(video_fname), file_mtime=os.path.getmtime(video_fname),
+             luma_mean=stats[:n, 0], luma_std=stats[:n, 1], luma_min=stats[:n, 2], luma_max=stats[:n, 3])
+    os.replace(tmp_fname, stats_fname)
+    print(f"{video_fname}: proxy of {n} frames of {shape[1]}x{shape[0]} in {time.time()-t0:.1f}s")
+    return Proxy(video_fname)
+
+
+def get_proxy(video_fname, rescale_factor=RESCALE_FACTOR, backend="opencv"):
+    """
+    Proxy of a video, built if needed
+    """
+    proxy = load_proxy(video_fname, rescale_factor)
+    if proxy is None:
+        proxy = build_proxy(video_fname, rescale_factor, backend)
+    return proxy
+
+
+def _build(video_fname, rescale_factor, backend, rebuild):
+    cv2.setNumThreads(1)
+    if not rebuild and load_proxy(video_fname, rescale_factor) is not None:
+        print(f"{video_fname}: proxy already built")
+        return
+    build_proxy(video_fname, rescale_factor, backend)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("videos", type=str, nargs="+",
+                    help="videos for which to build proxies")
+    ap.add_argument('-r',"--rescale-factor", type=int, default=RESCALE_FACTOR,
+                    help=f"Reduce frames this many times (defaults to {RESCALE_FACTOR}).")
+    ap.add_argument('-k','--backend', type=str, default="ffmpeg" if ffmpeg_available() else "opencv", choices=BACKENDS,
+                    help="Video decoding backend (ffmpeg, if available, decodes directly at low resolution).")
+    ap.add_argument('-j','--jobs', type=int, default=1,
+                    help="Number of videos processed at the same time.")
+    ap.add_argument('--rebuild', action="store_true",
+                    help="Rebuild proxies that already exist.")
+    args = vars(ap.parse_args())
+    if args["jobs"] <= 1:
+        for fname in args["videos"]:
+            _build(fname,args["rescale_factor"],args["backend"],args["rebuild"])
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args["jobs"]) as pool:
+            futures = [pool.submit(_build,fname,args["rescale_factor"],args["backend"],args["rebuild"])
+                       for fname in args["videos"]]
+            for f in futures:
+                f.result()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Index of QR (sector marker) sightings across acquisitions, in a SQLite database.
+
+extract.py and detect_qr_codes.py report the codes they see in every frame. Besides their
+per run CSV files, when asked to (-I), they record them here, in a single database for all
+acquisitions (usually <datadir>/qr_index.sqlite), so that questions like "which frames of
+which take cover sectors 127 to 128" are answered without decoding any video:
+
+    videos(id, path, acquisition, camera, take, part, fps)
+    sightings(video_id, frame, time_ms, sector, x1, y1, ..., x4, y4)
+
+sightings is indexed by sector and time. The corners (x1, y1) to (x4, y4) are in pixels of
+the source video (full resolution, unrotated, distorted), whatever the resolution, rotation
+or lens correction of the frames the code was detected on (see undistort.source_points).
+Recording the same frame again (e.g. when an extraction is repeated) replaces the previous
+sighting.
+
+As a program, it prints the intervals during which the given sectors are visible:
+
+    python qrindex.py -d data/qr_index.sqlite -s 127 128
+"""
+
+import argparse
+import os
+import re
+import sqlite3
+
+QRINDEX_FNAME = "qr_index.sqlite"
+MAX_GAP_MS = 1000   # sightings of a sector further apart than this start a new interval
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    acquisition TEXT,
+    camera TEXT,
+    take INTEGER,
+    part INTEGER,
+    fps REAL
+);
+CREATE TABLE IF NOT EXISTS sightings (
+    video_id INTEGER NOT NULL REFERENCES videos(id),
+    frame INTEGER NOT NULL,
+    time_ms INTEGER NOT NULL,
+    sector INTEGER NOT NULL,
+    x1 REAL, y1 REAL, x2 REAL, y2 REAL, x3 REAL, y3 REAL, x4 REAL, y4 REAL,
+    PRIMARY KEY (video_id, frame, sector)
+);
+CREATE INDEX IF NOT EXISTS sightings_sector ON sightings (sector, time_ms);
+CREATE INDEX IF NOT EXISTS sightings_time ON sightings (video_id, time_ms);
+"""
+
+# <datadir>/<acquisition>/<camera>/<camera>_toma<take>_parte<part>.mp4
+VIDEO_RE = re.compile(r"(?P<camera>[^/\\]+)_toma(?P<take>\d+)_parte(?P<part>\d+)\.\w+$")
+
+
+def parse_video_path(path):
+    """
+    (acquisition, camera, take, part) of a video from its path; take and part are None if
+    the file name does not follow the <camera>_toma<take>_parte<part>.mp4 convention
+    """
+    path = os.path.abspath(path)
+    camera_dir = os.path.dirname(path)
+    acquisition = os.path.basename(os.path.dirname(camera_dir))
+    m = VIDEO_RE.search(os.path.basename(path))
+    if m is None:
+        return acquisition, os.path.basename(camera_dir), None, None
+    return acquisition, m.group("camera"), int(m.group("take")), int(m.group("part"))
+
+
+class QRIndex():
+    '''
+    QR sightings database. Sightings are buffered and written by flush() (or close());
+    add() may be called from a thread other than the one that opened the index.
+    '''
+    def __init__(self, fname):
+        self.fname = fname
+        self.db = sqlite3.connect(fname, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL") # several extractions may write at the same time
+        self.db.executescript(SCHEMA)
+        self.pending = list()
+
+    def video(self, path, fps):
+        """
+        Id of a video, registering it if needed
+        """
+        path = os.path.abspath(path)
+        acquisition, camera, take, part = parse_video_path(path)
+        with self.db:
+            self.db.execute("INSERT INTO videos (path, acquisition, camera, take, part, fps) VALUES (?,?,?,?,?,?) "
+                            "ON CONFLICT(path) DO UPDATE SET fps=excluded.fps",
+                            (path, acquisition, camera, take, part, fps))
+        return self.db.execute("SELECT id FROM videos WHERE path=?", (path,)).fetchone()[0]
+
+    def add(self, video_id, fps, frame, sector, quad):
+        """
+        Records that sector was seen at frame of a video (fps frames per second), with its
+        corners quad (4x2, in pixels of the source video)
+        """
+        corners = [float(v) for v in quad.ravel()[:8]] if quad is not None else [None]*8
+        self.pending.append((video_id, int(frame), int(round(1000*frame/fps)), int(sector), *corners))
+
+    def flush(self):
+        pending, self.pending = self.pending, list()
+        if not pending:
+            return
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO sightings VALUES (?,?,?,?,?,?,?,?,?,?,?,?)", pending)
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def intervals(self, sector_min, sector_max=None, acquisition=None, camera=None, take=None,
+                  start_ms=None, end_ms=None, max_gap_ms=MAX_GAP_MS):
+        """
+        Intervals during which the sectors sector_min to sector_max (inclusive) are seen,
+        optionally only in one acquisition, camera or take and between start_ms and end_ms
+        from the start of each video. A new interval starts when a sector is not seen for
+        more than max_gap_ms. Returns a list of dicts with keys sector, acquisition, camera,
+        take, part, path, first_frame, last_frame, start_ms, end_ms and sightings.
+        """
+        if sector_max is None:
+            sector_max = sector_min
+        query = ("SELECT s.video_id, s.sector, s.frame, s.time_ms, v.path, v.acquisition, v.camera, v.take, v.part "
+                 "FROM sightings s JOIN videos v ON s.video_id = v.id WHERE s.sector BETWEEN ? AND ?")
+        params = [sector_min, sector_max]
+        for column, value in (("v.acquisition", acquisition), ("v.camera", camera), ("v.take", take)):
+            if value is not None:
+                query += f" AND {column} = ?"
+                params.append(value)
+        if start_ms is not None:
+            query += " AND s.time_ms >= ?"
+            params.append(start_ms)
+        if end_ms is not None:
+            query += " AND s.time_ms <= ?"
+            params.append(end_ms)
+        query += " ORDER BY s.video_id, s.sector, s.frame"
+        self.flush()
+        intervals = list()
+        current = None
+        for video_id, sector, frame, time_ms, path, acq, cam, tk, part in self.db.execute(query, params):
+            if current is not None and current["video_id"] == video_id and current["sector"] == sector \
+               and time_ms - current["end_ms"] <= max_gap_ms:
+                current["last_frame"] = frame
+                current["end_ms"] = time_ms
+                current["sightings"] += 1
+                continue
+            current = {"video_id": video_id, "sector": sector, "acquisition": acq, "camera": cam,
+                       "take": tk, "part": part, "path": path, "first_frame": frame, "last_frame": frame,
+                       "start_ms": time_ms, "end_ms": time_ms, "sightings": 1}
+            intervals.append(current)
+        for interval in intervals:
+            del interval["video_id"]
+        return intervals
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-d","--database", type=str, required=True,
+                    help=f"QR index database (usually <datadir>/{QRINDEX_FNAME}).")
+    ap.add_argument("-s","--sector", type=int, nargs="+", required=True,
+                    help="sector, or first and last sectors of a range")
+    ap.add_argument("-A","--adqdir", type=str, default=None,
+                    help="only this acquisition")
+    ap.add_argument("-c","--camera", type=str, default=None,
+                    help="only this camera")
+    ap.add_argument("-t","--take", type=int, default=None,
+                    help="only this take")
+    ap.add_argument("-g","--max-gap", type=int, default=MAX_GAP_MS,
+                    help=f"Sightings further apart than this many milliseconds are different intervals (defaults to {MAX_GAP_MS}).")
+    args = vars(ap.parse_args())
+    if not os.path.exists(args["database"]):
+        print(f"ERROR: no se encuentra {args['database']}.")
+        exit(1)
+    index = QRIndex(args["database"])
+    sectors = args["sector"]
+    for i in index.intervals(sectors[0],sectors[-1],args["adqdir"],args["camera"],args["take"],max_gap_ms=args["max_gap"]):
+        print(f'sector {i["sector"]:4d}  {i["acquisition"]} {i["camera"]} toma {i["take"]} parte {i["part"]}: '
+              f'frames {i["first_frame"]}-{i["last_frame"]}, {i["start_ms"]}-{i["end_ms"]} ms ({i["sightings"]} sightings)')
+    index.close()
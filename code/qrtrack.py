@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Detect-then-track QR engine.
+
+Running cv2.QRCodeDetector.detectAndDecode on every frame is by far the most expensive
+part of a full take scan, and the sector markers are only visible in a small fraction of
+the frames. QRTracker does the following on each (grayscale) frame:
+
+1. looks for QR finder patterns (the three nested squares at the corners of a code) in a
+   downscaled copy of the frame; this is a threshold plus a contour search, very cheap;
+2. only when two or more finder patterns are found close together, it crops that region
+   from the full resolution frame and decodes it;
+3. once a code is decoded, its quad is tracked on the following frames with sparse optical
+   flow on the downscaled frames, without decoding it again, until it leaves the frame.
+
+For each code it records the frame where it entered (was first decoded), the frame where
+its center was closest to the center of the image, and the frame where it left.
+"""
+
+import numpy as np
+import cv2
+
+DETECT_WIDTH = 640      # width of the downscaled frame used for finder detection and tracking
+MIN_FINDERS = 2         # finder patterns needed to try decoding a region
+ROI_MARGIN = 1.5        # region margin, in finder pattern sizes
+MIN_TRACK_POINTS = 6    # tracking is lost with fewer points than this
+
+
+def find_finder_patterns(small, block_size=21, min_size=4):
+    """
+    Finds QR finder pattern candidates in a small grayscale (uint8) image:
+    contours that contain a contour that contains another one, squarish, at least
+    min_size pixels wide, with area ratio roughly 7x7 to 3x3. block_size is that of
+    the adaptive threshold. Returns an array of (x, y, size) rows.
+    """
+    bw = cv2.adaptiveThreshold(small, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, block_size, 5)
+    contours, hierarchy = cv2.findContours(bw, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    if hierarchy is None:
+        return np.zeros((0, 3))
+    hierarchy = hierarchy[0]
+    finders = []
+    for i, cnt in enumerate(contours):
+        child = hierarchy[i][2]
+        if child < 0:
+            continue
+        grandchild = hierarchy[child][2]
+        if grandchild < 0:
+            continue
+        x, y, w, h = cv2.boundingRect(cnt)
+        if w < min_size or h < min_size or max(w, h) > 2*min(w, h):
+            continue
+        outer = cv2.contourArea(cnt)
+        inner = cv2.contourArea(contours[grandchild])
+        if inner <= 0:
+            continue
+        ratio = outer/inner
+        if 2.5 < ratio < 15:
+            finders.append((x + w/2, y + h/2, max(w, h)))
+    return np.array(finders).reshape(-1, 3)
+
+
+def group_finders(finders):
+    """
+    Groups finder patterns that may belong to the same code. Returns a list of
+    bounding boxes (x0, y0, x1, y1), in the coordinates of the finder patterns.
+    """
+    boxes = []
+    n = len(finders)
+    used = np.zeros(n, dtype=bool)
+    for i in range(n):
+        if used[i]:
+            continue
+        xi, yi, si = finders[i]
+        # finders of the same code are less than ~ 8 finder sizes apart
+        d = np.hypot(finders[:, 0] - xi, finders[:, 1] - yi)
+        members = np.flatnonzero((d < 8*max(si, finders[:, 2].max())) & ~used)
+        if len(members) < MIN_FINDERS:
+            continue
+        used[members] = True
+        g = finders[members]
+        s = g[:, 2].max()
+        boxes.append((g[:, 0].min() - ROI_MARGIN*s, g[:, 1].min() - ROI_MARGIN*s,
+                      g[:, 0].max() + ROI_MARGIN*s, g[:, 1].max() + ROI_MARGIN*s))
+    return boxes
+
+
+class QRTracker():
+    '''
+    Feed it consecutive (or regularly sampled) grayscale frames with process().
+    '''
+    def __init__(self, detect_width=DETECT_WIDTH):
+        self.detect_width = detect_width
+        self.detector = cv2.QRCodeDetector()
+        self.prev_small = None
+        self.tracks = []   # codes currently visible
+        self.events = []   # codes that already left (or are still visible at finish())
+        self.decodes = 0   # number of detectAndDecode calls
+        self.frames = 0
+
+    def _decode_roi(self, gray, box, scale):
+        h, w = gray.shape[:2]
+        x0 = int(max(0, box[0]*scale))
+        y0 = int(max(0, box[1]*scale))
+        x1 = int(min(w, box[2]*scale))
+        y1 = int(min(h, box[3]*scale))
+        if x1 - x0 < 8 or y1 - y0 < 8:
+            return None, None
+        self.decodes += 1
+        try:
+            data, points, _ = self.detector.detectAndDecode(gray[y0:y1, x0:x1])
+        except cv2.error:
+            return None, None
+        if data is None or not len(data) or points is None:
+            return None, None
+        quad = np.squeeze(points).reshape(4, 2) + (x0, y0)
+        return data, quad
+
+    def _covered(self, box, scale):
+        cx = 0.5*(box[0] + box[2])*scale
+        cy = 0.5*(box[1] + box[3])*scale
+        for t in self.tracks:
+            q = t["quad"]
+            if q[:, 0].min() <= cx <= q[:, 0].max() and q[:, 1].min() <= cy <= q[:, 1].max():
+                return True
+        return False
+
+    def _start_track(self, frame_index, data, quad, small, scale):
+        mask = np.zeros(small.shape, dtype=np.uint8)
+        cv2.fillConvexPoly(mask, np.round(quad/scale).astype(np.int32), 255)
+        pts = cv2.goodFeaturesToTrack(small, 50, 0.01, 3, mask=mask)
+        corners = (quad/scale).astype(np.float32).reshape(-1, 1, 2)
+        pts = corners if pts is None else np.concatenate((corners, pts.astype(np.float32)))
+        track = {"data": data, "quad": quad, "points": pts, "entry": frame_index,
+                 "exit": frame_index, "center": frame_index, "center_dist": np.inf}
+        self._update_center(track, frame_index, small.shape, scale)
+        self.tracks.append(track)
+
+    def _update_center(self, track, frame_index, small_shape, scale):
+        hs, ws = small_shape
+        c = track["quad"].mean(axis=0)/scale
+        d = np.hypot(c[0] - ws/2, c[1] - hs/2)
+        if d < track["center_dist"]:
+            track["center_dist"] = d
+            track["center"] = frame_index
+
+    def _track(self, frame_index, small, scale):
+        hs, ws = small.shape
+        alive = []
+        for t in self.tracks:
+            nxt, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_small, small, t["points"], None)
+            ok = status.ravel() == 1 if status is not None else np.zeros(0, dtype=bool)
+            lost = ok.sum() < MIN_TRACK_POINTS
+            if not lost:
+                A, _ = cv2.estimateAffinePartial2D(t["points"][ok], nxt[ok])
+                lost = A is None
+            if not lost:
+                quad_small = cv2.transform((t["quad"]/scale).reshape(-1, 1, 2), A).reshape(4, 2)
+                c = quad_small.mean(axis=0)
+                lost = not (0 <= c[0] < ws and 0 <= c[1] < hs)
+            if lost:
+                self.events.append(t)
+                continue
+            t["quad"] = quad_small*scale
+            t["points"] = nxt[ok].reshape(-1, 1, 2)
+            t["exit"] = frame_index
+            self._update_center(t, frame_index, small.shape, scale)
+            alive.append(t)
+        self.tracks = alive
+
+    def process(self, frame_index, gray):
+        """
+        Processes a grayscale uint8 frame. Returns the list of (data, quad) of the codes
+        visible in it (quad is a 4x2 array of corners, in frame coordinates).
+        """
+        self.frames += 1
+        h, w = gray.shape[:2]
+        scale = max(1, w/self.detect_width)
+        if scale > 1:
+            small = cv2.resize(gray, (int(round(w/scale)), int(round(h/scale))), interpolation=cv2.INTER_AREA)
+            scale = w/small.shape[1]
+        else:
+            small = gray
+        if self.prev_small is not None and len(self.tracks):
+            self._track(frame_index, small, scale)
+        visible = [(t["data"], t["quad"]) for t in self.tracks]
+        for box in group_finders(find_finder_patterns(small)):
+            if self._covered(box, scale):
+                continue
+            data, quad = self._decode_roi(gray, box, scale)
+            if data is None:
+                continue
+            if any(t["data"] == data for t in self.tracks):
+                continue
+            self._start_track(frame_index, data, quad, small, scale)
+            visible.append((data, quad))
+        self.prev_small = small
+        return visible
+
+    def gap(self):
+        """
+        Tells the tracker that the next frame does not follow the last one processed (frames
+        were skipped): the codes being tracked are closed, as they cannot be followed across.
+        """
+        self.events.extend(self.tracks)
+        self.tracks = []
+        self.prev_small = None
+
+    def finish(self):
+        """
+        Closes the codes still being tracked and returns the list of events, ordered by entry:
+        dicts with keys data, entry, center and exit (frame indexes), and center_dist (distance
+        from the code to the center of the image at the center frame, in detection pixels).
+        """
+        self.events.extend(self.tracks)
+        self.tracks = []
+        events = sorted(self.events, key=lambda t: t["entry"])
+        return [{k: t[k] for k in ("data", "entry", "center", "exit", "center_dist")} for t in events]
+
+
+def merge_events(events):
+    """
+    Joins the events (see QRTracker.finish) of the same code that follow each other
+    without a gap, as happens when a video is processed in segments (see vmap.py) and a
+    code is visible across the boundary between two of them. Returns them ordered by entry.
+    """
+    merged = []
+    last = dict() # last event of each code
+    for e in sorted(events, key=lambda e: e["entry"]):
+        prev = last.get(e["data"])
+        if prev is not None and e["entry"] <= prev["exit"] + 1:
+            prev["exit"] = max(prev["exit"], e["exit"])
+            if e["center_dist"] < prev["center_dist"]:
+                prev["center"] = e["center"]
+                prev["center_dist"] = e["center_dist"]
+            continue
+        e = dict(e)
+        last[e["data"]] = e
+        merged.append(e)
+    return merged
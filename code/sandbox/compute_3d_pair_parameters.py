@@ -3,13 +3,18 @@ import numpy as np
 import cv2 as cv
 import os
 import argparse 
+import sys
+# shared modules live in the parent directory
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+from cornercache import CornerCache, CACHE_FNAME, file_key
 #
 # cambio choto
 #
-def gather_calibration_points(img_dir,img_list,args):
+def gather_calibration_points(img_dir,img_list,args,cache=None):
     """
-    Calibrates a single camera.
-    Takes the args produced by argparse as input
+    Finds the calibration points on each image of img_list (None where not found).
+    Takes the args produced by argparse as input. Detections are looked up in and
+    added to cache (a CornerCache), if given.
     """
     M = args["nrows"]
     N = args["ncols"]
@@ -22,26 +27,41 @@ def gather_calibration_points(img_dir,img_list,args):
     objpoints = [] # 3d point in real world space
     imgpoints = [] # 2d points in image plane.
 
+    # everything that changes the detected corners, except the image itself
+    detection_params = dict(pattern="chessboard",pattern_size=(M,N),downscale=downscale,window_size=window_size,
+                            maxiter=args["maxiter"],epsilon=args["epsilon"])
+    img_size = None
     n = 0
     with open(img_list) as flist:
         for relfname in flist:
             fname = os.path.join(img_dir,relfname.strip())
             print('Finding calibration points in ',fname,end=' ... ')
-            color_frame = cv.imread(fname)
-            h,w,c = color_frame.shape
-            color_frame = cv.resize(color_frame,(w//downscale,h//downscale))
-            gray_frame = cv.cvtColor(color_frame, cv.COLOR_BGR2GRAY)
-            gray = np.array(gray_frame)
-            gray = gray - np.min(gray)
-            gray = gray*(255/np.max(gray))
-            gray = gray.astype(np.uint8)
-            # Find the chess board corners
-            ret, corners = cv.findChessboardCorners(gray, (M,N), None)
-            # If found, add object points, image points (after refining them)
-            if ret == True:
+            key = file_key(fname,**detection_params) if cache is not None else None
+            if key is not None and key in cache:
+                # detected in a previous run: no need to even decode the image
+                corners2, img_size, _ = cache.get(key)
+                print('(cached)',end=' ')
+            else:
+                color_frame = cv.imread(fname)
+                h,w,c = color_frame.shape
+                color_frame = cv.resize(color_frame,(w//downscale,h//downscale))
+                gray_frame = cv.cvtColor(color_frame, cv.COLOR_BGR2GRAY)
+                img_size = (gray_frame.shape[1],gray_frame.shape[0])
+                gray = np.array(gray_frame)
+                gray = gray - np.min(gray)
+                gray = gray*(255/np.max(gray))
+                gray = gray.astype(np.uint8)
+                # Find the chess board corners
+                ret, corners = cv.findChessboardCorners(gray, (M,N), None)
+                corners2 = None
+                if ret == True:
+                    criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, args["maxiter"], args["epsilon"])
+                    corners2 = cv.cornerSubPix(gray,corners, (window_size,window_size), (-1,-1), criteria)
+                if key is not None:
+                    cache.put(key,corners2,img_size)
+            # If found, add object points, image points
+            if corners2 is not None:
                 objpoints.append(objp)
-                criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, args["maxiter"], args["epsilon"])
-                corners2 = cv.cornerSubPix(gray,corners, (window_size,window_size), (-1,-1), criteria)
                 imgpoints.append(corners2)
                 n += 1
                 print('OK!')
@@ -53,10 +73,10 @@ def gather_calibration_points(img_dir,img_list,args):
             if n >= args["nframes"]: 
                 break
     print(f"processed {n} valid frames")
-    return np.flip(gray_frame.shape), objpoints,imgpoints
+    return img_size, objpoints,imgpoints
 
 
-def calibrate_single_camera(args,img_dir,img_list):
+def calibrate_single_camera(args,img_dir,img_list,cache=None):
     """
     Calibrates a single camera.
     Takes the args produced by argparse as input
@@ -64,7 +84,10 @@ def calibrate_single_camera(args,img_dir,img_list):
     M = args["nrows"]
     N = args["ncols"]
 
-    img_size, objpoints, imgpoints = gather_calibration_points(img_dir,img_list)
+    img_size, objpoints, imgpoints = gather_calibration_points(img_dir,img_list,args,cache)
+    objpoints = [o for o in objpoints if o is not None]
+    imgpoints = [i for i in imgpoints if i is not None]
+    n = len(objpoints)
     #
     # calibrating
     #
@@ -103,14 +126,16 @@ def calibrate_single(objpoints,imgpoints,img_size,args):
     return newcameramtx, dist
 
 
-def calibrate_pair(img_dir, img_list1,img_list2,args):
+def calibrate_pair(img_dir, img_list1,img_list2,args,cache=None):
     """
     Calibrates a pair of cameras using previously computed matrices and distortion coeffs for both cameras
-    and a list of synchronized frames for each 
+    and a list of synchronized frames for each.
+    The points are detected once per image (and not at all if they are in cache); the
+    single camera calibrations and the pair calibration all use them.
     """
     print("Gathering calibration points")
-    img_size, objpoints1,imgpoints1 = gather_calibration_points(img_dir,img_list1,args)
-    img_size, objpoints2,imgpoints2 = gather_calibration_points(img_dir,img_list2,args)
+    img_size, objpoints1,imgpoints1 = gather_calibration_points(img_dir,img_list1,args,cache)
+    img_size, objpoints2,imgpoints2 = gather_calibration_points(img_dir,img_list2,args,cache)
     valid_objpoints = [o1 for o1,o2 in zip(objpoints1,objpoints2) if o1 is not None and o2 is not None]
     valid_imgpoints_1 = [o1 for o1,o2 in zip(imgpoints1,imgpoints2) if o1 is not None and o2 is not None]
     valid_imgpoints_2 = [o2 for o1,o2 in zip(imgpoints1,imgpoints2) if o1 is not None and o2 is not None]
@@ -164,16 +189,23 @@ if __name__ == "__main__":
     ap.add_argument('-L',"--pattern-size", type=float, default=1,
                     help="Size of patterns in real world (in your units of preference, doesn't matter).")
 
+    ap.add_argument('-C',"--corner-cache", type=str, default=None,
+                    help=f"File where detected corners are cached (may be shared with the other calibration tools). Defaults to {CACHE_FNAME} in outdir.")
+
     args = vars(ap.parse_args())
-    CM1, dist1, CM2, dist2, R, T, E, F = calibrate_pair(args["indir"],args["list_left"],args["list_right"],args)
     outdir = args["outdir"]
+    cache = CornerCache(args["corner_cache"] or os.path.join(outdir,CACHE_FNAME))
+    try:
+        CM1, dist1, CM2, dist2, R, T, E, F = calibrate_pair(args["indir"],args["list_left"],args["list_right"],args,cache)
+    finally:
+        cache.close()
 
     print('Saving results')
     np.savetxt(os.path.join(outdir,'calibration_matrix_1.txt'),CM1,fmt='%10.6f')
     np.savetxt(os.path.join(outdir,'calibration_distortion_coeffs_1.txt'),dist1,fmt='%10.6f')
-    np.savetxt(os.path.join(outdir,'calibration_matrix_2.txt'),CM1,fmt='%10.6f')
+    np.savetxt(os.path.join(outdir,'calibration_matrix_2.txt'),CM2,fmt='%10.6f')
     np.savetxt(os.path.join(outdir,'calibration_distortion_coeffs_2.txt'),dist2,fmt='%10.6f')
 
     np.savetxt(os.path.join(outdir,'calibration_pair_rotation_matrix.txt'),R,fmt='%10.6f')
-    np.savetxt(os.path.join(outdir,'calibration_pair_translation_matrix.txt'),R,fmt='%10.6f')
+    np.savetxt(os.path.join(outdir,'calibration_pair_translation_matrix.txt'),T,fmt='%10.6f')
     cv.destroyAllWindows()
@@ -3,11 +3,16 @@ import numpy as np
 import cv2 as cv
 import os
 import argparse 
+import sys
+# shared modules live in the parent directory
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+from cornercache import CornerCache, CACHE_FNAME, file_key
 
-def gather_camera_points(img_dir,img_list,args):
+def gather_camera_points(img_dir,img_list,args,cache=None):
     """
-    Calibrates a single camera.
-    Takes the args produced by argparse as input
+    Finds the calibration points on each image of img_list (None where not found).
+    Takes the args produced by argparse as input. Detections are looked up in and
+    added to cache (a CornerCache), if given.
     """
     M = args["nrows"]
     N = args["ncols"]
@@ -20,26 +25,45 @@ def gather_camera_points(img_dir,img_list,args):
     objpoints = [] # 3d point in real world space
     imgpoints = [] # 2d points in image plane.
 
+    # everything that changes the detected corners, except the image itself
+    detection_params = dict(pattern="chessboard",pattern_size=(M,N),downscale=downscale,window_size=window_size,
+                            maxiter=args["maxiter"],epsilon=args["epsilon"])
+    img_size = None
     n = 0
     with open(img_list) as flist:
         for relfname in flist:
             fname = os.path.join(img_dir,relfname.strip())
             print('Finding calibration points in ',fname,end=' ... ')
-            color_frame = cv.imread(fname)
-            h,w,c = color_frame.shape
-            color_frame = cv.resize(color_frame,(w//downscale,h//downscale))
-            gray_frame = cv.cvtColor(color_frame, cv.COLOR_BGR2GRAY)
-            gray = np.array(gray_frame)
-            gray = gray - np.min(gray)
-            gray = gray*(255/np.max(gray))
-            gray = gray.astype(np.uint8)
-            # Find the chess board corners
-            ret, corners = cv.findChessboardCorners(gray, (M,N), None)
-            # If found, add object points, image points (after refining them)
-            if ret == True:
+            key = file_key(fname,**detection_params) if cache is not None else None
+            if key is not None and key in cache and not args["debug"]:
+                # detected in a previous run: no need to even decode the image
+                corners2, img_size, _ = cache.get(key)
+                print('(cached)',end=' ')
+            else:
+                color_frame = cv.imread(fname)
+                h,w,c = color_frame.shape
+                color_frame = cv.resize(color_frame,(w//downscale,h//downscale))
+                gray_frame = cv.cvtColor(color_frame, cv.COLOR_BGR2GRAY)
+                img_size = (gray_frame.shape[1],gray_frame.shape[0])
+                gray = np.array(gray_frame)
+                gray = gray - np.min(gray)
+                gray = gray*(255/np.max(gray))
+                gray = gray.astype(np.uint8)
+                # Find the chess board corners
+                ret, corners = cv.findChessboardCorners(gray, (M,N), None)
+                corners2 = None
+                if ret == True:
+                    criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, args["maxiter"], args["epsilon"])
+                    corners2 = cv.cornerSubPix(gray,corners, (window_size,window_size), (-1,-1), criteria)
+                    # Draw and save the corners
+                    if args["debug"]:
+                        cv.drawChessboardCorners(gray, (M,N), corners2, ret)
+                        cv.imwrite(os.path.join(args["outdir"],f'calibration_frame_{n:05d}.jpg'),gray)
+                if key is not None:
+                    cache.put(key,corners2,img_size)
+            # If found, add object points, image points
+            if corners2 is not None:
                 objpoints.append(objp)
-                criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, args["maxiter"], args["epsilon"])
-                corners2 = cv.cornerSubPix(gray,corners, (window_size,window_size), (-1,-1), criteria)
                 imgpoints.append(corners2)
                 n += 1
                 print('OK!')
@@ -50,7 +74,7 @@ def gather_camera_points(img_dir,img_list,args):
 
             if n >= args["nframes"]: 
                 break
-    return np.flip(gray_frame.shape), objpoints,imgpoints
+    return img_size, objpoints,imgpoints
 
 
 if __name__ == "__main__":
@@ -78,7 +102,9 @@ if __name__ == "__main__":
     ap.add_argument('-N',"--ncols", type=int, default=6,
                     help="Number of columns in pattern.")
     ap.add_argument('-D',"--debug", action="store_true",
-                    help="Save debugging info (frames).")
+                    help="Save debugging info (frames). Cached detections are not used, so that every frame is saved.")
+    ap.add_argument('-C',"--corner-cache", type=str, default=None,
+                    help=f"File where detected corners are cached (may be shared with the other calibration tools). Defaults to {CACHE_FNAME} in outdir.")
     ap.add_argument('-L',"--pattern-size", type=float,
                     help="Size of patterns in real world (in your units of preference, doesn't matter).")
 
@@ -88,50 +114,14 @@ if __name__ == "__main__":
     N = args["ncols"]
     indir=args["indir"]
     outdir=args["outdir"]
-    downscale=args["downscale"]
-    window_size = 11 # for finding cheessboard points
-
-    objp = np.zeros((M*N,3), np.float32)
-    objp[:,:2] = np.mgrid[0:M,0:N].T.reshape(-1,2) * args["pattern_size"]
-    # Arrays to store object points and image points from all the images.
-    objpoints = [] # 3d point in real world space
-    imgpoints = [] # 2d points in image plane.
-
-    n = 0
-    with open(args["list"]) as flist:
-        for relfname in flist:
-            fname = os.path.join(indir,relfname.strip())
-            print('Finding calibration points in ',fname,end=' ... ')
-            color_frame = cv.imread(fname)
-            h,w,c = color_frame.shape
-            color_frame = cv.resize(color_frame,(w//downscale,h//downscale))
-            gray_frame = cv.cvtColor(color_frame, cv.COLOR_BGR2GRAY)
-            gray = np.array(gray_frame)
-            gray = gray - np.min(gray)
-            gray = gray*(255/np.max(gray))
-            gray = gray.astype(np.uint8)
-            # Find the chess board corners
-            ret, corners = cv.findChessboardCorners(gray, (M,N), None)
-            # If found, add object points, image points (after refining them)
-            if ret == True:
-                objpoints.append(objp)
-                criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, args["maxiter"], args["epsilon"])
-                corners2 = cv.cornerSubPix(gray,corners, (window_size,window_size), (-1,-1), criteria)
-                imgpoints.append(corners2)
-                # Draw and display the corners
-                if args["debug"]:
-                    cv.drawChessboardCorners(gray, (M,N), corners2, ret)
-                    #cv.imshow('img', gray)
-                    cv.imwrite(os.path.join(outdir,f'calibration_frame_{n:05d}.jpg'),gray)
-                    #cv.waitKey(100)
-                n += 1
-                print('OK!')
-            else:
-                print('Pattern not found!')
-            if n >= args["nframes"]: 
-                break
-
-    #img_size, obj_points, img_points = gather_camera_points(args["indir"],args["list"],args)
+    cache = CornerCache(args["corner_cache"] or os.path.join(outdir,CACHE_FNAME))
+    try:
+        img_size, objpoints, imgpoints = gather_camera_points(indir,args["list"],args,cache)
+    finally:
+        cache.close()
+    objpoints = [o for o in objpoints if o is not None]
+    imgpoints = [i for i in imgpoints if i is not None]
+    w,h = img_size
 
     #
     # calibrating
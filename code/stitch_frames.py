@@ -15,14 +15,15 @@ import skimage
 from skimage import io as imgio
 from skimage.filters import gaussian
 import matplotlib.pyplot as plt
+from framestore import open_frames
 
 
 if __name__ == "__main__":
 
     ap = argparse.ArgumentParser()
-    ap.add_argument("-i","--input", required=True, help="image list or folder.")
+    ap.add_argument("-i","--input", required=True, help="frame store, image list or folder.")
     ap.add_argument("-m","--movement", required=True, help="movement from frame to frame.")
-    ap.add_argument("-d","--base_dir", required=True, help="base dir for files.")
+    ap.add_argument("-d","--base_dir", default=None, help="base dir for the files of an image list.")
     ap.add_argument("-w","--filter_radius", type=float, default=8)
 
     args = ap.parse_args()
@@ -35,19 +36,9 @@ if __name__ == "__main__":
         sys.exit(1)
     
     #
-    # detect type of input
+    # input may be a frame store (read straight from memory mapped chunks), a folder or a list
     #
-    input_files = list()
-    if os.path.isdir(args.input):
-        input_files = [os.path.join(args.base_dir,f) for f in os.listdir(args.input) if f.endswith(".jpg") or f.endswith(".png")]
-    else:
-        _,ext = os.path.splitext(args.input)
-        extl = ext.lower()
-        if extl == '.list':
-            with open(args.input,'r') as fl:
-                input_files = [l.strip() for l in fl.readlines()]
-        else:
-            print("Input must be a list or a folder.")
+    input_files, read_frame = open_frames(args.input,args.base_dir)
 
     movs = np.loadtxt(args.movement)
     dx = movs[0,:].astype(int)
@@ -69,9 +60,8 @@ if __name__ == "__main__":
     w = None
     output_image = None
     norm_image = None
-    for i,input_rel_path in enumerate(input_files):
-        input_abs_path = os.path.join(args.base_dir,input_rel_path)
-        input_frame = imgio.imread(input_abs_path)
+    for i,input_path in enumerate(input_files):
+        input_frame = read_frame(i)
         if i == 0:
             h,w,_ = input_frame.shape
             sh = h + maxy - miny
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Timeline overview of a take, to find the calibration and white segments at a glance.
+
+A take is scanned once at low resolution (from its proxy, see proxy.py, if it has one)
+and a few cheap features are computed on each frame:
+
+    luma        mean luma
+    saturated   fraction of saturated pixels (the white card fills the frame)
+    circles     number of dark round blobs (the circle grid of the calibration pattern)
+    qr          number of QR finder patterns (sector markers)
+    motion      mean absolute difference with the previous frame
+
+They are cached next to the video (<video>.timeline.npz), along with where they come from
+(the proxy or the video, and at which resolution), so the scan runs once per take,
+and rendered by render_strip() as a strip with one row per feature and one column per
+group of frames; annotate.py shows it under the frames, and clicking on it jumps there.
+"""
+
+import argparse
+import os
+import time
+import numpy as np
+import cv2
+
+from ffsource import open_video, ffmpeg_available, BACKENDS
+from proxy import load_proxy
+from qrtrack import find_finder_patterns
+
+TIMELINE_SUFFIX = ".timeline.npz"
+TIMELINE_VERSION = 2
+RESCALE_FACTOR = 8
+SATURATION = 250        # luma of saturated pixels
+MIN_BLOBS = 12          # blobs needed to consider that the circle grid is in view
+FEATURES = ("luma", "saturated", "circles", "qr", "motion")
+SEGMENT_FEATURES = ("saturated", "circles", "qr") # features that mark segments (on/off)
+COLORS = {"luma": (255, 255, 255),
+          "saturated": (255, 128, 0),
+          "circles": (128, 255, 0),
+          "qr": (0, 255, 255),
+          "motion": (255, 64, 255)}
+
+
+def timeline_filename(video_fname):
+    return video_fname + TIMELINE_SUFFIX
+
+
+def _blob_detector():
+    params = cv2.SimpleBlobDetector_Params()
+    params.filterByColor = True
+    params.blobColor = 0
+    params.filterByArea = True
+    params.minArea = 4
+    params.maxArea = 2000
+    params.filterByCircularity = True
+    params.minCircularity = 0.7
+    params.filterByConvexity = False
+    params.filterByInertia = False
+    return cv2.SimpleBlobDetector_create(params)
+
+
+def compute_features(video_fname, backend="opencv", rescale_factor=RESCALE_FACTOR, progress=None):
+    """
+    Features of every frame of the video, as a dict of arrays (see FEATURES).
+    progress, if given, is called with the number of frames processed every 100 frames.
+    """
+    proxy = load_proxy(video_fname)
+    if proxy is not None:
+        cap = None
+        nframes = len(proxy)
+    else:
+        # with the ffmpeg backend the frames come already reduced and in RGB
+        cap, transformed = open_video(video_fname, backend, rescale_factor, pix_fmt="rgb24")
+        nframes = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    detector = _blob_detector()
+    features = {k: list() for k in FEATURES}
+    prev = None
+    n = 0
+    try:
+        while True:
+            if proxy is not None:
+                if n >= nframes:
+                    break
+                frame = proxy[n]
+            else:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                if not transformed:
+                    frame = cv2.resize(frame, (w//rescale_factor, h//rescale_factor), interpolation=cv2.INTER_AREA)
+                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            gray = cv2.cvtColor(np.ascontiguousarray(frame), cv2.COLOR_RGB2GRAY)
+            features["luma"].append(cv2.mean(gray)[0])
+            features["saturated"].append(np.count_nonzero(gray >= SATURATION)/gray.size)
+            features["circles"].append(len(detector.detect(gray)))
+            features["qr"].append(len(find_finder_patterns(gray)))
+            features["motion"].append(cv2.mean(cv2.absdiff(gray, prev))[0] if prev is not None else 0.0)
+            prev = gray
+            n += 1
+            if progress is not None and not n % 100:
+                progress(n)
+    finally:
+        if cap is not None:
+            cap.release()
+    return {k: np.array(v, dtype=np.float32) for k, v in features.items()}
+
+
+def load_features(video_fname, backend="opencv", rescale_factor=RESCALE_FACTOR, rebuild=False, progress=None):
+    """
+    Features of the video (see compute_features), computed and cached next to it if needed
+    """
+    cache_fname = timeline_filename(video_fname)
+    # what compute_features would scan now
+    proxy = load_proxy(video_fname)
+    source, source_factor = ("proxy", proxy.rescale_factor) if proxy is not None else ("video", rescale_factor)
+    if not rebuild and os.path.exists(cache_fname):
+        with np.load(cache_fname) as data:
+            cached = {k: data[k] for k in data.files}
+        if int(cached["version"]) == TIMELINE_VERSION and \
+           str(cached["source"]) == source and \
+           int(cached["rescale_factor"]) == source_factor and \
+           int(cached["file_size"]) == os.path.getsize(video_fname) and \
+           float(cached["file_mtime"]) == os.path.getmtime(video_fname):
+            return {k: cached[k] for k in FEATURES}
+    print("computing timeline of", video_fname)
+    t0 = time.time()
+    features = compute_features(video_fname, backend, rescale_factor, progress)
+    print(f"timeline of {video_fname}: {len(features['luma'])} frames in {time.time()-t0:.1f}s")
+    try:
+        tmp_fname = f"{cache_fname}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_fname, version=TIMELINE_VERSION, source=source, rescale_factor=source_factor,
+                 file_size=os.path.getsize(video_fname),
+                 file_mtime=os.path.getmtime(video_fname), **features)
+        os.replace(tmp_fname, cache_fname)
+    except OSError as e:
+        print("WARNING: could not cache timeline:", e)
+    return features
+
+
+def levels(features):
+    """
+    Features scaled to 0..1 for display, and boolean masks of the frames where each of
+    SEGMENT_FEATURES is on (used to find segments)
+    """
+    scaled = dict()
+    active = dict()
+    for k in FEATURES:
+        v = features[k].astype(np.float32)
+        if k == "saturated":
+            s = np.clip(v/0.5, 0, 1) # half of the frame saturated is as white as it gets
+        elif k == "circles":
+            s = np.clip(v/(2*MIN_BLOBS), 0, 1)
+        elif k == "qr":
+            s = np.clip(v/3, 0, 1)
+        else:
+            hi = np.percentile(v, 99) if len(v) else 0
+            s = np.clip(v/hi, 0, 1) if hi > 0 else np.zeros_like(v)
+        scaled[k] = s
+    active["saturated"] = scaled["saturated"] >= 0.5
+    active["circles"] = features["circles"] >= MIN_BLOBS
+    active["qr"] = features["qr"] > 0
+    return scaled, active
+
+
+def render_strip(features, width, row_height=8, nframes=None):
+    """
+    RGB image with one row of height row_height per feature, and width columns covering
+    nframes frames (defaults to all of them); each column shows the largest value of the
+    frames that fall in it.
+    """
+    scaled, _ = levels(features)
+    n = len(features["luma"]) if nframes is None else nframes
+    strip = np.zeros((row_height*len(FEATURES), width, 3), dtype=np.uint8)
+    if n <= 0:
+        return strip
+    # first frame of each column
+    bounds = np.minimum((np.arange(width + 1)*n)//width, n)
+    for r, k in enumerate(FEATURES):
+        s = scaled[k][:n]
+        if len(s) < n:
+            s = np.concatenate((s, np.zeros(n - len(s), dtype=np.float32)))
+        starts = np.minimum(bounds[:-1], n - 1)
+        column = np.maximum.reduceat(s, starts)
+        strip[r*row_height:(r+1)*row_height] = (column[:, None]*np.array(COLORS[k])).astype(np.uint8)
+    return strip
+
+
+def segment_at(features, name, frame):
+    """
+    (first, last) frames of the run of frames around frame where feature name is on, or
+    None if it is off at frame or name is not one of SEGMENT_FEATURES
+    """
+    _, active = levels(features)
+    if name not in active:
+        return None
+    on = active[name]
+    if not 0 <= frame < len(on) or not on[frame]:
+        return None
+    off = np.flatnonzero(~on)
+    before = off[off < frame]
+    after = off[off > frame]
+    return (int(before[-1]) + 1 if len(before) else 0,
+            int(after[0]) - 1 if len(after) else len(on) - 1)
+
+
+def segments(features, name, min_length=1):
+    """
+    List of (first, last) frames of the runs of frames where feature name is on
+    """
+    _, active = levels(features)
+    on = np.concatenate(([False], active[name], [False])).astype(np.int8)
+    d = np.diff(on)
+    starts = np.flatnonzero(d == 1)
+    ends = np.flatnonzero(d == -1) - 1
+    return [(int(a), int(b)) for a, b in zip(starts, ends) if b - a + 1 >= min_length]
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("videos", type=str, nargs="+",
+                    help="videos to scan")
+    ap.add_argument('-k','--backend', type=str, default="ffmpeg" if ffmpeg_available() else "opencv", choices=BACKENDS,
+                    help="Video decoding backend, when the video has no proxy.")
+    ap.add_argument('-m','--min-length', type=int, default=25,
+                    help="Shortest segment listed, in frames.")
+    ap.add_argument('--rebuild', action="store_true",
+                    help="Recompute the cached features.")
+    args = vars(ap.parse_args())
+    for fname in args["videos"]:
+        features = load_features(fname,args["backend"],rebuild=args["rebuild"])
+        for k in SEGMENT_FEATURES:
+            print(f"{fname} {k}: {segments(features,k,args['min_length'])}")
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Lens undistortion and stereo rectification of extracted frames.
+
+calibrate_camera.py (single cameras) and calibrate_pair.py (stereo) estimate the
+intrinsics of the cameras on frames reduced and rotated in some way. Here we build, with
+cv2.initUndistortRectifyMap, the maps that take each output pixel to its position in the
+frame as it comes out of the decoder, which may be at full resolution and unrotated. Since
+the reduction and rotation are composed into the maps, a single cv2.remap replaces the
+resize of ReduceStage (see RemapStage in vutils.py): correcting frames costs about the same
+as not correcting them.
+
+The illumination gain maps are defined on the distorted frames; they are remapped once
+with the same maps, so that RectifyStage can be applied to the corrected frames.
+
+Maps are computed once per camera model, input shape, resolution and rotation, and kept
+in memory (they are cheap to compute but large).
+"""
+
+import collections
+import hashlib
+import json
+import os
+import numpy as np
+import cv2
+
+INTRINSICS_FNAME = "calibration_intrinsics.json"
+STEREO_FNAME = "stereo_calibration.json"
+LEGACY_RESCALE_FACTOR = 4   # default of calibrate_camera.py when the resolution was not recorded
+MAX_MAPS = 4
+
+_maps = collections.OrderedDict()
+
+
+def load_camera_model(calibration_dir, camera=1, stereo=False, rot=0):
+    """
+    Camera model of camera (1 or 2) in calibration_dir, as a dict with its camera matrix,
+    distortion coefficients, rectification rotation R (None for plain undistortion), new
+    projection matrix P and the rescale_factor and rotation of the frames they refer to.
+    stereo uses the rectification of stereo_calibration.json (calibrate_pair.py); otherwise
+    the output of calibrate_camera.py is used. rot is assumed for old calibrations, which
+    do not record it.
+    """
+    if stereo:
+        with open(os.path.join(calibration_dir, STEREO_FNAME), "r") as f:
+            calibration = json.loads(f.read())
+        model = {"camera_matrix": calibration[f"camera_matrix_{camera}"],
+                 "distortion_coeffs": calibration[f"distortion_coeffs_{camera}"],
+                 "R": calibration[f"R{camera}"],
+                 "P": calibration[f"P{camera}"],
+                 "rescale_factor": calibration["rescale_factor"],
+                 "rot": calibration[f"rot{camera}"]}
+    else:
+        prefix = "" if camera == 1 else f"camera{camera}_"
+        fname = os.path.join(calibration_dir, prefix + INTRINSICS_FNAME)
+        if os.path.exists(fname):
+            with open(fname, "r") as f:
+                model = json.loads(f.read())
+        else:
+            # calibrations made before the intrinsics were saved as JSON
+            print(f"WARNING: {fname} not found; assuming the calibration was done at rescale factor {LEGACY_RESCALE_FACTOR}")
+            load = lambda name: np.loadtxt(os.path.join(calibration_dir, prefix + name)).tolist()
+            model = {"camera_matrix": load("calibration_matrix.txt"),
+                     "distortion_coeffs": load("calibration_distortion_coeffs.txt"),
+                     "optimal_matrix": load("calibration_optimal_matrix.txt"),
+                     "rescale_factor": LEGACY_RESCALE_FACTOR,
+                     "rot": rot}
+        model = {"camera_matrix": model["camera_matrix"],
+                 "distortion_coeffs": model["distortion_coeffs"],
+                 "R": None,
+                 "P": model["optimal_matrix"],
+                 "rescale_factor": model["rescale_factor"],
+                 "rot": model["rot"]}
+    model["key"] = hashlib.sha1(json.dumps(model, sort_keys=True).encode("utf-8")).hexdigest()
+    return model
+
+
+def _scale_matrix(s):
+    # pixel x at one resolution is at (x + 0.5)*s - 0.5 at a resolution s times larger
+    return np.array([[s, 0, (s-1)/2], [0, s, (s-1)/2], [0, 0, 1]])
+
+
+def _source_coords(mapx, mapy, reduced_shape, rescale_factor, rot):
+    """
+    Takes coordinates in the reduced and rotated frame to the decoded (full resolution,
+    unrotated) frame; reduced_shape is the (h,w) of the reduced frame before rotating.
+    Inverse of fast_rot for multiples of 90 degrees.
+    """
+    h, w = reduced_shape
+    rot = rot % 360
+    if rot == 90:
+        mapx, mapy = mapy, (h - 1) - mapx
+    elif rot == 270:
+        mapx, mapy = (w - 1) - mapy, mapx
+    elif rot == 180:
+        mapx, mapy = (w - 1) - mapx, (h - 1) - mapy
+    elif rot != 0:
+        raise ValueError(f"undistortion only supports rotations by multiples of 90 degrees (got {rot})")
+    r = rescale_factor
+    return (mapx + 0.5)*r - 0.5, (mapy + 0.5)*r - 0.5
+
+
+def undistort_maps(model, shape, rescale_factor=1, rot=0, transformed=True):
+    """
+    cv2.remap maps producing the corrected frames reduced rescale_factor times and rotated
+    rot degrees, from decoded frames of the given shape: already reduced and rotated if
+    transformed, full resolution and unrotated otherwise.
+    """
+    if (rot - model["rot"]) % 360:
+        raise ValueError(f"camera was calibrated on frames rotated {model['rot']} degrees, not {rot}")
+    h, w = shape[:2]
+    if transformed:
+        out_h, out_w = h, w
+    else:
+        reduced_shape = (h//rescale_factor, w//rescale_factor)
+        out_h, out_w = reduced_shape if rot % 180 == 0 else reduced_shape[::-1]
+    # camera model at the output resolution
+    scale = _scale_matrix(model["rescale_factor"]/rescale_factor)
+    mtx = scale @ np.array(model["camera_matrix"])
+    P = scale @ np.array(model["P"])
+    R = np.eye(3) if model["R"] is None else np.array(model["R"])
+    mapx, mapy = cv2.initUndistortRectifyMap(mtx, np.array(model["distortion_coeffs"]), R, P,
+                                             (out_w, out_h), cv2.CV_32FC1)
+    if not transformed:
+        mapx, mapy = _source_coords(mapx, mapy, reduced_shape, rescale_factor, rot)
+    # fixed point maps are faster to apply
+    return cv2.convertMaps(mapx.astype(np.float32), mapy.astype(np.float32), cv2.CV_16SC2)
+
+
+def source_points(points, shape, rescale_factor=1, rot=0, model=None):
+    """
+    Takes (n x 2) points of an extracted frame (reduced rescale_factor times, rotated rot
+    degrees and, if model is given, corrected with it) to the full resolution, unrotated
+    decoded frame, of the given (h,w) shape. Same mapping as the maps of undistort_maps.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if model is not None:
+        scale = _scale_matrix(model["rescale_factor"]/rescale_factor)
+        mtx = scale @ np.array(model["camera_matrix"])
+        P = (scale @ np.array(model["P"]))[:, :3]
+        R = np.eye(3) if model["R"] is None else np.array(model["R"])
+        rays = (np.linalg.inv(P @ R) @ np.column_stack((points, np.ones(len(points)))).T).T
+        points, _ = cv2.projectPoints(rays, np.zeros(3), np.zeros(3), mtx, np.array(model["distortion_coeffs"]))
+        points = points.reshape(-1, 2)
+    h, w = shape[:2]
+    x, y = _source_coords(points[:, 0], points[:, 1], (h//rescale_factor, w//rescale_factor), rescale_factor, rot)
+    return np.column_stack((x, y))
+
+
+def get_undistort_maps(model, shape, rescale_factor=1, rot=0, transformed=True):
+    """
+    undistort_maps, cached in memory
+    """
+    key = (model["key"], tuple(shape[:2]), rescale_factor, rot, transformed)
+    if key in _maps:
+        _maps.move_to_end(key)
+        return _maps[key]
+    maps = undistort_maps(model, shape, rescale_factor, rot, transformed)
+    _maps[key] = maps
+    while len(_maps) > MAX_MAPS:
+        _maps.popitem(last=False)
+    return maps
+
+
+def remap(image, maps):
+    """
+    Applies maps (see get_undistort_maps) to image; points that fall outside are black
+    """
+    return cv2.remap(image, maps[0], maps[1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Selection of calibration views and incremental camera calibration.
+
+A calibration session gives us hundreds or thousands of frames with the pattern, but
+consecutive frames are nearly identical: they make cv2.calibrateCamera much slower without
+adding information. What constrains the intrinsics is having the pattern in many different
+places of the image, at different distances and tilted in different directions, and sharp.
+
+select_views() describes each view by the position, scale and tilt of the pattern and by
+its sharpness, and greedily picks the view that is farthest (in that space) from the ones
+already picked and that covers more of the image not covered yet, weighted by sharpness.
+
+incremental_calibration() then calibrates with the first views in that order, and keeps
+adding views (starting from the previous solution) until the RMS error stops changing.
+"""
+
+import numpy as np
+import cv2
+
+COVERAGE_CELLS = 8      # the image is divided in COVERAGE_CELLS x COVERAGE_CELLS cells
+COVERAGE_WEIGHT = 1.0   # weight of the newly covered area in the greedy score
+MAX_VIEWS = 40
+INITIAL_VIEWS = 10
+STEP_VIEWS = 5
+RMS_TOL = 0.01          # relative change of the RMS error considered converged
+
+
+def view_sharpness(gray, centers):
+    """
+    Variance of the Laplacian on the bounding box of the pattern
+    """
+    pts = centers.reshape(-1, 2)
+    h, w = gray.shape[:2]
+    x0, y0 = np.maximum(0, np.floor(pts.min(axis=0)).astype(int))
+    x1, y1 = np.minimum((w, h), np.ceil(pts.max(axis=0)).astype(int) + 1)
+    if x1 - x0 < 3 or y1 - y0 < 3:
+        return 0.0
+    return float(cv2.Laplacian(gray[y0:y1, x0:x1], cv2.CV_32F).var())
+
+
+def view_features(centers, frame_size):
+    """
+    (x, y, scale, horizontal tilt, vertical tilt) of a view, and its coverage mask.
+    Position and scale are relative to the frame size; tilts are the log ratios of the
+    lengths of opposite sides of the pattern hull (0 when seen straight on).
+    """
+    w, h = frame_size
+    pts = centers.reshape(-1, 2).astype(np.float32)
+    hull = cv2.convexHull(pts)
+    area = cv2.contourArea(hull)
+    x, y = pts.mean(axis=0)
+    scale = np.sqrt(area/(w*h))
+    # quadrilateral approximation of the hull: the extreme points along the diagonals
+    s = pts.sum(axis=1)
+    d = pts[:, 0] - pts[:, 1]
+    tl, br, tr, bl = pts[np.argmin(s)], pts[np.argmax(s)], pts[np.argmax(d)], pts[np.argmin(d)]
+    eps = 1e-6
+    tilt_x = np.log((np.linalg.norm(tl-bl) + eps)/(np.linalg.norm(tr-br) + eps))
+    tilt_y = np.log((np.linalg.norm(tl-tr) + eps)/(np.linalg.norm(bl-br) + eps))
+    mask = np.zeros((COVERAGE_CELLS, COVERAGE_CELLS), dtype=np.uint8)
+    cells = np.round(hull.reshape(-1, 2)*[COVERAGE_CELLS/w, COVERAGE_CELLS/h]).astype(np.int32)
+    cv2.fillConvexPoly(mask, cells, 1)
+    return np.array([x/w, y/h, scale, tilt_x, tilt_y]), mask.astype(bool)
+
+
+def select_views(img_points, frame_size, sharpness=None, max_views=MAX_VIEWS):
+    """
+    Greedily orders (and keeps at most max_views of) the views given by their image points.
+    Returns the list of selected view indexes, most informative first.
+    """
+    n = len(img_points)
+    if n == 0:
+        return []
+    feats = list()
+    masks = list()
+    for centers in img_points:
+        f, m = view_features(centers, frame_size)
+        feats.append(f)
+        masks.append(m)
+    feats = np.array(feats)
+    masks = np.array(masks)
+    # features normalized so that each one has a similar spread
+    spread = feats.std(axis=0)
+    feats = (feats - feats.mean(axis=0))/np.where(spread > 0, spread, 1)
+    if sharpness is None:
+        weight = np.ones(n)
+    else:
+        sharpness = np.asarray(sharpness, dtype=np.float64)
+        weight = np.sqrt(sharpness/max(sharpness.max(), 1e-9))
+    covered = np.zeros(masks.shape[1:], dtype=bool)
+    selected = [int(np.argmax(weight*(1 + masks.reshape(n, -1).sum(axis=1)/covered.size)))]
+    covered |= masks[selected[0]]
+    min_dist = np.linalg.norm(feats - feats[selected[0]], axis=1)
+    available = np.ones(n, dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < min(n, max_views):
+        new_cells = (masks & ~covered).reshape(n, -1).sum(axis=1)/covered.size
+        score = weight*(min_dist + COVERAGE_WEIGHT*new_cells)
+        score[~available] = -np.inf
+        best = int(np.argmax(score))
+        selected.append(best)
+        available[best] = False
+        covered |= masks[best]
+        min_dist = np.minimum(min_dist, np.linalg.norm(feats - feats[best], axis=1))
+    return selected
+
+
+def incremental_calibration(obj_points, img_points, frame_size, initial=INITIAL_VIEWS, step=STEP_VIEWS,
+                            tol=RMS_TOL, flags=0):
+    """
+    Calibrates with the first initial views, then adds step views at a time (using the
+    previous solution as initial guess) until the RMS error changes less than tol (relative)
+    or all the views are used. Views should come ordered by select_views.
+    Returns (rms, mtx, dist, rvecs, tvecs, number of views used), as cv2.calibrateCamera.
+    """
+    n = len(obj_points)
+    k = min(n, max(initial, 1))
+    rms, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(obj_points[:k], img_points[:k], frame_size, None, None, flags=flags)
+    print(f"\t{k:4d} views: RMS {rms:.4f}")
+    while k < n:
+        k = min(n, k + step)
+        prev = rms
+        rms, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(obj_points[:k], img_points[:k], frame_size, mtx, dist,
+                                                           flags=flags | cv2.CALIB_USE_INTRINSIC_GUESS)
+        print(f"\t{k:4d} views: RMS {rms:.4f}")
+        if abs(rms - prev) <= tol*max(prev, 1e-9):
+            break
+    return rms, mtx, dist, rvecs, tvecs, k
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Per-video frame index for frame-accurate random access.
+
+The index maps each frame number (in presentation order, the same numbering used by
+cv2.VideoCapture) to its presentation time stamp (PTS), the byte offset of its compressed
+sample within the file and the nearest preceding keyframe. It is built once by a demux-only
+pass over the MP4 sample tables (no decoding at all, it takes a fraction of a second even
+for long GoPro takes) and cached next to the video as <video>.idx.npz.
+
+With the index, reaching frame N amounts to seeking to its keyframe (which every backend
+does right) and decoding only the tail of the GOP, instead of decoding every frame from the
+start of the take "a lo bestia".
+"""
+
+import os
+import struct
+import numpy as np
+import cv2
+
+INDEX_SUFFIX = ".idx.npz"
+INDEX_VERSION = 1
+
+# boxes that only contain other boxes and that we need to traverse
+CONTAINER_BOXES = (b"moov", b"trak", b"mdia", b"minf", b"stbl", b"edts")
+
+
+def _iter_boxes(f, start, end):
+    """
+    Iterate over the ISO-BMFF boxes found in f between start and end.
+    Yields (type, payload offset, payload size)
+    """
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack(">I4s", header)
+        hlen = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            hlen = 16
+        elif size == 0:
+            size = end - pos
+        if size < hlen:
+            return
+        yield kind, pos + hlen, size - hlen
+        pos += size
+
+
+def _read_full_box(f, offset, size):
+    """
+    Reads a 'full box' payload (version + flags + data)
+    """
+    f.seek(offset)
+    data = f.read(size)
+    version = data[0]
+    return version, data[4:]
+
+
+def _parse_trak(f, offset, size):
+    """
+    Collects the sample tables of a single track
+    """
+    track = dict()
+    def walk(start, end):
+        for kind, off, sz in _iter_boxes(f, start, end):
+            if kind in CONTAINER_BOXES:
+                walk(off, off + sz)
+            elif kind == b"hdlr":
+                _, data = _read_full_box(f, off, sz)
+                track["handler"] = data[4:8]
+            elif kind == b"mdhd":
+                version, data = _read_full_box(f, off, sz)
+                if version == 1:
+                    track["timescale"] = struct.unpack(">I", data[16:20])[0]
+                else:
+                    track["timescale"] = struct.unpack(">I", data[8:12])[0]
+            elif kind in (b"stts", b"ctts", b"stss", b"stsz", b"stsc", b"stco", b"co64"):
+                track[kind.decode()] = _read_full_box(f, off, sz)
+    walk(offset, offset + size)
+    return track
+
+
+def _sample_table(track):
+    """
+    Expands the compact MP4 sample tables into per-sample arrays (in decode order):
+    decode time, composition offset, byte offset, size and sync (keyframe) flag
+    """
+    # decoding times
+    _, data = track["stts"]
+    n = struct.unpack(">I", data[:4])[0]
+    stts = np.frombuffer(data[4:4 + 8 * n], dtype=">u4").reshape(-1, 2).astype(np.int64)
+    deltas = np.repeat(stts[:, 1], stts[:, 0])
+    nsamples = len(deltas)
+    dts = np.zeros(nsamples, dtype=np.int64)
+    dts[1:] = np.cumsum(deltas)[:-1]
+    # composition offsets (B-frames); version 1 allows negative offsets
+    cts = np.zeros(nsamples, dtype=np.int64)
+    if "ctts" in track:
+        version, data = track["ctts"]
+        n = struct.unpack(">I", data[:4])[0]
+        ctts = np.frombuffer(data[4:4 + 8 * n], dtype=">u4" if version == 0 else ">i4").reshape(-1, 2).astype(np.int64)
+        cts[:] = np.repeat(ctts[:, 1], ctts[:, 0])[:nsamples]
+    # sample sizes
+    _, data = track["stsz"]
+    fixed_size, n = struct.unpack(">II", data[:8])
+    if fixed_size:
+        sizes = np.full(n, fixed_size, dtype=np.int64)
+    else:
+        sizes = np.frombuffer(data[8:8 + 4 * n], dtype=">u4").astype(np.int64)
+    # chunk offsets
+    if "co64" in track:
+        _, data = track["co64"]
+        n = struct.unpack(">I", data[:4])[0]
+        chunk_offsets = np.frombuffer(data[4:4 + 8 * n], dtype=">u8").astype(np.int64)
+    else:
+        _, data = track["stco"]
+        n = struct.unpack(">I", data[:4])[0]
+        chunk_offsets = np.frombuffer(data[4:4 + 4 * n], dtype=">u4").astype(np.int64)
+    # sample to chunk: (first chunk, samples per chunk, description index)
+    _, data = track["stsc"]
+    n = struct.unpack(">I", data[:4])[0]
+    stsc = np.frombuffer(data[4:4 + 12 * n], dtype=">u4").reshape(-1, 3).astype(np.int64)
+    nchunks = len(chunk_offsets)
+    first_chunk = np.append(stsc[:, 0] - 1, nchunks)
+    samples_per_chunk = np.repeat(stsc[:, 1], np.diff(first_chunk))
+    chunk_of_sample = np.repeat(np.arange(nchunks), samples_per_chunk)[:nsamples]
+    first_sample_of_chunk = np.concatenate(([0], np.cumsum(samples_per_chunk)[:-1]))
+    size_cumsum = np.concatenate(([0], np.cumsum(sizes)))
+    offsets = chunk_offsets[chunk_of_sample] + \
+        size_cumsum[:nsamples] - size_cumsum[first_sample_of_chunk[chunk_of_sample]]
+    # sync samples; if there is no stss box, every sample is a keyframe
+    keyframe = np.ones(nsamples, dtype=bool)
+    if "stss" in track:
+        _, data = track["stss"]
+        n = struct.unpack(">I", data[:4])[0]
+        sync = np.frombuffer(data[4:4 + 4 * n], dtype=">u4").astype(np.int64) - 1
+        keyframe[:] = False
+        keyframe[sync[sync < nsamples]] = True
+    return dts, cts, offsets, sizes[:nsamples], keyframe
+
+
+def build_index(video_fname):
+    """
+    Demux-only pass over an MP4 file. Returns a dict of per-frame arrays in presentation order:
+    * pts: presentation time stamp, in seconds
+    * offset: byte offset of the compressed sample in the file
+    * size: size in bytes of the compressed sample
+    * keyframe: index of the nearest keyframe at or before each frame
+    """
+    file_size = os.path.getsize(video_fname)
+    with open(video_fname, "rb") as f:
+        video_track = None
+        for kind, off, sz in _iter_boxes(f, 0, file_size):
+            if kind != b"moov":
+                continue
+            for tkind, toff, tsz in _iter_boxes(f, off, off + sz):
+                if tkind != b"trak":
+                    continue
+                track = _parse_trak(f, toff, tsz)
+                if track.get("handler") == b"vide":
+                    video_track = track
+                    break
+        if video_track is None:
+            raise ValueError(f"no video track found in {video_fname}")
+        dts, cts, offsets, sizes, keyframe = _sample_table(video_track)
+    timescale = video_track["timescale"]
+    pts_ticks = dts + cts
+    # frames are numbered in presentation order
+    order = np.argsort(pts_ticks, kind="stable")
+    pts_ticks = pts_ticks[order]
+    pts_ticks -= pts_ticks[0]
+    is_key = keyframe[order]
+    key_positions = np.flatnonzero(is_key)
+    if len(key_positions) == 0 or key_positions[0] != 0:
+        key_positions = np.concatenate(([0], key_positions))
+    nearest_key = key_positions[np.searchsorted(key_positions, np.arange(len(order)), side="right") - 1]
+    return {
+        "version": INDEX_VERSION,
+        "pts": pts_ticks / timescale,
+        "offset": offsets[order],
+        "size": sizes[order],
+        "keyframe": nearest_key.astype(np.int64),
+        "timescale": timescale,
+        "file_size": file_size,
+        "file_mtime": os.path.getmtime(video_fname),
+    }
+
+
+def index_filename(video_fname):
+    return video_fname + INDEX_SUFFIX
+
+
+def load_index(video_fname, rebuild=False):
+    """
+    Returns the frame index of a video, building it and caching it next to the video
+    if it does not exist or is stale (the video changed since it was built).
+    """
+    idx_fname = index_filename(video_fname)
+    if not rebuild and os.path.exists(idx_fname):
+        with np.load(idx_fname) as data:
+            index = {k: data[k] for k in data.files}
+        if int(index["version"]) == INDEX_VERSION and \
+           int(index["file_size"]) == os.path.getsize(video_fname) and \
+           float(index["file_mtime"]) == os.path.getmtime(video_fname):
+            return index
+    print("building frame index for", video_fname)
+    index = build_index(video_fname)
+    try:
+        tmp_fname = f"{idx_fname}.{os.getpid()}.tmp.npz" # several processes may be indexing the same video
+        np.savez(tmp_fname, **index)
+        os.replace(tmp_fname, idx_fname)
+    except OSError as e:
+        print("WARNING: could not cache frame index:", e)
+    return index
+
+
+def current_frame(cap, index):
+    """
+    Frame number of the last frame grabbed by cap, according to its PTS.
+    """
+    t = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+    pts = index["pts"]
+    i = int(np.searchsorted(pts, t))
+    if i >= len(pts):
+        return len(pts) - 1
+    if i > 0 and (t - pts[i - 1]) < (pts[i] - t):
+        i -= 1
+    return i
+
+
+def seek_frame(cap, index, target):
+    """
+    Positions cap so that the next read() returns frame number target.
+    We seek to the keyframe preceding the target, check where we actually landed
+    using the PTS of the grabbed frame, and decode (grab) only the remaining GOP tail.
+    If the backend landed after the target, we fall back to decoding from the start.
+    Returns the number of frames decoded to get there.
+    """
+    nframes = len(index["pts"])
+    target = max(0, min(int(target), nframes))
+    if target == 0 or getattr(cap, "exact_seek", False):
+        # frame sources that seek exactly by themselves (e.g. ffsource.FFmpegCapture)
+        cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+        return 0
+    key = int(index["keyframe"][min(target, nframes - 1)])
+    cap.set(cv2.CAP_PROP_POS_FRAMES, key)
+    if not cap.grab():
+        return 0
+    decoded = 1
+    landed = current_frame(cap, index)
+    if landed == target and key == target:
+        # target is itself a keyframe and we now know the seek is exact: do it again
+        cap.set(cv2.CAP_PROP_POS_FRAMES, key)
+        return decoded
+    if landed >= target:
+        # overshoot: this should not happen with a correct index, but be safe
+        print(f"WARNING: seek to keyframe {key} landed on frame {landed}. Decoding from the start.")
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        landed = -1
+    while landed < target - 1:
+        if not cap.grab():
+            break
+        decoded += 1
+        landed += 1
+    return decoded
+
+
+def sample_frames(cap, index, ini_frame, fin_frame, skip, stats=None, reuse=True, frames=None):
+    """
+    Sparse sampling planner: yields (frame number, frame) for frames ini_frame, ini_frame+skip, ...
+    up to (not including) fin_frame, or for the (increasing) frame numbers in frames, if given.
+    cap must be positioned so that its next frame is ini_frame.
+    Dropped frames are only grabbed (demuxed and decoded, but never converted to BGR arrays);
+    if the index is given and there is a keyframe between the current position and the next
+    wanted frame, we jump straight to that keyframe and skip the frames in between altogether.
+    If stats (a dict) is given, it is updated with the number of frames grabbed (decoded),
+    retrieved (converted) and emitted, and the number of keyframe jumps.
+    With reuse=True every frame is retrieved into the same buffer; use reuse=False if
+    the frames are kept after the next one is requested.
+    """
+    if stats is None:
+        stats = dict()
+    for k in ("grabbed", "retrieved", "emitted", "jumps"):
+        stats.setdefault(k, 0)
+    frame = None
+    pos = ini_frame # next frame to be grabbed
+    seek_cost = getattr(cap, "seek_cost", 0) # frames worth of decoding that a seek costs
+    if frames is None:
+        frames = range(ini_frame, fin_frame, max(1, skip))
+    for target in frames:
+        if index is not None and target < len(index["keyframe"]) and index["keyframe"][target] > pos \
+           and target - pos > seek_cost:
+            stats["grabbed"] += seek_frame(cap, index, target)
+            stats["jumps"] += 1
+            pos = target
+        while pos < target:
+            if not cap.grab():
+                return
+            stats["grabbed"] += 1
+            pos += 1
+        if not cap.grab():
+            return
+        stats["grabbed"] += 1
+        pos += 1
+        ret, frame = cap.retrieve(frame if reuse else None)
+        if not ret:
+            return
+        stats["retrieved"] += 1
+        stats["emitted"] += 1
+        yield target, frame
+
+
+def print_sampling_stats(stats, elapsed):
+    """
+    One line summary of the work done by sample_frames
+    """
+    emitted = max(1, stats["emitted"])
+    print(f'decoded {stats["grabbed"]} frames, emitted {stats["emitted"]} '
+          f'({stats["grabbed"]/emitted:.2f} decoded per emitted frame), '
+          f'{stats["jumps"]} keyframe jumps, {stats["emitted"]/max(elapsed,1e-6):.2f} emitted fps')
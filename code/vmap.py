@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Map over video segments on a process pool.
+
+Scanning a whole take (QR detection, white frame statistics, ...) is decoding bound, and a
+single decoder does not use more than a couple of cores. Here a video is split in
+segments that start at keyframes (see vindex.py), so that each one can be decoded on its
+own from its first frame without decoding anything before it, and each segment is handed
+to a worker process with its own decoder.
+
+The work done on each segment is described by a mapper: an object, built in the worker by
+mapper_factory() (which must be picklable: a top level class or function, or a
+functools.partial of one), with two methods:
+
+    process(index, frame)   called for each frame of the segment, in order
+    result()                called at the end; its value is sent back to the parent
+
+and optionally a third one:
+
+    more(index, end)        called when the segment (which ends at frame end, not
+                            included) is done, before each frame index that follows it;
+                            while it returns True those frames are also processed, so
+                            that what is being followed at the end of the segment (e.g.
+                            a tracked code) is followed into the next one
+
+map_video() yields the result of each segment in frame order, so the caller merges them
+(writes rows, merges accumulators, drops what more() processed twice, joins events that
+cross segment boundaries) as they arrive.
+"""
+
+import concurrent.futures
+import os
+import numpy as np
+import cv2
+
+from ffsource import open_video
+from vindex import load_index, sample_frames
+
+
+def init_worker():
+    """
+    Initializer of pools of OpenCV workers (one per core): keeps OpenCV from spawning
+    threads in each of them
+    """
+    cv2.setNumThreads(1)
+
+
+def split_video(video_fname, nsegments, ini_frame=0, end_frame=None):
+    """
+    Splits frames ini_frame to end_frame (not included) of the video in about nsegments
+    (ini, end) segments of similar length, all of them but the first starting at a keyframe.
+    """
+    try:
+        keyframe = load_index(video_fname)["keyframe"]
+    except (OSError, ValueError, KeyError) as e:
+        print(f"WARNING: no frame index for {video_fname} ({e}); segments will not be keyframe aligned")
+        keyframe = None
+    if end_frame is None:
+        if keyframe is not None:
+            end_frame = len(keyframe)
+        else:
+            cap = cv2.VideoCapture(video_fname)
+            end_frame = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            cap.release()
+    nsegments = max(1, min(nsegments, end_frame - ini_frame))
+    bounds = [ini_frame]
+    for k in range(1, nsegments):
+        b = ini_frame + (k*(end_frame - ini_frame))//nsegments
+        if keyframe is not None and b < len(keyframe):
+            b = int(keyframe[b])
+        if b > bounds[-1]:
+            bounds.append(b)
+    bounds.append(end_frame)
+    return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def map_frames(video_fname, ini_frame, end_frame, mapper_factory, backend="opencv", rescale_factor=1, rot=0,
+               pix_fmt="bgr24", frames=None):
+    """
+    Runs a mapper (see above) on frames ini_frame to end_frame (not included) of the video,
+    or only on those of frames (an increasing sequence of frame numbers) in that range, and
+    then on the following ones (of frames, if given) while mapper.more() says so.
+    Returns mapper.result().
+    With the opencv backend frames are full size BGR; with ffmpeg they come reduced, rotated
+    and in pix_fmt (see ffsource.open_video).
+    """
+    mapper = mapper_factory()
+    more = getattr(mapper, "more", None)
+    cap, _ = open_video(video_fname, backend, rescale_factor, rot, pix_fmt=pix_fmt, start_frame=ini_frame)
+    try:
+        if frames is not None:
+            frames = [f for f in frames if f >= ini_frame]
+            if more is None:
+                frames = [f for f in frames if f < end_frame]
+            try:
+                index = load_index(video_fname)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"WARNING: no frame index for {video_fname} ({e}); frames will be reached by decoding")
+                index = None
+            for n, frame in sample_frames(cap, index, ini_frame, end_frame, 1, frames=frames):
+                if n >= end_frame and not more(n, end_frame):
+                    break
+                mapper.process(n, frame)
+        else:
+            frame = None
+            n = ini_frame
+            while n < end_frame or (more is not None and more(n, end_frame)):
+                ret, frame = cap.read(frame)
+                if not ret:
+                    break
+                mapper.process(n, frame)
+                n += 1
+    finally:
+        cap.release()
+    return mapper.result()
+
+
+def map_video(video_fname, mapper_factory, jobs=None, nsegments=None, ini_frame=0, end_frame=None,
+              backend="opencv", rescale_factor=1, rot=0, pix_fmt="bgr24", frames=None):
+    """
+    Splits the video in nsegments keyframe aligned segments (one per job by default), runs
+    map_frames on each of them on jobs processes (one per core by default) and yields
+    ((ini, end), result) for each segment, in frame order. Each segment gets the frames
+    from its start on; those after its end are only used if the mapper asks for them.
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if nsegments is None:
+        nsegments = jobs
+    segments = split_video(video_fname, nsegments, ini_frame, end_frame)
+    if frames is not None:
+        frames = np.asarray(frames)
+    args = (mapper_factory, backend, rescale_factor, rot, pix_fmt)
+    if jobs <= 1 or len(segments) == 1:
+        for ini, end in segments:
+            yield (ini, end), map_frames(video_fname, ini, end, *args,
+                                         frames=frames[frames >= ini] if frames is not None else None)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_worker) as pool:
+        futures = [pool.submit(map_frames, video_fname, ini, end, *args,
+                               frames=frames[frames >= ini] if frames is not None else None)
+                   for ini, end in segments]
+        for (ini, end), f in zip(segments, futures):
+            yield (ini, end), f.result()
@@ -1,12 +1,26 @@
+import os
+import time
+import queue
+import threading
 import numpy as np
 import skimage.transform as trans
 import cv2
 import matplotlib.pyplot as plt
+from vindex import load_index, seek_frame, sample_frames, print_sampling_stats
+from ffsource import open_video
+from illumination import apply_gain
 
 def compute_offsets(annotations):
     sync_1 = annotations["sync_1_frame"]
     sync_2 = annotations["sync_2_frame"]
 
+    if sync_1 < 0 and sync_2 < 0 and annotations.get("auto_offset") is not None:
+        # not annotated by hand, but estimated by autosync.py
+        offset = [0,int(round(annotations["auto_offset"]))]
+        print(f"Using automatic sync offset {annotations['auto_offset']:.2f} "
+              f"(confidence {annotations.get('auto_offset_confidence',0):.2f}): input 2 {offset[1]}")
+        return offset
+
     if sync_1 < 0:
         sync_1 = 0
         print("WARNING: Assuming sync frame 1 is 0 (does not seem right but...)")
@@ -68,56 +82,470 @@ def fast_rot(img,rot):
         return (255*trans.rotate(img,rot,resize=True)).astype(np.uint8) # rotation scales colors to 0-1!!
 
 
-def guess_orientation(cap):
+ORIENTATION_SAMPLES = 32  # frames looked at by guess_orientation
+THUMB_WIDTH = 160         # width of the thumbnails used by guess_orientation
+
+def guess_orientation(cap, nsamples=ORIENTATION_SAMPLES, thumb_width=THUMB_WIDTH, proxy=None):
     """
-    Guess orientation of video frames
+    Guess orientation of video frames.
+    Frames must end up in portrait, with the blue side at the bottom. We look at nsamples
+    frames spread over the whole take, reduced to thumbnails, and each one votes for the
+    side where there is more blue. Returns the angle and the confidence (fraction of the
+    frames that agree with it, 0.5 to 1).
+    If the proxy of the video (see proxy.py) is given, frames are taken from it and cap is
+    not touched; otherwise the position of cap is left at the beginning of the video.
     """
-    cap.set(cv2.CAP_PROP_POS_AVI_RATIO, 0.25) # start somewhere in the middle of the footage
-    frame = None
-    angle = None
-    blue_profile = None
+    nframes = len(proxy) if proxy is not None else int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    blue_channel = 2 if proxy is not None else 0 # proxies are RGB, decoded frames BGR
+    by_ratio = True
+    votes = 0
     n = 0
-    while (cap.isOpened()): # ----- loop over frames
-        # Capture frame-by-frame
-        if frame is None:
+    landscape = None
+    # skip the ends of the take, where the camera is being handled
+    for t in np.linspace(0.05, 0.95, nsamples):
+        # seeking by frame number does not work well with some backends, and by ratio with others
+        ret = False
+        if proxy is not None:
+            ret = nframes > 0
+            frame = proxy[min(nframes-1,int(t*nframes))] if ret else None
+        elif by_ratio:
+            cap.set(cv2.CAP_PROP_POS_AVI_RATIO, t)
+            ret, frame = cap.read()
+            by_ratio = ret or nframes <= 0
+        if not ret and nframes > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, int(t*nframes))
             ret, frame = cap.read()
-        else:
-            ret, frame = cap.read(frame)
         if not ret:
-            break
+            continue
+        h,w,_ = frame.shape
+        if landscape is None:
+            # first we check whether it is landscape or portrait
+            landscape = h < w
+            print("height",h,"width",w,"landscape" if landscape else "portrait")
+        thumb = cv2.resize(frame,(thumb_width,max(1,thumb_width*h//w)),interpolation=cv2.INTER_AREA)
+        # what will be the top of the portrait frame is the left side of a landscape frame
+        # rotated 90 degrees
+        blue = thumb[:,:,blue_channel].astype(np.float32)
+        profile = blue.mean(axis=0) if landscape else blue.mean(axis=1)
+        quarter = max(1,len(profile)//4)
+        votes += profile[:quarter].mean() > profile[-quarter:].mean() # more blue on top
         n += 1
-        # first we check whether it is landscape or portrait
-        # should be portrait.
-        # this is done only once
-        h,w,c = frame.shape
-        if angle == None:
-            if h < w:
-                angle = 90
-            else:
-                angle = 0
-            print("height",h,"width",w,"angle",angle)
-        #
-        # rotate to portrait
-        #
-        rot_frame = fast_rot(frame,angle)
-        #
-        # now see where there is more blue
-        # should be on the lower half
-        if blue_profile is None:
-            # frames are BGR
-            blue_profile = np.squeeze(np.sum(rot_frame[:,:,0],axis=1))
+    if proxy is None:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    if n == 0:
+        print("WARNING: could not read any frame to guess the orientation")
+        return 0, 0.0
+    flip = votes > n/2
+    if landscape:
+        angle = 270 if flip else 90
+    else:
+        angle = 180 if flip else 0
+    return angle, float(max(votes,n-votes)/n)
+
+
+#
+# ---------------------------------------------------------------------------------------
+# streaming frame pipeline
+# ---------------------------------------------------------------------------------------
+#
+# A pipeline is a source of frame items, a list of stages and a sink:
+#
+#    source -> stage -> stage -> ... -> sink
+#
+# A frame item is a dict with (at least) the frame number "index", the current "image" and
+# whether the image was already "transformed" (reduced, RGB, rotated) by the decoder. Each
+# stage takes an item and returns it, possibly modified, or None to drop it. Every stage
+# keeps its own call and time counters, so Pipeline.report() tells where the time goes.
+#
+# With threaded=True each stage (and the source) runs on its own thread, connected by
+# small bounded queues, so decoding, rectification, QR detection and writing overlap
+# (OpenCV and numpy release the GIL). Items still go through each stage in order, so
+# stateful stages (e.g. QR tracking) work the same in both modes.
+#
+
+class Stage():
+    '''
+    Base class for pipeline stages. Subclasses implement process(item).
+    '''
+    def __init__(self, name=None):
+        self.name = name if name is not None else type(self).__name__
+        self.calls = 0
+        self.seconds = 0.0
+
+    def process(self, item):
+        return item
+
+    def __call__(self, item):
+        t0 = time.time()
+        item = self.process(item)
+        self.seconds += time.time()-t0
+        self.calls += 1
+        return item
+
+    def close(self):
+        pass
+
+
+class FunctionStage(Stage):
+    '''
+    Wraps a function item -> item (or None) as a stage
+    '''
+    def __init__(self, fn, name=None):
+        super().__init__(name if name is not None else fn.__name__)
+        self.fn = fn
+
+    def process(self, item):
+        return self.fn(item)
+
+
+class VideoSource(Stage):
+    '''
+    Yields every skip-th frame of a video between ini_frame and fin_frame (not included),
+    as dicts with its frame number (index), presentation time in seconds (time) and image,
+    seeking through the frame index and only grabbing dropped frames (see vindex.sample_frames).
+    If frames (an increasing list of frame numbers) is given, only those frames are produced.
+    With the ffmpeg backend the frames come already reduced, rotated and in RGB.
+    '''
+    def __init__(self, fname, ini_frame=0, fin_frame=None, skip=1, backend="opencv",
+                 rescale_factor=1, rot=0, use_index=True, frames=None):
+        super().__init__("source")
+        self.fname = fname
+        self.ini_frame = max(0, ini_frame)
+        self.fin_frame = fin_frame
+        self.skip = skip
+        self.backend = backend
+        self.rescale_factor = rescale_factor
+        self.rot = rot
+        self.use_index = use_index
+        self.frames = frames
+        self.stats = dict()
+
+    def __iter__(self):
+        index = None
+        if self.use_index:
+            try:
+                index = load_index(self.fname)
+            except (ValueError, KeyError, OSError) as e:
+                print(f"WARNING: could not index {self.fname} ({e}). Seeking by brute force.")
+        t0 = time.time()
+        cap, transformed = open_video(self.fname, self.backend, self.rescale_factor, self.rot, pix_fmt="rgb24")
+        nframes = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = cap.get(cv2.CAP_PROP_FPS) or 1
+        fin_frame = nframes if self.fin_frame is None else min(self.fin_frame, nframes)
+        ini_frame = self.ini_frame
+        targets = None
+        if self.frames is not None:
+            targets = [f for f in self.frames if self.ini_frame <= f < fin_frame]
+            ini_frame = targets[0] if len(targets) else fin_frame
+        pos = 0
+        if index is not None:
+            self.stats["grabbed"] = seek_frame(cap, index, ini_frame)
+            pos = ini_frame
+        while pos < ini_frame and cap.grab(): # no index: brute force
+            pos += 1
+        self.seconds += time.time()-t0
+        frames = sample_frames(cap, index, ini_frame, fin_frame, self.skip, self.stats, reuse=False, frames=targets)
+        try:
+            while True:
+                t0 = time.time()
+                try:
+                    frame_index, frame = next(frames)
+                except StopIteration:
+                    break
+                finally:
+                    self.seconds += time.time()-t0
+                self.calls += 1
+                if index is not None and frame_index < len(index["pts"]):
+                    frame_time = float(index["pts"][frame_index])
+                else:
+                    frame_time = frame_index/fps
+                yield {"index": frame_index, "time": frame_time, "image": frame, "transformed": transformed}
+        finally:
+            cap.release()
+
+
+class ReduceStage(Stage):
+    '''
+    Reduces the frame by rescale_factor, converts BGR to RGB and rotates it
+    (unless the decoder already did it)
+    '''
+    def __init__(self, rescale_factor=1, rot=0):
+        super().__init__("reduce")
+        self.rescale_factor = rescale_factor
+        self.rot = rot
+
+    def process(self, item):
+        if item["transformed"]:
+            return item
+        frame = item["image"]
+        h, w = frame.shape[:2]
+        if self.rescale_factor != 1:
+            frame = cv2.resize(frame, (w//self.rescale_factor, h//self.rescale_factor))
+        frame = np.flip(frame, axis=2)
+        item["image"] = np.ascontiguousarray(fast_rot(frame, self.rot))
+        item["transformed"] = True
+        return item
+
+
+class RemapStage(Stage):
+    '''
+    ReduceStage fused with a geometric correction (lens undistortion, stereo rectification,
+    see undistort.py): a single cv2.remap takes the decoded frame to the reduced, rotated
+    and corrected one. maps_fn(shape, transformed) must return the maps for decoded frames
+    of the given shape; it is called once, on the first frame.
+    '''
+    def __init__(self, maps_fn):
+        super().__init__("remap")
+        self.maps_fn = maps_fn
+        self.maps = None
+
+    def process(self, item):
+        frame = item["image"]
+        if self.maps is None:
+            self.maps = self.maps_fn(frame.shape, item["transformed"])
+        frame = cv2.remap(frame, self.maps[0], self.maps[1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+        if not item["transformed"]:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        item["image"] = frame
+        item["transformed"] = True
+        return item
+
+
+class CopyStage(Stage):
+    '''
+    Keeps a copy of the current image under another key (e.g. the unrectified "crude" frame)
+    '''
+    def __init__(self, key):
+        super().__init__(f"copy:{key}")
+        self.key = key
+
+    def process(self, item):
+        item[self.key] = item["image"].copy()
+        return item
+
+
+class RectifyStage(Stage):
+    '''
+    Illumination and white balance correction (see illumination.py).
+    gain_fn(shape) must return the gain map for frames of the given shape; it is called
+    once, on the first frame.
+    '''
+    def __init__(self, gain_fn):
+        super().__init__("rectify")
+        self.gain_fn = gain_fn
+        self.gain_map = None
+
+    def process(self, item):
+        if self.gain_map is None:
+            self.gain_map = self.gain_fn(item["image"].shape)
+        item["image"] = apply_gain(item["image"], self.gain_map)
+        return item
+
+
+class QRStage(Stage):
+    '''
+    Detects (and tracks) QR codes on the green channel. The codes visible in each frame are
+    stored in item["qr"] as (data, quad) pairs; on_detect(item, data, quad), if given,
+    is called for each of them.
+    '''
+    def __init__(self, tracker, on_detect=None):
+        super().__init__("qr")
+        self.tracker = tracker
+        self.on_detect = on_detect
+
+    def process(self, item):
+        image = item["image"]
+        gray = np.ascontiguousarray(image[:, :, 1]) if image.ndim == 3 else image
+        item["qr"] = self.tracker.process(item["index"], gray)
+        if self.on_detect is not None:
+            for data, quad in item["qr"]:
+                self.on_detect(item, data, quad)
+        return item
+
+
+class CropStage(Stage):
+    '''
+    Crops top_crop% and bottom_crop% rows from the image
+    '''
+    def __init__(self, top_crop=0, bottom_crop=0):
+        super().__init__("crop")
+        self.top_crop = top_crop
+        self.bottom_crop = bottom_crop
+
+    def process(self, item):
+        hr = item["image"].shape[0]
+        top = hr*self.top_crop//100
+        bottom = hr*(100-self.bottom_crop)//100
+        if top > 0 or bottom < hr:
+            item["image"] = item["image"][top:bottom]
+        return item
+
+
+class ImageSink(Stage):
+    '''
+    Writes item["image"] as <output_dir>/<prefix>_frame_NNNNNNN.jpg through an ImageWriter.
+    extras maps other item keys to file name suffixes, e.g. {"crude": "_crude"}.
+    If a manifest (see manifest.py) is given, every file is recorded there, with the
+    parameters hash params, once it is completely written.
+    '''
+    def __init__(self, writer, output_dir, prefix, extras=None, ext=".jpg", manifest=None, params=None, **save_args):
+        super().__init__("sink")
+        self.writer = writer
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.extras = extras if extras is not None else dict()
+        self.ext = ext
+        self.manifest = manifest
+        self.params = params
+        self.save_args = save_args
+
+    def frame_files(self, index):
+        """
+        Files written for frame index (keys of extras missing from the item are not written)
+        """
+        frame_name = os.path.join(self.output_dir, f'{self.prefix}_frame_{index:07d}')
+        return [frame_name+self.ext] + [frame_name+suffix+self.ext for suffix in self.extras.values()]
+
+    def process(self, item):
+        index = item["index"]
+        on_done = None
+        if self.manifest is not None:
+            on_done = lambda fname, crc: self.manifest.record(fname, index, self.prefix, self.params, crc)
+        keys = ["image"] + list(self.extras.keys())
+        for key, fname in zip(keys, self.frame_files(index)):
+            if key in item:
+                self.writer.write(fname, item[key], on_done, **self.save_args)
+        return item
+
+
+class FrameStoreSink(Stage):
+    '''
+    Appends item images to frame stores (see framestore.py) instead of writing image files.
+    stores maps item keys to FrameStores, e.g. {"image": store, "crude": crude_store}.
+    The frame time and the QR codes seen on it (if any) go to the store index.
+    '''
+    def __init__(self, stores):
+        super().__init__("store")
+        self.stores = stores
+
+    def process(self, item):
+        for key, store in self.stores.items():
+            if key in item:
+                store.append(item["index"], item[key], item.get("time"), item.get("qr"))
+        return item
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+
+
+class _PipelineError():
+    def __init__(self, exc):
+        self.exc = exc
+
+_END = object()
+
+
+class Pipeline():
+    '''
+    Runs items from source through stages into sink (see above).
+    '''
+    def __init__(self, source, stages, sink=None, threaded=False, queue_size=4):
+        self.source = source
+        self.stages = list(stages)
+        self.sink = sink
+        self.threaded = threaded
+        self.queue_size = queue_size
+        self.emitted = 0
+        self.elapsed = 0
+
+    def _nodes(self):
+        return self.stages + ([self.sink] if self.sink is not None else [])
+
+    def run(self):
+        """
+        Runs the pipeline to the end. Returns the number of items that reached the end.
+        """
+        t0 = time.time()
+        if self.threaded:
+            self._run_threaded()
         else:
-            blue_profile += np.squeeze(np.sum(rot_frame[:,:,0],axis=1))
-        if n == 100:
-            if blue_profile[0] > blue_profile[-1]:
-                angle = 270
-            #cap.release()
-            return angle
-        #if not n % 100:
-        #    plt.figure()
-        #    plt.subplot(1,2,1)
-        #    plt.plot(blue_profile*(1/n))
-        #    plt.subplot(1,2,2)
-        #    print(np.max(rot_frame))
-        #    plt.imshow(np.flip(rot_frame,2)*(1/np.max(rot_frame)))
-        #    plt.show()
+            for item in self.source:
+                for stage in self._nodes():
+                    item = stage(item)
+                    if item is None:
+                        break
+                if item is not None:
+                    self.emitted += 1
+        for stage in self._nodes():
+            stage.close()
+        self.elapsed = time.time()-t0
+        return self.emitted
+
+    def _run_threaded(self):
+        stop = threading.Event()
+        nodes = self._nodes()
+        queues = [queue.Queue(self.queue_size) for _ in range(len(nodes))]
+
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def feed():
+            try:
+                for item in self.source:
+                    if stop.is_set():
+                        break
+                    put(queues[0], item)
+            except BaseException as e:
+                put(queues[0], _PipelineError(e))
+            put(queues[0], _END)
+
+        def work(stage, qin, qout):
+            while True:
+                item = qin.get()
+                if item is _END or isinstance(item, _PipelineError):
+                    put(qout, item)
+                    return
+                try:
+                    item = stage(item)
+                except BaseException as e:
+                    item = _PipelineError(e)
+                if item is not None:
+                    put(qout, item)
+
+        done = queue.Queue()
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for i, stage in enumerate(nodes):
+            qout = queues[i+1] if i+1 < len(nodes) else done
+            threads.append(threading.Thread(target=work, args=(stage, queues[i], qout), daemon=True))
+        for t in threads:
+            t.start()
+        try:
+            while True:
+                item = done.get()
+                if item is _END:
+                    break
+                if isinstance(item, _PipelineError):
+                    raise item.exc
+                self.emitted += 1
+        finally:
+            stop.set()
+            for t in threads:
+                t.join(timeout=1)
+
+    def report(self):
+        """
+        Prints where the time went, stage by stage
+        """
+        print(f"pipeline: {self.emitted} frames in {self.elapsed:.1f}s ({self.emitted/max(self.elapsed,1e-6):.2f} fps)")
+        if isinstance(self.source, VideoSource) and "grabbed" in self.source.stats:
+            print_sampling_stats(self.source.stats, self.elapsed)
+        for stage in [self.source] + self._nodes():
+            if isinstance(stage, Stage):
+                print(f"\t{stage.name:12s} {stage.calls:8d} calls {stage.seconds:8.2f}s {1000*stage.seconds/max(1,stage.calls):8.2f}ms/call")
+
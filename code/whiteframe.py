@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Streaming per pixel reductions for the white (illumination) frame.
+
+The white frame is computed from the (reduced) frames of a sequence in which the camera
+looks at a white target. Taking the per pixel maximum is cheap but a single specular glint
+ruins it, so we also provide robust alternatives, all computed in a single pass without
+keeping the frames in memory:
+
+    max         per pixel maximum
+    average     per pixel mean
+    trimmed     per pixel mean of the values between the TRIM and 100-TRIM percentiles
+    <integer>   per pixel percentile, e.g. 90
+
+average needs a per pixel sum; trimmed and the percentiles keep a 256 bin histogram per
+pixel (at the reduced resolution), updated with one scatter per frame: each pixel falls in
+exactly one bin, so a single fancy-indexed increment does the job without np.add.at.
+
+WhiteAccumulator also keeps the R,G,B sums of the non saturated pixels used for the white
+balance.
+"""
+
+import numpy as np
+
+TRIM = 10           # percent trimmed at each end by the "trimmed" method
+HIST_BAND = 1 << 16 # pixels processed at a time when reducing histograms
+METHODS = ("max", "average", "trimmed")
+
+
+def parse_method(method):
+    """
+    Returns the method name, or the percentile (int) for integer methods
+    """
+    method = str(method).strip().lower()
+    if method in METHODS:
+        return method
+    try:
+        p = int(method)
+    except ValueError:
+        raise ValueError(f"unknown white frame method {method}: must be one of {', '.join(METHODS)} or a percentile")
+    if not 0 <= p <= 100:
+        raise ValueError(f"percentile must be between 0 and 100 (got {p})")
+    return p
+
+
+def _hist_percentile(hist, n, p):
+    """
+    Per pixel p-th percentile from a (pixels x 256) histogram of n samples
+    """
+    rank = max(1, int(np.ceil(p*n/100)))
+    out = np.empty(hist.shape[0], dtype=np.uint8)
+    for i0 in range(0, hist.shape[0], HIST_BAND):
+        cum = np.cumsum(hist[i0:i0+HIST_BAND], axis=1, dtype=np.uint32)
+        out[i0:i0+HIST_BAND] = np.argmax(cum >= rank, axis=1)
+    return out
+
+
+def _hist_trimmed_mean(hist, n, trim):
+    """
+    Per pixel mean of the samples ranked between trim% and (100-trim)% of a (pixels x 256) histogram
+    """
+    lo = int(np.floor(trim*n/100))
+    hi = n - lo
+    values = np.arange(256, dtype=np.float64)
+    out = np.empty(hist.shape[0], dtype=np.uint8)
+    for i0 in range(0, hist.shape[0], HIST_BAND):
+        h = hist[i0:i0+HIST_BAND].astype(np.int64)
+        cum = np.cumsum(h, axis=1)
+        # number of samples of each bin whose rank falls in [lo,hi)
+        kept = np.clip(np.minimum(cum, hi) - np.maximum(cum - h, lo), 0, None)
+        out[i0:i0+HIST_BAND] = np.rint((kept @ values)/max(1, hi-lo)).astype(np.uint8)
+    return out
+
+
+class WhiteAccumulator():
+    '''
+    Feed it RGB uint8 frames (all with the same shape) with update(); white_frame()
+    returns the uint8 white frame and white_balance() the mean R,G,B of the non saturated
+    pixels. Accumulators of the same method can be combined with merge().
+    '''
+    def __init__(self, method="max"):
+        self.method = parse_method(method)
+        self.shape = None
+        self.frames = 0
+        self.rgb_sums = np.zeros(3, dtype=np.float64)
+        self.num_valid = 0
+        self.acc = None # max, sum or histogram, depending on the method
+
+    def _init(self, shape):
+        self.shape = shape
+        npix = shape[0]*shape[1]
+        if self.method == "max":
+            self.acc = np.zeros(npix, dtype=np.uint8)
+        elif self.method == "average":
+            self.acc = np.zeros(npix, dtype=np.uint32)
+        else:
+            self.acc = np.zeros((npix, 256), dtype=np.uint16)
+            self.bins = np.arange(npix, dtype=np.int64)*256
+
+    def update(self, rgb):
+        if self.shape is None:
+            self._init(rgb.shape[:2])
+        elif rgb.shape[:2] != self.shape:
+            raise ValueError(f"frame shape {rgb.shape[:2]} does not match {self.shape}")
+        gray = (np.sum(rgb, axis=2, dtype=np.uint16)//3).astype(np.uint8).ravel() # (R + G + B)/3
+        # (R+G+B)//3 == 255 only if R = G = B = 255, so each saturated pixel adds exactly
+        # 255 to every channel sum: no need to mask them out
+        saturated = int(np.count_nonzero(gray == 255))
+        self.num_valid += gray.size - saturated
+        self.rgb_sums += rgb.reshape(-1, 3).sum(axis=0, dtype=np.uint64) - 255*saturated
+        if self.method == "max":
+            np.maximum(self.acc, gray, out=self.acc)
+        elif self.method == "average":
+            self.acc += gray
+        else:
+            if self.frames == np.iinfo(self.acc.dtype).max:
+                self.acc = self.acc.astype(np.uint32)
+            self.acc.reshape(-1)[self.bins + gray] += 1
+        self.frames += 1
+
+    def merge(self, other):
+        """
+        Adds the frames accumulated by other (same method and frame shape)
+        """
+        if other.method != self.method:
+            raise ValueError(f"cannot merge {other.method} and {self.method} accumulators")
+        if other.shape is None:
+            return self
+        if self.shape is None:
+            self._init(other.shape)
+        elif other.shape != self.shape:
+            raise ValueError(f"cannot merge accumulators of shapes {other.shape} and {self.shape}")
+        if self.method == "max":
+            np.maximum(self.acc, other.acc, out=self.acc)
+        else:
+            if self.method != "average" and (self.frames + other.frames > np.iinfo(self.acc.dtype).max
+                                             or other.acc.dtype != self.acc.dtype):
+                self.acc = self.acc.astype(np.uint32)
+            self.acc += other.acc
+        self.frames += other.frames
+        self.num_valid += other.num_valid
+        self.rgb_sums += other.rgb_sums
+        return self
+
+    def state(self):
+        """
+        Partial state as a dict of plain values and numpy arrays (picklable, or storable
+        with np.savez), so that accumulators can be run in other processes and merged
+        """
+        return {"method": self.method, "shape": self.shape, "frames": self.frames,
+                "rgb_sums": self.rgb_sums, "num_valid": self.num_valid, "acc": self.acc}
+
+    @staticmethod
+    def from_state(state):
+        accumulator = WhiteAccumulator(state["method"])
+        if state["shape"] is not None:
+            accumulator._init(tuple(state["shape"]))
+            accumulator.acc = state["acc"]
+        accumulator.frames = int(state["frames"])
+        accumulator.rgb_sums = np.array(state["rgb_sums"], dtype=np.float64)
+        accumulator.num_valid = int(state["num_valid"])
+        return accumulator
+
+    def white_frame(self):
+        if self.frames == 0:
+            raise ValueError("no frames accumulated")
+        if self.method == "max":
+            wf = self.acc
+        elif self.method == "average":
+            wf = np.rint(self.acc/self.frames).astype(np.uint8)
+        elif self.method == "trimmed":
+            wf = _hist_trimmed_mean(self.acc, self.frames, TRIM)
+        else:
+            wf = _hist_percentile(self.acc, self.frames, self.method)
+        return wf.reshape(self.shape)
+
+    def white_balance(self):
+        means = self.rgb_sums/max(1, self.num_valid)
+        return {"red": float(means[0]), "green": float(means[1]), "blue": float(means[2])}